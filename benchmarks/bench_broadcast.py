@@ -0,0 +1,94 @@
+"""Fan-out cost of /ws/log broadcasts with hundreds of simulated WebSocket clients.
+
+Compares the old sequential broadcast (json.dumps and an awaited send per client) with ConnectionManager's
+per-client queues, with a share of slow and dead clients mixed in:
+
+    python benchmarks/bench_broadcast.py --clients 500 --messages 200 --slow 0.05 --dead 0.01
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import ConnectionManager
+
+class SimulatedClient:
+    def __init__(self, send_delay: float, dead: bool):
+        self.send_delay, self.dead, self.received = send_delay, dead, 0
+
+    async def accept(self): pass
+
+    async def close(self, code=None): pass
+
+    async def send_text(self, data: str):
+        if self.dead: raise ConnectionResetError("client went away")
+        await asyncio.sleep(self.send_delay)
+        self.received += 1
+
+class SequentialManager:
+    def __init__(self): self.active_connections = []
+
+    async def connect(self, websocket):
+        await websocket.accept()
+        self.active_connections.append(websocket)
+
+    async def broadcast(self, message: str, status: str = "info"):
+        payload = {"message": message, "status": status}
+        for connection in list(self.active_connections):
+            try: await connection.send_text(json.dumps(payload))
+            except Exception: self.active_connections.remove(connection)
+
+def make_clients(args):
+    rng = random.Random(42)
+    clients = []
+    for _ in range(args.clients):
+        roll = rng.random()
+        clients.append(SimulatedClient(args.slow_delay if roll < args.slow else 0.0005, args.slow <= roll < args.slow + args.dead))
+    return clients
+
+async def measure(manager, clients, messages):
+    for client in clients: await manager.connect(client)
+    latencies = []
+    started = time.perf_counter()
+    for i in range(messages):
+        t = time.perf_counter()
+        await manager.broadcast(f"✔ Sent 'bench' to customer {i}", "success")
+        latencies.append(time.perf_counter() - t)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {"seconds": round(elapsed, 3), "broadcasts_per_sec": round(messages / elapsed, 1),
+            "p50_ms": round(1000 * latencies[len(latencies) // 2], 3), "p99_ms": round(1000 * latencies[int(len(latencies) * 0.99)], 3)}
+
+async def run(args):
+    sequential = await measure(SequentialManager(), make_clients(args), args.messages)
+    manager = ConnectionManager(queue_size=args.queue_size, policy=args.policy)
+    clients = make_clients(args)
+    queued = await measure(manager, clients, args.messages)
+    # Time until every healthy fast client has received every broadcast.
+    started = time.perf_counter()
+    fast = [c for c in clients if not c.dead and c.send_delay < args.slow_delay]
+    while any(c.received < args.messages for c in fast) and time.perf_counter() - started < 60:
+        await asyncio.sleep(0.001)
+    queued["fast_clients_drained_seconds"] = round(time.perf_counter() - started, 3)
+    queued.update(manager.stats())
+    for websocket in list(manager.active_connections): manager.disconnect(websocket)
+    return {"clients": args.clients, "messages": args.messages, "sequential": sequential, "queued": queued}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--slow", type=float, default=0.05, help="share of clients that are slow to receive")
+    parser.add_argument("--slow-delay", type=float, default=0.05, help="seconds per send for slow clients")
+    parser.add_argument("--dead", type=float, default=0.01, help="share of clients whose sends fail")
+    parser.add_argument("--queue-size", type=int, default=256)
+    parser.add_argument("--policy", choices=["drop", "disconnect"], default="drop")
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Compare the old one-connection-per-call send path with the pooled async GraphAPIClient.
+
+Start the mock first (see benchmarks/mock_graph.py), then:
+
+    python benchmarks/bench_graph_client.py --base-url http://127.0.0.1:9000/v19.0 --messages 500 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import GraphAPIClient
+
+def payload(i):
+    return {"messaging_product": "whatsapp", "to": f"9100000{i:05d}", "type": "text", "text": {"body": "benchmark"}}
+
+def run_unpooled(base_url, messages):
+    started = time.perf_counter()
+    for i in range(messages):
+        response = httpx.post(f"{base_url}/bench/messages", json=payload(i), headers={"Authorization": "Bearer bench"})
+        response.raise_for_status()
+    return time.perf_counter() - started
+
+async def run_pooled(base_url, messages, concurrency, http2):
+    client = GraphAPIClient(base_url, "bench", "bench", 15, 5, concurrency, http2)
+    await client.open()
+    semaphore = asyncio.Semaphore(concurrency)
+    async def send(i):
+        async with semaphore: await client.send_message(payload(i))
+    started = time.perf_counter()
+    try:
+        await asyncio.gather(*(send(i) for i in range(messages)))
+    finally:
+        await client.close()
+    return time.perf_counter() - started
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://127.0.0.1:9000/v19.0")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--http2", action="store_true")
+    args = parser.parse_args()
+    unpooled = run_unpooled(args.base_url, args.messages)
+    pooled = asyncio.run(run_pooled(args.base_url, args.messages, args.concurrency, args.http2))
+    print(json.dumps({
+        "messages": args.messages, "concurrency": args.concurrency, "http2": args.http2,
+        "unpooled_seconds": round(unpooled, 3), "unpooled_msgs_per_sec": round(args.messages / unpooled, 1),
+        "pooled_seconds": round(pooled, 3), "pooled_msgs_per_sec": round(args.messages / pooled, 1),
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
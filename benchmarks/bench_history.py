@@ -0,0 +1,122 @@
+"""GET /conversations/{sender_id} serialization: the old list-of-dicts + response_model + json path versus the
+streamed orjson path, with gzip and brotli sizes, at 1k, 10k and 100k messages. Histories longer than
+HISTORY_MAX_PAGE_SIZE are read the way a client has to, one `before` page at a time.
+
+Uses the same DB_* environment variables as the app and seeds bench-history-<n> senders, deleted afterwards:
+
+    python benchmarks/bench_history.py --sizes 1000,10000,100000
+
+With --synthetic the rows are generated in memory and only the serialization halves are compared (no database).
+"""
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+import brotli
+import orjson
+from fastapi.encoders import jsonable_encoder
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import (HISTORY_MAX_PAGE_SIZE, HISTORY_STREAM_CHUNK_SIZE, GZIP_LEVEL, BROTLI_QUALITY, MessagePage, db_pool, decode_cursor,
+                  encode_cursor, stream_messages_for_sender_from_db)
+
+SENDER = "bench-history-{}"
+
+def old_encode(rows) -> bytes:
+    # What the endpoint did before: build dicts, validate against MessagePage, encode with the stdlib.
+    messages = [{"id": m[0], "text": m[1], "timestamp": m[2].isoformat(), "direction": (m[3] or '').strip("'"), "status": m[4]} for m in rows]
+    page = {"messages": messages, "has_more": False, "before": encode_cursor(rows[0][2], rows[0][0]), "after": encode_cursor(rows[-1][2], rows[-1][0])}
+    return json.dumps(jsonable_encoder(MessagePage(**page))).encode()
+
+def new_encode(rows) -> bytes:
+    chunks = [b'{"messages":[']
+    for i in range(0, len(rows), HISTORY_STREAM_CHUNK_SIZE):
+        body = orjson.dumps([{"id": m[0], "text": m[1], "timestamp": m[2], "direction": m[3], "status": m[4]} for m in rows[i:i + HISTORY_STREAM_CHUNK_SIZE]])
+        chunks.append((b',' if i else b'') + body[1:-1])
+    chunks.append(b'],' + orjson.dumps({"has_more": False, "before": encode_cursor(rows[0][2], rows[0][0]), "after": encode_cursor(rows[-1][2], rows[-1][0])})[1:])
+    return b"".join(chunks)
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, round(1000 * (time.perf_counter() - started), 2)
+
+def compression(body: bytes) -> dict:
+    gz, gzip_ms = timed(gzip.compress, body, GZIP_LEVEL)
+    br, brotli_ms = timed(lambda b: brotli.compress(b, quality=BROTLI_QUALITY), body)
+    return {"raw_bytes": len(body), "gzip_bytes": len(gz), "gzip_ms": gzip_ms, "br_bytes": len(br), "br_ms": brotli_ms}
+
+def run_synthetic(size: int) -> dict:
+    started = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    rows = [(i, f"Hello, this is benchmark message number {i} about order #{1000 + i}", started + timedelta(seconds=i),
+             "incoming" if i % 2 else "outgoing", "delivered") for i in range(size)]
+    old_body, old_ms = timed(old_encode, rows)
+    new_body, new_ms = timed(new_encode, rows)
+    assert json.loads(old_body)["messages"][-1]["id"] == json.loads(new_body)["messages"][-1]["id"]
+    return {"messages": size, "old_ms": old_ms, "new_ms": new_ms, "speedup": round(old_ms / new_ms, 1), **compression(new_body)}
+
+def run_database(size: int) -> dict:
+    sender = SENDER.format(size)
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM messages WHERE sender_id = %s;", (sender,))
+        cur.execute("""
+            INSERT INTO messages (sender_id, message_text, direction, created_at, status)
+            SELECT %s, 'Hello, this is benchmark message number ' || g, CASE WHEN g %% 2 = 0 THEN 'outgoing' ELSE 'incoming' END,
+                   now() - make_interval(secs => %s - g), 'delivered'
+            FROM generate_series(1, %s) AS g;
+        """, (sender, size, size))
+        conn.commit()
+    try:
+        page = min(size, HISTORY_MAX_PAGE_SIZE)
+        def old_path():
+            # Same keyset pages as the endpoint, each built and encoded the old way.
+            bodies, before = [], None
+            with db_pool.connection() as conn:
+                cur = conn.cursor()
+                while len(bodies) * page < size:
+                    condition, params = ("AND (created_at, id) < (%s, %s)", decode_cursor(before)) if before else ("", ())
+                    cur.execute(f"SELECT id, message_text, created_at, direction, status FROM messages WHERE sender_id = %s {condition} "
+                                "ORDER BY created_at DESC, id DESC LIMIT %s;", (sender, *params, page + 1))
+                    rows = cur.fetchall()[:page][::-1]
+                    bodies.append(old_encode(rows))
+                    before = encode_cursor(rows[0][2], rows[0][0])
+            return bodies
+        def new_path():
+            bodies, before = [], None
+            while len(bodies) * page < size:
+                bodies.append(b"".join(stream_messages_for_sender_from_db(sender, page, before)))
+                before = orjson.loads(bodies[-1])["before"]
+            return bodies
+        old_bodies, old_ms = timed(old_path)
+        new_bodies, new_ms = timed(new_path)
+        count = lambda bodies: sum(len(json.loads(body)["messages"]) for body in bodies)
+        assert count(new_bodies) == count(old_bodies) == size
+        compressed = [compression(body) for body in new_bodies]
+        return {"messages": size, "pages": len(new_bodies), "old_ms": old_ms, "new_ms": new_ms, "speedup": round(old_ms / new_ms, 1),
+                **{key: round(sum(c[key] for c in compressed), 2) for key in compressed[0]}}
+    finally:
+        with db_pool.connection() as conn:
+            conn.cursor().execute("DELETE FROM messages WHERE sender_id = %s;", (sender,))
+            conn.commit()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--synthetic", action="store_true")
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(",")]
+    if args.synthetic:
+        results = [run_synthetic(size) for size in sizes]
+    else:
+        db_pool.open()
+        try: results = [run_database(size) for size in sizes]
+        finally: db_pool.close()
+    print(json.dumps({"mode": "synthetic" if args.synthetic else "database", "results": results}, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Rows/second of the old per-row INSERT path versus the batched MessageWriter.
+
+Uses the same DB_* environment variables as the app and writes rows with a bench-writer- sender_id,
+which are deleted afterwards along with their conversations rows:
+
+    python benchmarks/bench_message_writer.py --rows 2000
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from main import DATABASE_CONFIG, MessageRow, MessageWriter, db_pool
+
+SENDER = "bench-writer-{}"
+
+def run_per_row(rows):
+    started = time.perf_counter()
+    for i in range(rows):
+        conn = psycopg2.connect(**DATABASE_CONFIG)
+        try:
+            cur = conn.cursor()
+            cur.execute("INSERT INTO messages (sender_id, message_text, direction) VALUES (%s, %s, 'incoming');", (SENDER.format(i % 50), f"per-row {i}"))
+            conn.commit()
+        finally:
+            conn.close()
+    return time.perf_counter() - started
+
+def run_writer(rows, batch_size, flush_interval):
+    spill_dir = tempfile.mkdtemp(prefix="bench-writer-")
+    try:
+        writer = MessageWriter(max(rows, 1), batch_size, flush_interval, os.path.join(spill_dir, "messages.spill"))
+        writer.start()
+        started = time.perf_counter()
+        for i in range(rows):
+            writer.put(MessageRow(SENDER.format(i % 50), f"batched {i}", 'incoming', datetime.now(timezone.utc)))
+        writer.stop()
+        return time.perf_counter() - started
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+def cleanup():
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM messages WHERE sender_id LIKE 'bench-writer-%%';")
+        cur.execute("DELETE FROM conversations WHERE sender_id LIKE 'bench-writer-%%';")
+        conn.commit()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--flush-interval", type=float, default=0.5)
+    args = parser.parse_args()
+    db_pool.open()
+    try:
+        try:
+            per_row = run_per_row(args.rows)
+            batched = run_writer(args.rows, args.batch_size, args.flush_interval)
+        finally:
+            cleanup()
+    finally:
+        db_pool.close()
+    print(json.dumps({
+        "rows": args.rows, "batch_size": args.batch_size,
+        "per_row_seconds": round(per_row, 3), "per_row_rows_per_sec": round(args.rows / per_row, 1),
+        "writer_seconds": round(batched, 3), "writer_rows_per_sec": round(args.rows / batched, 1),
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""Sustained load against POST /whatsapp-webhook with synthetic Meta deliveries.
+
+    python benchmarks/load_webhook.py --url http://127.0.0.1:8000 --concurrency 64 --duration 30
+
+Reports acknowledged requests/second and ack latency, then the app's own queue depth, lag and stage timings.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+import uuid
+
+import httpx
+
+def delivery(n: int, messages_per_delivery: int) -> dict:
+    messages = [{"from": f"91{9000000000 + (n * messages_per_delivery + i) % 50000}", "id": f"wamid.{uuid.uuid4().hex}",
+                 "timestamp": str(int(time.time())), "type": "text", "text": {"body": f"load test message {n}-{i}"}}
+                for i in range(messages_per_delivery)]
+    return {"object": "whatsapp_business_account", "entry": [{"id": "load-test", "changes": [{"field": "messages", "value": {
+        "messaging_product": "whatsapp", "metadata": {"phone_number_id": "load-test"}, "messages": messages}}]}]}
+
+async def run(args):
+    counter = itertools.count()
+    latencies, statuses = [], {}
+    deadline = time.perf_counter() + args.duration
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=30) as client:
+        async def user():
+            while time.perf_counter() < deadline:
+                body = json.dumps(delivery(next(counter), args.messages_per_delivery))
+                started = time.perf_counter()
+                response = await client.post("/whatsapp-webhook", content=body, headers={"Content-Type": "application/json"})
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        started = time.perf_counter()
+        await asyncio.gather(*(user() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+        server = (await client.get("/webhook/stats")).json()
+    latencies.sort()
+    pick = lambda q: round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * q))], 3) if latencies else None
+    return {"requests": len(latencies), "seconds": round(elapsed, 3), "requests_per_sec": round(len(latencies) / elapsed, 1),
+            "statuses": statuses, "p50_ms": pick(0.5), "p95_ms": pick(0.95), "p99_ms": pick(0.99), "server": server}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=15)
+    parser.add_argument("--messages-per-delivery", type=int, default=1)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+if __name__ == "__main__":
+    main()
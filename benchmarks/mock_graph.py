@@ -0,0 +1,60 @@
+"""Local stand-in for graph.facebook.com's /messages endpoint.
+
+    MOCK_GRAPH_LATENCY_MS=120 uvicorn benchmarks.mock_graph:app --port 9000
+    GRAPH_API_BASE_URL=http://127.0.0.1:9000/v19.0 uvicorn main:app
+
+Error injection (fractions of requests): MOCK_GRAPH_ERROR_RATE answers 500 with a transient Graph error,
+MOCK_GRAPH_THROTTLE_RATE answers 429 (code 130429) and MOCK_GRAPH_INVALID_RATE answers 400 with a permanent
+"undeliverable" error (code 131026). MOCK_GRAPH_JITTER_MS adds uniform extra latency.
+"""
+import asyncio
+import os
+import random
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+LATENCY_MS = float(os.environ.get('MOCK_GRAPH_LATENCY_MS', '100'))
+JITTER_MS = float(os.environ.get('MOCK_GRAPH_JITTER_MS', '0'))
+ERROR_RATE = float(os.environ.get('MOCK_GRAPH_ERROR_RATE', '0'))
+THROTTLE_RATE = float(os.environ.get('MOCK_GRAPH_THROTTLE_RATE', '0'))
+INVALID_RATE = float(os.environ.get('MOCK_GRAPH_INVALID_RATE', '0'))
+FAULTS = [
+    (ERROR_RATE, "errors_total", 500, {"message": "An unknown error has occurred.", "code": 1, "is_transient": True}),
+    (THROTTLE_RATE, "throttled_total", 429, {"message": "Rate limit hit", "code": 130429}),
+    (INVALID_RATE, "invalid_total", 400, {"message": "Message Undeliverable.", "code": 131026}),
+]
+
+app = FastAPI()
+app.state.counts = {}
+
+def count(key: str):
+    app.state.counts[key] = app.state.counts.get(key, 0) + 1
+
+@app.post("/{version}/{phone_number_id}/messages")
+async def send_message(version: str, phone_number_id: str, request: Request):
+    payload = await request.json()
+    count("requests_total")
+    latency = LATENCY_MS + random.uniform(0, JITTER_MS)
+    if latency: await asyncio.sleep(latency / 1000)
+    roll = random.random()
+    for rate, key, status, error in FAULTS:
+        if roll < rate:
+            count(key)
+            return JSONResponse({"error": {"type": "OAuthException", **error}}, status_code=status)
+        roll -= rate
+    count("accepted_total")
+    recipient = payload.get("to", "")
+    return {"messaging_product": "whatsapp", "contacts": [{"input": recipient, "wa_id": recipient}],
+            "messages": [{"id": f"wamid.{uuid.uuid4().hex}"}]}
+
+@app.get("/stats")
+def stats():
+    return {**app.state.counts, "latency_ms": LATENCY_MS, "jitter_ms": JITTER_MS,
+            "error_rate": ERROR_RATE, "throttle_rate": THROTTLE_RATE, "invalid_rate": INVALID_RATE}
+
+@app.post("/reset")
+def reset():
+    app.state.counts = {}
+    return {"status": "ok"}
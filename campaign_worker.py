@@ -0,0 +1,25 @@
+"""Standalone campaign sender.
+
+Any number of these can run next to (or instead of) the web workers against the same database; they share the
+campaign queue in Postgres and split CAMPAIGN_RATE_LIMIT between every live worker:
+
+    python campaign_worker.py
+"""
+import asyncio
+import os
+import signal
+
+os.environ['CAMPAIGN_WORKER_ENABLED'] = 'true'
+
+from main import app, lifespan
+
+async def serve():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM): loop.add_signal_handler(sig, stop.set)
+    async with lifespan(app):
+        print("Campaign worker running, waiting for campaigns.")
+        await stop.wait()
+
+if __name__ == "__main__":
+    asyncio.run(serve())
@@ -1,17 +1,45 @@
 import os
 import asyncio
+import base64
+import csv
+import fcntl
+import glob
+import gzip
+import hashlib
+import io
 import json
+import queue
+import random
 import time
+import threading
+import select
+import socket
+import string
+import uuid
+import zlib
+import orjson
 import psycopg2
-import requests
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
+import httpx
+try: import brotli
+except ImportError: brotli = None
 import re
-from datetime import datetime
-from typing import List, Optional
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from datetime import date, datetime, timedelta, timezone
+from functools import partial, wraps
+from itertools import chain, islice
+from typing import Dict, List, NamedTuple, Optional, Set
 
-from fastapi import FastAPI, BackgroundTasks, HTTPException, Request, WebSocket
+from fastapi import FastAPI, BackgroundTasks, File, HTTPException, Query, Request, Response, UploadFile, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, generate_latest
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
 
 # ===================================================================
 # --- 1. CONFIGURATION & MODELS ---
@@ -24,6 +52,77 @@ DATABASE_CONFIG = {
     "password": os.environ.get('DB_PASSWORD')
 }
 VERIFY_TOKEN = os.environ.get('VERIFY_TOKEN', 'your-secret-webhook-token')
+WS_CLIENT_QUEUE_SIZE = int(os.environ.get('WS_CLIENT_QUEUE_SIZE', '256'))
+WS_SLOW_CLIENT_POLICY = os.environ.get('WS_SLOW_CLIENT_POLICY', 'drop')  # 'drop' oldest queued message or 'disconnect'
+WS_SEND_TIMEOUT = float(os.environ.get('WS_SEND_TIMEOUT', '5'))
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '10000'))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '4'))
+WEBHOOK_BATCH_SIZE = int(os.environ.get('WEBHOOK_BATCH_SIZE', '100'))
+WEBHOOK_DEDUP_CACHE_SIZE = int(os.environ.get('WEBHOOK_DEDUP_CACHE_SIZE', '100000'))
+WEBHOOK_DEDUP_CACHE_TTL = float(os.environ.get('WEBHOOK_DEDUP_CACHE_TTL', '86400'))
+UPLOAD_READ_CHUNK_SIZE = 64 * 1024
+UPLOAD_COPY_BATCH_SIZE = int(os.environ.get('UPLOAD_COPY_BATCH_SIZE', '5000'))
+SEARCH_CANDIDATE_LIMIT = int(os.environ.get('SEARCH_CANDIDATE_LIMIT', '1000'))  # most recent matches that get ranked
+SEARCH_HEADLINE_OPTIONS = "StartSel=<mark>, StopSel=</mark>, MaxWords=18, MinWords=6, MaxFragments=2, FragmentDelimiter=\" … \""
+HISTORY_MAX_PAGE_SIZE = int(os.environ.get('HISTORY_MAX_PAGE_SIZE', '10000'))
+HISTORY_STREAM_CHUNK_SIZE = 2000  # rows per server-side cursor fetch and per encoded response chunk
+COMPRESSION_MIN_SIZE = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+# Country code assumed for numbers given without one (and too short to carry their own); empty rejects them as invalid.
+DEFAULT_COUNTRY_CODE = re.sub(r'\D', '', os.environ.get('DEFAULT_COUNTRY_CODE', ''))
+CAMPAIGN_PREPARE_BATCH_SIZE = int(os.environ.get('CAMPAIGN_PREPARE_BATCH_SIZE', '10000'))  # source rows normalized per transaction
+CAMPAIGN_CLAIM_BATCH_SIZE = int(os.environ.get('CAMPAIGN_CLAIM_BATCH_SIZE', '50'))
+CAMPAIGN_CLAIM_LEASE = float(os.environ.get('CAMPAIGN_CLAIM_LEASE', '300'))  # seconds before an unfinished 'sending' row is considered orphaned
+CAMPAIGN_SHARDS = 16  # must match the modulus of campaign_recipients.shard (migration 007)
+# Set to false on API-only nodes; sending then happens in the processes started with campaign_worker.py.
+CAMPAIGN_WORKER_ENABLED = os.environ.get('CAMPAIGN_WORKER_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+CAMPAIGN_HEARTBEAT_INTERVAL = float(os.environ.get('CAMPAIGN_HEARTBEAT_INTERVAL', '5'))
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+HISTORY_POOL_SIZE = int(os.environ.get('HISTORY_POOL_SIZE', '4'))  # separate connections for streamed history, which are held for the whole download
+# LISTEN/NOTIFY needs a session-level connection, e.g. Supabase's session pooler port (5432) rather than 6543.
+LISTEN_DATABASE_CONFIG = {**DATABASE_CONFIG, "port": os.environ.get('DB_LISTEN_PORT', DATABASE_CONFIG["port"])}
+DB_LISTEN_ENABLED = os.environ.get('DB_LISTEN_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+TEMPLATES_CHANNEL = 'templates_changed'
+EVENTS_CHANNEL = 'conversation_events'
+CAMPAIGNS_CHANNEL = 'campaigns_changed'
+NOTIFY_PAYLOAD_LIMIT = 7900
+PROCESS_TOKEN = f"{os.getpid()}-{uuid.uuid4().hex}"
+MESSAGE_WRITER_QUEUE_SIZE = int(os.environ.get('MESSAGE_WRITER_QUEUE_SIZE', '10000'))
+MESSAGE_WRITER_BATCH_SIZE = int(os.environ.get('MESSAGE_WRITER_BATCH_SIZE', '500'))
+MESSAGE_WRITER_FLUSH_INTERVAL = float(os.environ.get('MESSAGE_WRITER_FLUSH_INTERVAL', '0.5'))
+MESSAGE_WRITER_SPILL_PATH = os.environ.get('MESSAGE_WRITER_SPILL_PATH', 'message_spill.ndjson')
+MIGRATIONS_LOCK_ID = 720_410_001
+MESSAGE_PARTITIONS_LOCK_ID = 720_410_002
+MESSAGE_ARCHIVE_LOCK_ID = 720_410_003
+MESSAGE_PARTITION_COPY_BATCH_SIZE = int(os.environ.get('MESSAGE_PARTITION_COPY_BATCH_SIZE', '50000'))  # rows per transaction in partition_messages.py
+MESSAGE_PARTITION_PREMAKE_MONTHS = int(os.environ.get('MESSAGE_PARTITION_PREMAKE_MONTHS', '3'))
+MESSAGE_RETENTION_MONTHS = int(os.environ.get('MESSAGE_RETENTION_MONTHS', '0'))  # full months kept online; 0 never archives
+MESSAGE_ARCHIVE_DIR = os.environ.get('MESSAGE_ARCHIVE_DIR', 'message_archive')
+MESSAGE_MAINTENANCE_INTERVAL = float(os.environ.get('MESSAGE_MAINTENANCE_INTERVAL', '3600'))
+MESSAGE_PARTITION_NAME = re.compile(r'^messages_(\d{4})_(\d{2})$')
+CONVERSATION_SNIPPET_LENGTH = 200
+STATUS_RANKS = {"sent": 1, "delivered": 2, "read": 3, "failed": 4}
+PENDING_STATUS_SWEEP_INTERVAL = float(os.environ.get('PENDING_STATUS_SWEEP_INTERVAL', '60'))
+PENDING_STATUS_TTL = float(os.environ.get('PENDING_STATUS_TTL', str(7 * 86400)))  # seconds a status may wait for its message row
+GRAPH_API_BASE_URL = os.environ.get('GRAPH_API_BASE_URL', 'https://graph.facebook.com/v19.0')
+GRAPH_API_TIMEOUT = float(os.environ.get('GRAPH_API_TIMEOUT', '15'))
+GRAPH_API_CONNECT_TIMEOUT = float(os.environ.get('GRAPH_API_CONNECT_TIMEOUT', '5'))
+GRAPH_API_MAX_CONNECTIONS = int(os.environ.get('GRAPH_API_MAX_CONNECTIONS', '100'))
+GRAPH_API_HTTP2 = os.environ.get('GRAPH_API_HTTP2', 'true').lower() in ('1', 'true', 'yes')
+GRAPH_THROTTLING_ERROR_CODES = {4, 80007, 130429, 131048, 131056}
+# Graph errors Meta documents as temporary; anything else that is not 5xx/throttling is treated as permanent.
+GRAPH_TRANSIENT_ERROR_CODES = {1, 2, 131000, 131016, 133004, 133005}
+CAMPAIGN_CONCURRENCY = int(os.environ.get('CAMPAIGN_CONCURRENCY', '10'))
+CAMPAIGN_STOP_GRACE = float(os.environ.get('CAMPAIGN_STOP_GRACE', '10'))  # seconds in-flight sends get to finish on shutdown
+CAMPAIGN_RATE_LIMIT = float(os.environ.get('CAMPAIGN_RATE_LIMIT', '80'))  # messages/second allowed by the WhatsApp tier
+CAMPAIGN_THROTTLE_RETRIES = int(os.environ.get('CAMPAIGN_THROTTLE_RETRIES', '3'))
+CAMPAIGN_PROGRESS_INTERVAL = float(os.environ.get('CAMPAIGN_PROGRESS_INTERVAL', '5'))
+CAMPAIGN_MAX_ATTEMPTS = int(os.environ.get('CAMPAIGN_MAX_ATTEMPTS', '5'))
+CAMPAIGN_RETRY_BASE_DELAY = float(os.environ.get('CAMPAIGN_RETRY_BASE_DELAY', '5'))
+CAMPAIGN_RETRY_MAX_DELAY = float(os.environ.get('CAMPAIGN_RETRY_MAX_DELAY', '600'))
 
 class Customer(BaseModel):
     phone: str
@@ -35,15 +134,69 @@ class Customer(BaseModel):
     offer_code: Optional[str] = None
     promo_link_id: Optional[str] = None
 
+CUSTOMER_FIELDS = list(Customer.model_fields)
+# Fields a segment filter may use, all backed by an index on customers (migration 013): 'text' or 'time'.
+SEGMENT_FIELDS = {"phone": "text", "country_code": "text", "order_status": "text", "product_name": "text", "offer_code": "text",
+                  "promo_link_id": "text", "created_at": "time", "updated_at": "time"}
+SEGMENT_COMPARISONS = {"eq": "=", "ne": "<>", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+SEGMENT_MAX_DEPTH = 8
+
 class CampaignRequest(BaseModel):
     template_name: str
     image_url: Optional[str] = None
-    customers: List[Customer]
+    customers: List[Customer] = []
+    upload_id: Optional[int] = None
+    segment_id: Optional[int] = None
+
+class CustomerImportRequest(BaseModel):
+    customers: List[Customer] = []
+    upload_id: Optional[int] = None
+
+class SegmentCreate(BaseModel):
+    name: str
+    filter: dict
+
+class OptOutRequest(BaseModel):
+    phones: List[str]
+    reason: Optional[str] = None
 
 class Message(BaseModel):
+    id: int
     text: str
     timestamp: str
     direction: str
+    status: Optional[str] = None
+
+class MessagePage(BaseModel):
+    messages: List[Message]
+    before: Optional[str] = None
+    after: Optional[str] = None
+    has_more: bool = False
+
+class ConversationSummary(BaseModel):
+    sender_id: str
+    last_message_at: str
+    last_message_text: Optional[str] = None
+    last_direction: str
+    unread_count: int
+    message_count: int
+
+class ConversationPage(BaseModel):
+    conversations: List[ConversationSummary]
+    next_cursor: Optional[str] = None
+
+class SearchHit(BaseModel):
+    id: int
+    sender_id: str
+    timestamp: str
+    direction: str
+    rank: float
+    snippet: str
+
+class SearchResults(BaseModel):
+    contacts: List[ConversationSummary]
+    messages: List[SearchHit]
+    next_cursor: Optional[str] = None
 
 class Reply(BaseModel):
     message: str
@@ -58,28 +211,1049 @@ class TemplateCreate(BaseModel):
     template_body: str
 
 # ===================================================================
-# --- 2. WebSocket Log Manager ---
+# --- 2. Metrics (Prometheus) ---
 # ===================================================================
+# Per-process metrics: with several gunicorn workers, scrape each worker or set PROMETHEUS_MULTIPROC_DIR.
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+GRAPH_REQUEST_SECONDS = Histogram("whatsapp_graph_request_seconds", "Graph API request latency", ["call", "status"],
+                                  buckets=(0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0, 15.0))
+DB_QUERY_SECONDS = Histogram("whatsapp_db_query_seconds", "Database helper latency, including pool wait", ["helper"])
+MESSAGE_WRITER_FLUSH_SECONDS = Histogram("whatsapp_message_writer_flush_seconds", "Message writer batch commit latency")
+CAMPAIGN_MESSAGES = Counter("whatsapp_campaign_messages_total", "Campaign send outcomes", ["outcome"])
+WEBHOOK_SECONDS = Histogram("whatsapp_webhook_seconds", "Webhook ingestion timings per worker batch", ["stage"], buckets=FAST_BUCKETS)
+WS_FANOUT_SECONDS = Histogram("whatsapp_ws_fanout_seconds", "Time to hand one payload to every subscribed client", ["manager"], buckets=FAST_BUCKETS)
+WS_SEND_SECONDS = Histogram("whatsapp_ws_send_seconds", "Per-client WebSocket send latency", ["manager"], buckets=FAST_BUCKETS)
+EVENT_LOOP_LAG_SECONDS = Histogram("whatsapp_event_loop_lag_seconds", "Event-loop scheduling delay", buckets=FAST_BUCKETS)
+EVENT_LOOP_PROBE_INTERVAL = 0.5
+
+def timed_db(func):
+    histogram = DB_QUERY_SECONDS.labels(func.__name__)
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with histogram.time(): return func(*args, **kwargs)
+    return wrapper
+
+async def monitor_event_loop_lag():
+    # How late a sleep wakes up is how long ready callbacks waited behind blocking work on the loop.
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(EVENT_LOOP_PROBE_INTERVAL)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - started - EVENT_LOOP_PROBE_INTERVAL))
+
+class StatsCollector:
+    # Exposes the existing stats() dictionaries at scrape time, so their counters stay the single source of truth.
+    def __init__(self, sources):
+        self.sources = sources
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        for prefix, stats in self.sources():
+            for key, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)): continue
+                name = f"whatsapp_{prefix}_{key}"
+                if key.endswith("_total"): yield CounterMetricFamily(name[:-len("_total")], f"{prefix} {key}", value=value)
+                else: yield GaugeMetricFamily(name, f"{prefix} {key}", value=value)
+
+# ===================================================================
+# --- 3. WebSocket Managers (Log & Conversation Events) ---
+# ===================================================================
+class ClientChannel:
+    def __init__(self, websocket: WebSocket, queue_size: int, policy: str, on_close, send_seconds):
+        self.websocket, self.policy, self.on_close, self.send_seconds = websocket, policy, on_close, send_seconds
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.task = asyncio.create_task(self._pump())
+
+    def offer(self, data: str) -> bool:
+        try:
+            self.queue.put_nowait(data)
+            return True
+        except asyncio.QueueFull:
+            if self.policy == "disconnect": return False
+            # Drop-oldest keeps a lagging client current instead of replaying a stale backlog.
+            self.queue.get_nowait()
+            self.queue.put_nowait(data)
+            self.dropped += 1
+            return True
+
+    async def _pump(self):
+        try:
+            while True:
+                data = await self.queue.get()
+                with self.send_seconds.time(): await asyncio.wait_for(self.websocket.send_text(data), WS_SEND_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.on_close(self.websocket)
+
+    def close(self, code: Optional[int] = None):
+        self.task.cancel()
+        if code is not None: asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try: await self.websocket.close(code=code)
+        except Exception: pass
+
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    def __init__(self, name: str = "log", queue_size: int = WS_CLIENT_QUEUE_SIZE, policy: str = WS_SLOW_CLIENT_POLICY):
+        self.queue_size, self.policy = queue_size, policy
+        self.fanout_seconds, self.send_seconds = WS_FANOUT_SECONDS.labels(name), WS_SEND_SECONDS.labels(name)
+        self.active_connections: Dict[WebSocket, ClientChannel] = {}
+        self.slow_disconnects_total = 0
+        self.dropped_total = 0  # drops of clients that have since disconnected, so the counter never goes backwards
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections[websocket] = ClientChannel(websocket, self.queue_size, self.policy, self.disconnect, self.send_seconds)
+
+    def disconnect(self, websocket: WebSocket, code: Optional[int] = None):
+        channel = self.active_connections.pop(websocket, None)
+        if channel is None: return
+        self.dropped_total += channel.dropped
+        channel.close(code)
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+    def send_to(self, websockets, data: str):
+        # Serialized once by the caller; each client's own pump task does the actual send, so one slow socket never stalls the rest.
+        with self.fanout_seconds.time():
+            for websocket in list(websockets):
+                channel = self.active_connections.get(websocket)
+                if channel is not None and not channel.offer(data):
+                    self.slow_disconnects_total += 1
+                    self.disconnect(websocket, code=1013)
 
     async def broadcast(self, message: str, status: str = "info"):
-        payload = {"message": message, "status": status}
-        for connection in self.active_connections:
-            await connection.send_text(json.dumps(payload))
+        self.send_to(self.active_connections, json.dumps({"message": message, "status": status}))
+
+    def stats(self):
+        channels = list(self.active_connections.values())
+        return {"connections": len(channels), "queued": sum(c.queue.qsize() for c in channels),
+                "dropped_total": self.dropped_total + sum(c.dropped for c in channels), "slow_disconnects_total": self.slow_disconnects_total}
 
 log_manager = ConnectionManager()
 
+class EventHub(ConnectionManager):
+    def __init__(self):
+        super().__init__("events")
+        self.subscriptions: Dict[str, Set[WebSocket]] = defaultdict(set)
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def subscribe(self, websocket: WebSocket, topic: str):
+        if topic == "inbox" or topic.startswith("conversation:"): self.subscriptions[topic].add(websocket)
+
+    def unsubscribe(self, websocket: WebSocket, topic: str):
+        sockets = self.subscriptions.get(topic)
+        if sockets is not None:
+            sockets.discard(websocket)
+            if not sockets: del self.subscriptions[topic]
+
+    def disconnect(self, websocket: WebSocket, code: Optional[int] = None):
+        for topic in list(self.subscriptions): self.unsubscribe(websocket, topic)
+        super().disconnect(websocket, code)
+
+    async def publish(self, topic: str, event: dict):
+        sockets = self.subscriptions.get(topic)
+        if sockets: self.send_to(sockets, json.dumps(event))
+
+    async def dispatch(self, payload: Optional[str]):
+        # A None payload means notifications may have been missed; clients refetch what they show.
+        if payload is None:
+            self.send_to(self.active_connections, json.dumps({"type": "resync"}))
+            return
+        data = json.loads(payload)
+        conversation = data["conversation"]
+        await self.publish("inbox", {"type": "conversation.updated", "conversation": conversation})
+        if data.get("messages") != []:
+            await self.publish(f"conversation:{conversation['sender_id']}", {"type": "message.new", "sender_id": conversation["sender_id"], "messages": data.get("messages")})
+
+    def dispatch_threadsafe(self, payload: Optional[str]):
+        if self.loop is not None and not self.loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self.dispatch(payload), self.loop)
+
+event_hub = EventHub()
+
 # ===================================================================
-# --- 3. HELPER FUNCTIONS (WhatsApp & DB) ---
+# --- 4. Database Access (Pool, Listener, Message Writer) ---
+# ===================================================================
+class DatabasePool:
+    def __init__(self, minconn: int, maxconn: int, timeout: float, config: dict):
+        self.minconn, self.maxconn, self.timeout, self.config = minconn, maxconn, timeout, config
+        self._pool: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired_total = 0
+        self.timeouts_total = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def open(self):
+        if self._pool is None:
+            self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.config)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+
+    @contextmanager
+    def connection(self):
+        if self._pool is None: raise RuntimeError("Database pool is not open.")
+        started = time.perf_counter()
+        with self._lock: self.waiting += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        waited = time.perf_counter() - started
+        with self._lock:
+            self.waiting -= 1
+            if acquired:
+                self.in_use += 1
+                self.acquired_total += 1
+                self.wait_time_total += waited
+                self.wait_time_max = max(self.wait_time_max, waited)
+            else:
+                self.timeouts_total += 1
+        if not acquired:
+            raise psycopg2.pool.PoolError(f"Timed out after {self.timeout}s waiting for a database connection.")
+        conn = None
+        try:
+            conn = self._pool.getconn()
+            yield conn
+        finally:
+            if conn is not None:
+                if not conn.closed:
+                    try: conn.rollback()
+                    except psycopg2.Error: pass
+                self._pool.putconn(conn, close=bool(conn.closed))
+            with self._lock: self.in_use -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self.maxconn, "in_use": self.in_use, "idle": self.maxconn - self.in_use,
+                "waiting": self.waiting, "acquired_total": self.acquired_total, "timeouts_total": self.timeouts_total,
+                "wait_time_avg_ms": round(1000 * self.wait_time_total / self.acquired_total, 3) if self.acquired_total else 0.0,
+                "wait_time_max_ms": round(1000 * self.wait_time_max, 3),
+            }
+
+db_pool = DatabasePool(DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DATABASE_CONFIG)
+history_pool = DatabasePool(1, HISTORY_POOL_SIZE, DB_POOL_TIMEOUT, DATABASE_CONFIG)
+
+class PgListener:
+    def __init__(self, config: dict):
+        self.config = config
+        self.handlers: dict = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def on(self, channel: str, handler):
+        self.handlers[channel] = handler
+
+    def start(self):
+        if DB_LISTEN_ENABLED and self.handlers and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="pg-listener", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        reconnecting = False
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.config)
+                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                cur = conn.cursor()
+                for channel in self.handlers: cur.execute(f"LISTEN {channel};")
+                # Anything published while we were disconnected is lost, so handlers get a None payload to resync.
+                if reconnecting: self._dispatch(self.handlers, None)
+                reconnecting = True
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 1.0) == ([], [], []): continue
+                    conn.poll()
+                    while conn.notifies:
+                        notify = conn.notifies.pop(0)
+                        self._dispatch({notify.channel: self.handlers.get(notify.channel)}, notify.payload)
+            except psycopg2.Error as e:
+                print(f"Database listener error: {e}")
+                self._stop.wait(5)
+            finally:
+                if conn: conn.close()
+
+    def _dispatch(self, handlers: dict, payload: Optional[str]):
+        for channel, handler in handlers.items():
+            if handler is None: continue
+            try: handler(payload)
+            except Exception as e: print(f"Error handling '{channel}' notification: {e}")
+
+pg_listener = PgListener(LISTEN_DATABASE_CONFIG)
+
+def strip_nul(text: Optional[str]) -> Optional[str]:
+    # Postgres text cannot hold NUL bytes; psycopg2 refuses them with a ValueError.
+    return text.replace("\x00", "") if text else text
+
+class MessageRow(NamedTuple):
+    sender_id: str
+    message_text: str
+    direction: str
+    created_at: datetime
+    wamid: Optional[str] = None
+
+class StatusUpdate(NamedTuple):
+    wamid: str
+    status: str
+    updated_at: datetime
+    recipient_id: Optional[str] = None
+    error: Optional[str] = None
+
+class RecipientOutcome(NamedTuple):
+    recipient_id: int
+    state: str
+    wamid: Optional[str] = None
+    error: Optional[str] = None
+    error_code: Optional[int] = None
+    next_attempt_at: Optional[datetime] = None
+
+class CampaignRecipient(NamedTuple):
+    id: int
+    recipient: str
+    name: str
+    variables: dict
+    attempts: int
+
+class WriterBarrier(NamedTuple):
+    done: threading.Event
+
+class MessageWriter:
+    _STOP = object()
+
+    def __init__(self, queue_size: int, batch_size: int, flush_interval: float, spill_path: str):
+        self.batch_size, self.flush_interval, self.spill_path = batch_size, flush_interval, spill_path
+        self._queue: queue.Queue = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._spill_lock = threading.Lock()
+        self.written_total = 0
+        self.duplicates_total = 0
+        self.statuses_total = 0
+        self.flushes_total = 0
+        self.spilled_total = 0
+
+    def start(self):
+        if self._thread is None:
+            self._closed = False
+            self._replay_spill()
+            self._thread = threading.Thread(target=self._run, name="message-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        # Graceful stop: everything queued before the sentinel is flushed before the thread exits.
+        if self._thread is not None:
+            self._closed = True
+            self._queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+
+    def put(self, item, urgent: bool = False):
+        if self._closed: return self._flush([item])
+        self._queue.put((item, urgent))
+
+    async def drain(self):
+        # Resolves once everything queued before the call has been committed (or spilled).
+        if self._thread is None: return
+        barrier = WriterBarrier(threading.Event())
+        await self.put_async(barrier)
+        await asyncio.to_thread(barrier.done.wait)
+
+    async def put_async(self, item, urgent: bool = False):
+        if self._closed: return await asyncio.to_thread(self._flush, [item])
+        try: self._queue.put_nowait((item, urgent))
+        except queue.Full: await asyncio.to_thread(self._queue.put, (item, urgent))
+
+    def _run(self):
+        batch: list = []
+        deadline, urgent = None, False
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try: item = self._queue.get(timeout=timeout)
+            except queue.Empty: item = None
+            if item is self._STOP:
+                if batch: self._flush(batch)
+                return
+            if item is not None and isinstance(item[0], WriterBarrier):
+                if batch: self._flush(batch)
+                batch, deadline, urgent = [], None, False
+                item[0].done.set()
+                continue
+            if item is not None:
+                batch.append(item[0])
+                urgent = urgent or item[1]
+                if deadline is None: deadline = time.monotonic() + self.flush_interval
+            # Urgent rows (inbound messages, operator replies) flush as soon as the queue is momentarily empty: group commit.
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline or (urgent and self._queue.empty())):
+                self._flush(batch)
+                batch, deadline, urgent = [], None, False
+
+    def _flush(self, items: list):
+        # Database errors are retried inside _write; anything else (a value psycopg2 cannot adapt, a bug) would fail the
+        # same way every time, so the batch goes to the spill file and the thread keeps draining the queue.
+        try:
+            with MESSAGE_WRITER_FLUSH_SECONDS.time(): self._write(items)
+        except Exception as e:
+            print(f"Message writer could not write a batch of {len(items)}, spilling it: {e!r}")
+            try: self.spill(items)
+            except Exception as e: print(f"Message writer dropped a batch of {len(items)}: {e!r}")
+
+    def _write(self, items: list):
+        rows = [i for i in items if isinstance(i, MessageRow)]
+        statuses = [i for i in items if isinstance(i, StatusUpdate)]
+        outcomes = [i for i in items if isinstance(i, RecipientOutcome)]
+        for attempt in range(3):
+            try:
+                events = []
+                with db_pool.connection() as conn:
+                    cur = conn.cursor()
+                    # Rows go in before statuses so a status arriving in the same batch as its outgoing row still applies.
+                    stored = []
+                    if rows:
+                        # message_wamids is the backstop for webhook retries the in-memory cache did not catch: a row is
+                        # only inserted when its wamid is claimed there (messages is partitioned, so it cannot be unique).
+                        seen = set()
+                        unique = [r for r in rows if r.wamid is None or not (r.wamid in seen or seen.add(r.wamid))]
+                        inserted = psycopg2.extras.execute_values(cur, """
+                            WITH batch (sender_id, message_text, direction, created_at, wamid) AS (VALUES %s),
+                            claimed AS (
+                                INSERT INTO message_wamids (wamid, created_at) SELECT wamid, created_at FROM batch WHERE wamid IS NOT NULL
+                                ON CONFLICT (wamid) DO NOTHING RETURNING wamid
+                            )
+                            INSERT INTO messages (sender_id, message_text, direction, created_at, wamid)
+                            SELECT * FROM batch WHERE wamid IS NULL OR wamid IN (SELECT wamid FROM claimed)
+                            RETURNING id, sender_id, message_text, direction, created_at, wamid;
+                        """, unique, template="(%s, %s, %s, %s::timestamptz, %s::text)", page_size=len(unique), fetch=True)
+                        stored = [MessageRow(*r[1:]) for r in inserted]
+                    if stored:
+                        summaries = self._update_conversations(cur, stored)
+                        events = build_conversation_events(stored, [r[0] for r in inserted], summaries)
+                        publish_conversation_events(cur, events)
+                    # Recipient outcomes commit with their outgoing message rows, so 'sent' always has a stored message behind it.
+                    # They go before statuses so a status in the same batch can be attributed to its campaign.
+                    if outcomes: apply_recipient_outcomes(cur, outcomes)
+                    wamids = [r.wamid for r in stored if r.wamid]
+                    if wamids:
+                        # Statuses that arrived (possibly in another process) before this row was stored were parked.
+                        cur.execute("DELETE FROM message_status_pending WHERE wamid = ANY(%s) RETURNING wamid, status, updated_at, recipient_id, error;", (wamids,))
+                        statuses = statuses + [StatusUpdate(*r) for r in cur.fetchall()]
+                    if statuses: apply_status_updates(cur, statuses)
+                    conn.commit()
+                if not DB_LISTEN_ENABLED:
+                    for payload in events: event_hub.dispatch_threadsafe(payload)
+                self.written_total += len(stored)
+                self.duplicates_total += len(rows) - len(stored)
+                self.statuses_total += len(statuses)
+                self.flushes_total += 1
+                return
+            except (psycopg2.Error, RuntimeError) as e:
+                print(f"Message writer flush failed (attempt {attempt + 1}): {e}")
+                time.sleep(0.5 * 2 ** attempt)
+        self.spill(items)
+
+    def _update_conversations(self, cur, rows: List[MessageRow]):
+        # Fold the batch into one summary row per sender; sorted so concurrent writers lock senders in the same order.
+        summaries: dict = {}
+        for row in rows:
+            latest, count, unread = summaries.get(row.sender_id, (row, 0, 0))
+            if row.created_at >= latest.created_at: latest = row
+            summaries[row.sender_id] = (latest, count + 1, unread + (row.direction == 'incoming'))
+        values = [(sender_id, latest.created_at, latest.message_text[:CONVERSATION_SNIPPET_LENGTH], latest.direction, unread, count)
+                  for sender_id, (latest, count, unread) in sorted(summaries.items())]
+        return psycopg2.extras.execute_values(cur, """
+            INSERT INTO conversations (sender_id, last_message_at, last_message_text, last_direction, unread_count, message_count) VALUES %s
+            ON CONFLICT (sender_id) DO UPDATE SET
+                last_message_text = CASE WHEN EXCLUDED.last_message_at >= conversations.last_message_at THEN EXCLUDED.last_message_text ELSE conversations.last_message_text END,
+                last_direction = CASE WHEN EXCLUDED.last_message_at >= conversations.last_message_at THEN EXCLUDED.last_direction ELSE conversations.last_direction END,
+                last_message_at = GREATEST(conversations.last_message_at, EXCLUDED.last_message_at),
+                unread_count = conversations.unread_count + EXCLUDED.unread_count,
+                message_count = conversations.message_count + EXCLUDED.message_count
+            RETURNING sender_id, last_message_at, last_message_text, last_direction, unread_count, message_count;
+        """, values, page_size=len(values), fetch=True)
+
+    def spill(self, items: list):
+        # Items that could not reach Postgres are kept on disk and replayed on the next start. Every process appends to the
+        # same file under an exclusive flock; if a starting process renamed it away while we waited, write a fresh one.
+        with self._spill_lock:
+            while True:
+                f = open(self.spill_path, "a", encoding="utf-8")
+                fcntl.flock(f, fcntl.LOCK_EX)
+                if same_file(self.spill_path, f): break
+                f.close()
+            with f:
+                for item in items:
+                    record = {k: v.isoformat() if isinstance(v, datetime) else v for k, v in item._asdict().items()}
+                    f.write(json.dumps({"kind": type(item).__name__, **record}) + "\n")
+        self.spilled_total += len(items)
+
+    def _replay_spill(self):
+        # The spill file and any '.replaying' leftovers are each claimed under a non-blocking flock, so workers starting
+        # together never take the same file, and a replay cut short by a crash (the lock dies with the process) is resumed
+        # by the next start. Replaying twice is harmless: wamids de-duplicate and statuses/outcomes are idempotent.
+        for path in [self.spill_path, *sorted(glob.glob(f"{glob.escape(self.spill_path)}.replaying*"))]:
+            try: f = open(path, encoding="utf-8")
+            except FileNotFoundError: continue
+            with f:
+                try: fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError: continue
+                if not same_file(path, f): continue
+                if path == self.spill_path:
+                    replaying = f"{self.spill_path}.replaying.{PROCESS_TOKEN}"
+                    os.replace(path, replaying)
+                    path = replaying
+                try: self._replay_file(f)
+                except Exception as e:
+                    print(f"Could not replay {path}, leaving it for the next start: {e}")
+                    continue
+                os.remove(path)
+
+    def _replay_file(self, f):
+        kinds = {"MessageRow": (MessageRow, "created_at"), "StatusUpdate": (StatusUpdate, "updated_at"), "RecipientOutcome": (RecipientOutcome, "next_attempt_at")}
+        items = []
+        for record in map(json.loads, f):
+            kind, time_field = kinds[record.pop("kind", "MessageRow")]
+            if record.get(time_field): record[time_field] = datetime.fromisoformat(record[time_field])
+            items.append(kind(**record))
+        for i in range(0, len(items), self.batch_size): self._flush(items[i:i + self.batch_size])
+
+    def stats(self):
+        return {"queue_depth": self._queue.qsize(), "queue_capacity": self._queue.maxsize, "written_total": self.written_total,
+                "duplicates_total": self.duplicates_total, "statuses_total": self.statuses_total, "flushes_total": self.flushes_total, "spilled_total": self.spilled_total}
+
+def same_file(path: str, f) -> bool:
+    try: return os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+    except FileNotFoundError: return False
+
+def conversation_from_row(r) -> dict:
+    return {"sender_id": r[0], "last_message_at": r[1].isoformat(), "last_message_text": r[2],
+            "last_direction": (r[3] or '').strip("'"), "unread_count": r[4], "message_count": r[5]}
+
+def build_conversation_events(rows: List[MessageRow], message_ids: List[int], summaries) -> List[str]:
+    messages_by_sender = defaultdict(list)
+    for row, message_id in zip(rows, message_ids):
+        messages_by_sender[row.sender_id].append({"id": message_id, "text": row.message_text, "timestamp": row.created_at.isoformat(),
+                                                  "direction": row.direction, "cursor": encode_cursor(row.created_at, message_id)})
+    events = []
+    for summary in summaries:
+        conversation = conversation_from_row(summary)
+        payload = json.dumps({"conversation": conversation, "messages": messages_by_sender[conversation["sender_id"]]})
+        # NOTIFY payloads are capped at 8000 bytes; oversized events make clients fetch the new rows by cursor instead.
+        if len(payload.encode()) > NOTIFY_PAYLOAD_LIMIT: payload = json.dumps({"conversation": conversation, "messages": None})
+        events.append(payload)
+    return events
+
+# Campaign rollups are bumped in the same statements that change recipient and message state, so they never need a rescan.
+CAMPAIGN_STATS_INSERT = "INSERT INTO campaign_stats_hourly AS s (campaign_id, bucket, template_name, sent, delivered, read, send_failed, delivery_failed)"
+CAMPAIGN_STATS_ON_CONFLICT = ("ON CONFLICT (campaign_id, bucket) DO UPDATE SET sent = s.sent + EXCLUDED.sent, delivered = s.delivered + EXCLUDED.delivered, "
+                              "read = s.read + EXCLUDED.read, send_failed = s.send_failed + EXCLUDED.send_failed, "
+                              "delivery_failed = s.delivery_failed + EXCLUDED.delivery_failed")
+
+def apply_status_updates(cur, statuses: List[StatusUpdate]):
+    # Keep only the furthest status per wamid and never move a row backwards (e.g. a late 'delivered' after 'read').
+    latest: dict = {}
+    for update in statuses:
+        rank = STATUS_RANKS.get(update.status)
+        current = latest.get(update.wamid)
+        if rank and (current is None or rank > STATUS_RANKS[current.status]): latest[update.wamid] = update
+    values = [(u.wamid, u.status, u.updated_at, STATUS_RANKS[u.status], u.error, u.recipient_id) for u in sorted(latest.values())]
+    if not values: return []
+    # The locked pre-image gives each row's previous status, so a jump from 'sent' straight to 'read' still counts as delivered.
+    # Rows are looked up through message_wamids.created_at, so only the partition holding each message is probed.
+    # A status whose message is not stored yet (the sender's writer has not flushed) is parked until the row arrives.
+    return psycopg2.extras.execute_values(cur, f"""
+        WITH v (wamid, status, updated_at, rank, error, recipient_id) AS (VALUES %s),
+        parked AS (
+            INSERT INTO message_status_pending AS p (wamid, status, updated_at, rank, error, recipient_id)
+            SELECT wamid, status, updated_at, rank, error, recipient_id FROM v
+            WHERE NOT EXISTS (SELECT 1 FROM message_wamids AS w WHERE w.wamid = v.wamid)
+            ON CONFLICT (wamid) DO UPDATE SET status = EXCLUDED.status, updated_at = EXCLUDED.updated_at, rank = EXCLUDED.rank, error = EXCLUDED.error
+            WHERE p.rank < EXCLUDED.rank
+        ),
+        changed AS (
+            UPDATE messages AS m SET status = v.status, status_updated_at = v.updated_at, status_error = v.error
+            FROM v, (SELECT m2.id, m2.created_at, m2.status FROM message_wamids AS w
+                     JOIN messages AS m2 ON m2.created_at = w.created_at AND m2.wamid = w.wamid
+                     WHERE w.wamid IN (SELECT wamid FROM v) FOR UPDATE OF m2) AS previous
+            WHERE m.wamid = v.wamid AND m.id = previous.id AND m.created_at = previous.created_at
+              AND COALESCE(CASE m.status WHEN 'sent' THEN 1 WHEN 'delivered' THEN 2 WHEN 'read' THEN 3 WHEN 'failed' THEN 4 END, 0) < v.rank
+            RETURNING m.wamid, v.status, previous.status AS previous_status, v.updated_at
+        ),
+        counted AS (
+            {CAMPAIGN_STATS_INSERT}
+            SELECT r.campaign_id, date_trunc('hour', c.updated_at, 'UTC'), campaigns.template_name, 0,
+                   count(*) FILTER (WHERE c.status IN ('delivered', 'read') AND COALESCE(c.previous_status, 'sent') = 'sent'),
+                   count(*) FILTER (WHERE c.status = 'read'), 0, count(*) FILTER (WHERE c.status = 'failed')
+            FROM changed AS c JOIN campaign_recipients AS r ON r.wamid = c.wamid JOIN campaigns ON campaigns.id = r.campaign_id
+            GROUP BY 1, 2, 3
+            {CAMPAIGN_STATS_ON_CONFLICT}
+        )
+        SELECT wamid, status FROM changed;
+    """, values, template="(%s, %s, %s::timestamptz, %s, %s::text, %s::text)", page_size=len(values), fetch=True)
+
+def apply_recipient_outcomes(cur, outcomes: List[RecipientOutcome]):
+    # A 'pending' outcome is a scheduled retry; final failures are copied to the dead-letter table in the same statement.
+    values = [(o.recipient_id, o.state, o.wamid, o.error, o.error_code, o.next_attempt_at) for o in sorted(outcomes, key=lambda o: o.recipient_id)]
+    psycopg2.extras.execute_values(cur, f"""
+        WITH updated AS (
+            UPDATE campaign_recipients AS r SET state = v.state, wamid = v.wamid, last_error = v.error, last_error_code = v.error_code,
+                next_attempt_at = v.next_attempt_at, updated_at = now()
+            FROM (VALUES %s) AS v (id, state, wamid, error, error_code, next_attempt_at)
+            WHERE r.id = v.id AND r.state = 'sending'
+            RETURNING r.id, r.campaign_id, r.recipient, r.state, r.attempts, r.last_error, r.last_error_code
+        ),
+        counted AS (
+            {CAMPAIGN_STATS_INSERT}
+            SELECT u.campaign_id, date_trunc('hour', now(), 'UTC'), c.template_name,
+                   count(*) FILTER (WHERE u.state = 'sent'), 0, 0, count(*) FILTER (WHERE u.state = 'failed'), 0
+            FROM updated AS u JOIN campaigns AS c ON c.id = u.campaign_id
+            WHERE u.state IN ('sent', 'failed')
+            GROUP BY u.campaign_id, c.template_name
+            {CAMPAIGN_STATS_ON_CONFLICT}
+        )
+        INSERT INTO campaign_dead_letters (campaign_id, recipient_id, recipient, attempts, error, error_code)
+        SELECT campaign_id, id, recipient, attempts, last_error, last_error_code FROM updated WHERE state = 'failed';
+    """, values, template="(%s::bigint, %s, %s::text, %s::text, %s::integer, %s::timestamptz)", page_size=len(values))
+    # Whichever writer records a campaign's last outcome completes it. The campaign row lock makes concurrent writers take
+    # turns, and the check runs as a later statement, so it sees the outcomes the previous lock holder committed.
+    cur.execute("""
+        SELECT id FROM campaigns WHERE id IN (SELECT campaign_id FROM campaign_recipients WHERE id = ANY(%s)) AND status = 'running'
+        ORDER BY id FOR UPDATE;
+    """, ([v[0] for v in values],))
+    running = [r[0] for r in cur.fetchall()]
+    if not running: return
+    cur.execute("""
+        UPDATE campaigns AS c SET status = 'completed', updated_at = now(), finished_at = now()
+        WHERE c.id = ANY(%s) AND NOT EXISTS (SELECT 1 FROM campaign_recipients AS r WHERE r.campaign_id = c.id AND r.state IN ('pending', 'sending'))
+        RETURNING c.id;
+    """, (running,))
+    for (campaign_id,) in cur.fetchall(): notify_campaign_changed(cur, campaign_id)
+
+def publish_conversation_events(cur, events: List[str]):
+    if events and DB_LISTEN_ENABLED:
+        cur.execute("SELECT pg_notify(%s, payload) FROM unnest(%s::text[]) AS payload;", (EVENTS_CHANNEL, events))
+
+message_writer = MessageWriter(MESSAGE_WRITER_QUEUE_SIZE, MESSAGE_WRITER_BATCH_SIZE, MESSAGE_WRITER_FLUSH_INTERVAL, MESSAGE_WRITER_SPILL_PATH)
+
+# Migration 011 in three steps: the schema swap, a copy that partition_messages.py runs in batches while the app is
+# stopped, and the index build. On an empty table the migration runs inline at startup as setup + finish.
+MESSAGE_PARTITIONS_SETUP = """
+    -- A unique index on a partitioned table must include the partition key, so wamid de-duplication moves to its own table.
+    CREATE TABLE IF NOT EXISTS message_wamids (
+        wamid TEXT PRIMARY KEY,
+        created_at TIMESTAMPTZ NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS message_wamids_created_idx ON message_wamids (created_at);
+    CREATE TABLE IF NOT EXISTS message_archives (
+        partition_name TEXT PRIMARY KEY,
+        range_start TIMESTAMPTZ NOT NULL,
+        range_end TIMESTAMPTZ NOT NULL,
+        path TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'exporting',
+        row_count BIGINT,
+        byte_count BIGINT,
+        sha256 TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        archived_at TIMESTAMPTZ
+    );
+    CREATE SEQUENCE IF NOT EXISTS messages_partitioned_id_seq;
+    SELECT setval('messages_partitioned_id_seq', COALESCE((SELECT max(id) FROM messages), 0) + 1, false);
+    ALTER TABLE messages RENAME TO messages_unpartitioned;
+    CREATE TABLE messages (
+        id BIGINT NOT NULL DEFAULT nextval('messages_partitioned_id_seq'),
+        sender_id TEXT NOT NULL,
+        message_text TEXT,
+        direction TEXT,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+        wamid TEXT,
+        status TEXT,
+        status_updated_at TIMESTAMPTZ,
+        status_error TEXT,
+        PRIMARY KEY (id, created_at)
+    ) PARTITION BY RANGE (created_at);
+    ALTER SEQUENCE messages_partitioned_id_seq OWNED BY messages.id;
+    -- Catches rows for months without a partition (late spill replays, archived months) instead of failing the insert.
+    CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+    -- Months are UTC. Rows already sitting in the default partition move into the new month, or ATTACH would refuse.
+    CREATE OR REPLACE FUNCTION ensure_messages_partition(month DATE) RETURNS TEXT LANGUAGE plpgsql AS $$
+    DECLARE
+        table_name TEXT := 'messages_' || to_char(month, 'YYYY_MM');
+        range_start TIMESTAMPTZ := date_trunc('month', month::timestamp) AT TIME ZONE 'UTC';
+        range_end TIMESTAMPTZ := (date_trunc('month', month::timestamp) + INTERVAL '1 month') AT TIME ZONE 'UTC';
+    BEGIN
+        IF to_regclass(table_name) IS NOT NULL OR EXISTS (SELECT 1 FROM message_archives AS a WHERE a.partition_name = table_name) THEN
+            RETURN table_name;
+        END IF;
+        EXECUTE format('CREATE TABLE %I (LIKE messages INCLUDING DEFAULTS)', table_name);
+        EXECUTE format('WITH moved AS (DELETE FROM messages_default WHERE created_at >= %L AND created_at < %L RETURNING *) '
+                       'INSERT INTO %I SELECT * FROM moved', range_start, range_end, table_name);
+        EXECUTE format('ALTER TABLE messages ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', table_name, range_start, range_end);
+        RETURN table_name;
+    END $$;
+    SELECT ensure_messages_partition(month::date) FROM generate_series(
+        date_trunc('month', COALESCE((SELECT min(created_at) FROM messages_unpartitioned), now()) AT TIME ZONE 'UTC'),
+        date_trunc('month', now() AT TIME ZONE 'UTC'), INTERVAL '1 month') AS month;
+"""
+
+MESSAGE_PARTITIONS_COPY = """
+    WITH batch AS (
+        SELECT id, sender_id, message_text, direction, created_at, wamid, status, status_updated_at, status_error
+        FROM messages_unpartitioned WHERE id > %s ORDER BY id LIMIT %s
+    ),
+    claimed AS (INSERT INTO message_wamids (wamid, created_at) SELECT wamid, created_at FROM batch WHERE wamid IS NOT NULL ON CONFLICT (wamid) DO NOTHING),
+    copied AS (
+        INSERT INTO messages (id, sender_id, message_text, direction, created_at, wamid, status, status_updated_at, status_error)
+        SELECT * FROM batch RETURNING id
+    )
+    SELECT count(*), max(id) FROM copied;
+"""
+
+MESSAGE_PARTITIONS_FINISH = """
+    DROP TABLE messages_unpartitioned;
+    -- Indexes are built once after the copy; every partition created later inherits them.
+    CREATE INDEX messages_sender_created_idx ON messages (sender_id, created_at, id);
+    CREATE INDEX messages_created_idx ON messages (created_at DESC, id DESC);
+    CREATE INDEX messages_wamid_idx ON messages (wamid) WHERE wamid IS NOT NULL;
+    CREATE INDEX messages_text_search_idx ON messages USING GIN (to_tsvector('simple', COALESCE(message_text, '')));
+"""
+
+MIGRATIONS = [
+    ("001_messages_sender_created_idx", """
+        CREATE INDEX IF NOT EXISTS messages_sender_created_idx ON messages (sender_id, created_at, id);
+    """),
+    ("002_conversations_summary", """
+        CREATE TABLE IF NOT EXISTS conversations (
+            sender_id TEXT PRIMARY KEY,
+            last_message_at TIMESTAMPTZ NOT NULL,
+            last_message_text TEXT,
+            last_direction TEXT,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            message_count BIGINT NOT NULL DEFAULT 0
+        );
+        INSERT INTO conversations (sender_id, last_message_at, last_message_text, last_direction, message_count)
+        SELECT DISTINCT ON (sender_id) sender_id, created_at, left(message_text, 200), direction, count(*) OVER (PARTITION BY sender_id)
+        FROM messages ORDER BY sender_id, created_at DESC, id DESC
+        ON CONFLICT (sender_id) DO NOTHING;
+        CREATE INDEX IF NOT EXISTS conversations_recent_idx ON conversations (last_message_at DESC, sender_id DESC);
+    """),
+    ("003_messages_wamid_status", """
+        ALTER TABLE messages
+            ADD COLUMN IF NOT EXISTS wamid TEXT,
+            ADD COLUMN IF NOT EXISTS status TEXT,
+            ADD COLUMN IF NOT EXISTS status_updated_at TIMESTAMPTZ,
+            ADD COLUMN IF NOT EXISTS status_error TEXT;
+        CREATE INDEX IF NOT EXISTS messages_wamid_idx ON messages (wamid) WHERE wamid IS NOT NULL;
+    """),
+    ("004_messages_wamid_unique", """
+        DELETE FROM messages AS a USING messages AS b WHERE a.wamid = b.wamid AND a.id > b.id;
+        CREATE UNIQUE INDEX IF NOT EXISTS messages_wamid_key ON messages (wamid) WHERE wamid IS NOT NULL;
+        DROP INDEX IF EXISTS messages_wamid_idx;
+    """),
+    ("005_campaign_uploads", """
+        CREATE TABLE IF NOT EXISTS campaign_uploads (
+            id BIGSERIAL PRIMARY KEY,
+            filename TEXT,
+            status TEXT NOT NULL DEFAULT 'loading',
+            row_count INTEGER NOT NULL DEFAULT 0,
+            rejected_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS campaign_upload_rows (
+            upload_id BIGINT NOT NULL REFERENCES campaign_uploads (id) ON DELETE CASCADE,
+            row_number INTEGER NOT NULL,
+            phone TEXT NOT NULL,
+            name TEXT NOT NULL,
+            country_code TEXT,
+            order_status TEXT,
+            tracking_id TEXT,
+            product_name TEXT,
+            offer_code TEXT,
+            promo_link_id TEXT,
+            PRIMARY KEY (upload_id, row_number)
+        );
+    """),
+    ("006_campaign_jobs", """
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id BIGSERIAL PRIMARY KEY,
+            template_name TEXT NOT NULL,
+            image_url TEXT,
+            status TEXT NOT NULL DEFAULT 'running',
+            total_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        );
+        CREATE TABLE IF NOT EXISTS campaign_recipients (
+            id BIGSERIAL PRIMARY KEY,
+            campaign_id BIGINT NOT NULL REFERENCES campaigns (id) ON DELETE CASCADE,
+            recipient TEXT NOT NULL,
+            name TEXT NOT NULL,
+            variables JSONB NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            wamid TEXT,
+            last_error TEXT,
+            claimed_at TIMESTAMPTZ,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS campaign_recipients_pending_idx ON campaign_recipients (campaign_id, id) WHERE state = 'pending';
+        CREATE INDEX IF NOT EXISTS campaign_recipients_sending_idx ON campaign_recipients (claimed_at) WHERE state = 'sending';
+        CREATE INDEX IF NOT EXISTS campaign_recipients_state_idx ON campaign_recipients (campaign_id, state);
+    """),
+    ("007_campaign_shards_and_workers", """
+        ALTER TABLE campaign_recipients ADD COLUMN IF NOT EXISTS shard SMALLINT GENERATED ALWAYS AS (id % 16) STORED;
+        CREATE INDEX IF NOT EXISTS campaign_recipients_shard_pending_idx ON campaign_recipients (campaign_id, shard, id) WHERE state = 'pending';
+        DROP INDEX IF EXISTS campaign_recipients_pending_idx;
+        CREATE TABLE IF NOT EXISTS campaign_workers (
+            worker_id TEXT PRIMARY KEY,
+            hostname TEXT,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            heartbeat_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            sent_total BIGINT NOT NULL DEFAULT 0,
+            rate_limit REAL
+        );
+    """),
+    ("008_campaign_retries_dead_letters", """
+        ALTER TABLE campaign_recipients
+            ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMPTZ,
+            ADD COLUMN IF NOT EXISTS last_error_code INTEGER;
+        CREATE TABLE IF NOT EXISTS campaign_dead_letters (
+            id BIGSERIAL PRIMARY KEY,
+            campaign_id BIGINT NOT NULL REFERENCES campaigns (id) ON DELETE CASCADE,
+            recipient_id BIGINT NOT NULL REFERENCES campaign_recipients (id) ON DELETE CASCADE,
+            recipient TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            error TEXT,
+            error_code INTEGER,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            replayed_at TIMESTAMPTZ
+        );
+        CREATE INDEX IF NOT EXISTS campaign_dead_letters_open_idx ON campaign_dead_letters (campaign_id, id) WHERE replayed_at IS NULL;
+    """),
+    ("009_recipient_validation_opt_outs", r"""
+        CREATE TABLE IF NOT EXISTS phone_number_rules (
+            country_code TEXT PRIMARY KEY,
+            national_pattern TEXT NOT NULL
+        );
+        INSERT INTO phone_number_rules (country_code, national_pattern) VALUES
+            ('91', '^[6-9]\d{9}$'), ('1', '^[2-9]\d{9}$'), ('44', '^7\d{9}$'), ('971', '^5\d{8}$'), ('966', '^5\d{8}$'),
+            ('65', '^[89]\d{7}$'), ('60', '^1\d{8,9}$'), ('61', '^4\d{8}$'), ('94', '^7\d{8}$'), ('880', '^1\d{9}$'),
+            ('977', '^9\d{9}$'), ('92', '^3\d{9}$'), ('49', '^1\d{9,10}$'), ('33', '^[67]\d{8}$')
+        ON CONFLICT (country_code) DO NOTHING;
+        CREATE TABLE IF NOT EXISTS opt_outs (
+            phone TEXT PRIMARY KEY,
+            reason TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        ALTER TABLE campaigns ADD COLUMN IF NOT EXISTS skipped JSONB NOT NULL DEFAULT '{}';
+    """),
+    ("010_search_indexes", """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        -- 'simple' (no stemming, no stop words) because conversations mix languages; queries must use the same expression.
+        CREATE INDEX IF NOT EXISTS messages_text_search_idx ON messages USING GIN (to_tsvector('simple', COALESCE(message_text, '')));
+        CREATE INDEX IF NOT EXISTS messages_created_idx ON messages (created_at DESC, id DESC);
+        CREATE INDEX IF NOT EXISTS conversations_sender_trgm_idx ON conversations USING GIN (sender_id gin_trgm_ops);
+    """),
+    ("011_messages_monthly_partitions", MESSAGE_PARTITIONS_SETUP + MESSAGE_PARTITIONS_FINISH),
+    ("012_campaign_stats_hourly", """
+        -- Counters are funnel steps reached per UTC hour: 'delivered' includes messages that went straight to 'read'.
+        -- send_failed never reached the Graph API; delivery_failed was accepted (so is in sent) and then reported failed.
+        CREATE TABLE IF NOT EXISTS campaign_stats_hourly (
+            campaign_id BIGINT NOT NULL REFERENCES campaigns (id) ON DELETE CASCADE,
+            bucket TIMESTAMPTZ NOT NULL,
+            template_name TEXT NOT NULL,
+            sent INTEGER NOT NULL DEFAULT 0,
+            delivered INTEGER NOT NULL DEFAULT 0,
+            read INTEGER NOT NULL DEFAULT 0,
+            send_failed INTEGER NOT NULL DEFAULT 0,
+            delivery_failed INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (campaign_id, bucket)
+        );
+        CREATE INDEX IF NOT EXISTS campaign_stats_hourly_template_idx ON campaign_stats_hourly (template_name, bucket);
+        CREATE INDEX IF NOT EXISTS campaign_stats_hourly_bucket_idx ON campaign_stats_hourly (bucket);
+        -- Status callbacks find their campaign through the recipient's wamid.
+        CREATE INDEX IF NOT EXISTS campaign_recipients_wamid_idx ON campaign_recipients (wamid) WHERE wamid IS NOT NULL;
+        INSERT INTO campaign_stats_hourly (campaign_id, bucket, template_name, sent, delivered, read, send_failed, delivery_failed)
+        SELECT r.campaign_id, date_trunc('hour', r.updated_at, 'UTC'), c.template_name,
+               count(*) FILTER (WHERE r.state = 'sent'), count(*) FILTER (WHERE m.status IN ('delivered', 'read')),
+               count(*) FILTER (WHERE m.status = 'read'), count(*) FILTER (WHERE r.state = 'failed'),
+               count(*) FILTER (WHERE r.state = 'sent' AND m.status = 'failed')
+        FROM campaign_recipients AS r
+        JOIN campaigns AS c ON c.id = r.campaign_id
+        LEFT JOIN messages AS m ON m.wamid = r.wamid
+        WHERE r.state IN ('sent', 'failed')
+        GROUP BY 1, 2, 3;
+    """),
+    ("013_customers_and_segments", """
+        -- Keyed by the normalized E.164 digits; "C" collation so phone prefix filters can use the primary key.
+        CREATE TABLE IF NOT EXISTS customers (
+            phone TEXT COLLATE "C" PRIMARY KEY,
+            name TEXT NOT NULL,
+            country_code TEXT,
+            order_status TEXT,
+            tracking_id TEXT,
+            product_name TEXT,
+            offer_code TEXT,
+            promo_link_id TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS customers_country_code_idx ON customers (country_code);
+        CREATE INDEX IF NOT EXISTS customers_order_status_idx ON customers (order_status);
+        CREATE INDEX IF NOT EXISTS customers_product_name_idx ON customers (product_name);
+        CREATE INDEX IF NOT EXISTS customers_offer_code_idx ON customers (offer_code);
+        CREATE INDEX IF NOT EXISTS customers_promo_link_id_idx ON customers (promo_link_id);
+        CREATE INDEX IF NOT EXISTS customers_created_at_idx ON customers (created_at);
+        CREATE INDEX IF NOT EXISTS customers_updated_at_idx ON customers (updated_at);
+        CREATE TABLE IF NOT EXISTS customer_segments (
+            id BIGSERIAL PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            filter JSONB NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+    ("014_campaign_recipient_claim_owner", """
+        ALTER TABLE campaign_recipients ADD COLUMN IF NOT EXISTS claimed_by TEXT;
+        CREATE INDEX IF NOT EXISTS campaign_recipients_claimed_by_idx ON campaign_recipients (claimed_by) WHERE state = 'sending';
+    """),
+    ("015_message_status_pending", """
+        CREATE TABLE IF NOT EXISTS message_status_pending (
+            wamid TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL,
+            rank INTEGER NOT NULL,
+            error TEXT,
+            recipient_id TEXT,
+            parked_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+    ("016_campaign_background_preparation", """
+        -- Campaigns start as 'preparing' and get their recipients in chunks: prepare_step is the source being read
+        -- (0 posted customers, 1 upload, 2 segment) and prepare_cursor the last row_number or phone taken from it.
+        ALTER TABLE campaigns
+            ADD COLUMN IF NOT EXISTS customers_upload_id BIGINT REFERENCES campaign_uploads (id) ON DELETE SET NULL,
+            ADD COLUMN IF NOT EXISTS upload_id BIGINT REFERENCES campaign_uploads (id) ON DELETE SET NULL,
+            ADD COLUMN IF NOT EXISTS segment_id BIGINT REFERENCES customer_segments (id) ON DELETE SET NULL,
+            ADD COLUMN IF NOT EXISTS prepare_step SMALLINT NOT NULL DEFAULT 0,
+            ADD COLUMN IF NOT EXISTS prepare_cursor TEXT;
+        -- Later chunks skip numbers an earlier chunk or source already added.
+        CREATE INDEX IF NOT EXISTS campaign_recipients_campaign_recipient_idx ON campaign_recipients (campaign_id, recipient);
+    """),
+]
+
+# Migrations that rewrite a whole table: the check says whether there is data to rewrite, in which case startup stops and
+# the migration has to be applied by the named script with the app down.
+OFFLINE_MIGRATIONS = {
+    "011_messages_monthly_partitions": ("SELECT EXISTS (SELECT 1 FROM messages) OR to_regclass('messages_unpartitioned') IS NOT NULL;", "partition_messages.py"),
+}
+
+def run_migrations():
+    # One transaction under an advisory lock, so workers starting together apply each migration exactly once.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_ID,))
+        cur.execute("CREATE TABLE IF NOT EXISTS schema_migrations (name TEXT PRIMARY KEY, applied_at TIMESTAMPTZ NOT NULL DEFAULT now());")
+        cur.execute("SELECT name FROM schema_migrations;")
+        applied = {r[0] for r in cur.fetchall()}
+        for name, sql in MIGRATIONS:
+            if name in applied: continue
+            if name in OFFLINE_MIGRATIONS:
+                check, script = OFFLINE_MIGRATIONS[name]
+                cur.execute(check)
+                if cur.fetchone()[0]:
+                    conn.commit()  # keep the migrations before it
+                    raise RuntimeError(f"Migration {name} rewrites existing data; stop the app and run `python {script}` first.")
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (name) VALUES (%s);", (name,))
+            print(f"Applied migration {name}")
+        conn.commit()
+
+def partition_messages_offline(batch_size: int = MESSAGE_PARTITION_COPY_BATCH_SIZE):
+    # Migration 011 for a populated messages table. Each batch is its own transaction and the copy resumes after the
+    # highest id already in the new table, so an interrupted run can simply be started again.
+    name = "011_messages_monthly_partitions"
+    earlier = [n for n, _ in MIGRATIONS[:[n for n, _ in MIGRATIONS].index(name)]]
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_ID,))
+        cur.execute("SELECT name FROM schema_migrations;")
+        applied = {r[0] for r in cur.fetchall()}
+        if name in applied:
+            print(f"Migration {name} is already applied.")
+            return
+        if not applied.issuperset(earlier): raise RuntimeError("Start the app once so the earlier migrations are applied first.")
+        cur.execute("SELECT to_regclass('messages_unpartitioned') IS NULL;")
+        if cur.fetchone()[0]: cur.execute(MESSAGE_PARTITIONS_SETUP)
+        cur.execute("SELECT COALESCE(max(id), 0) FROM messages;")
+        after, copied = cur.fetchone()[0], 0
+        conn.commit()
+        while True:
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_ID,))
+            cur.execute(MESSAGE_PARTITIONS_COPY, (after, batch_size))
+            count, last = cur.fetchone()
+            conn.commit()
+            if not count: break
+            after, copied = last, copied + count
+            print(f"Copied {copied} messages (up to id {after})")
+        cur.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATIONS_LOCK_ID,))
+        cur.execute(MESSAGE_PARTITIONS_FINISH)
+        cur.execute("INSERT INTO schema_migrations (name) VALUES (%s);", (name,))
+        conn.commit()
+        print(f"Applied migration {name}")
+
+# ===================================================================
+# --- 5. WhatsApp Graph API Client ---
+# ===================================================================
+class GraphAPIClient:
+    def __init__(self, base_url: str, access_token: Optional[str], phone_number_id: Optional[str],
+                 timeout: float, connect_timeout: float, max_connections: int, http2: bool):
+        self.base_url, self.access_token, self.phone_number_id = base_url.rstrip('/'), access_token, phone_number_id
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections, keepalive_expiry=60)
+        self.http2 = http2
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def open(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url, http2=self.http2, timeout=self.timeout, limits=self.limits,
+                headers={"Authorization": f"Bearer {self.access_token}", "Content-Type": "application/json"},
+            )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def send_message(self, payload: dict):
+        if self._client is None: raise RuntimeError("Graph API client is not open.")
+        started, status = time.perf_counter(), "transport_error"
+        try:
+            response = await self._client.post(f"/{self.phone_number_id}/messages", json=payload)
+            status = str(response.status_code)
+        finally:
+            GRAPH_REQUEST_SECONDS.labels(payload.get("type", "unknown"), status).observe(time.perf_counter() - started)
+        response.raise_for_status()
+        return response.json()
+
+graph_client = GraphAPIClient(GRAPH_API_BASE_URL, ACCESS_TOKEN, PHONE_NUMBER_ID, GRAPH_API_TIMEOUT,
+                              GRAPH_API_CONNECT_TIMEOUT, GRAPH_API_MAX_CONNECTIONS, GRAPH_API_HTTP2)
+
+# ===================================================================
+# --- 6. HELPER FUNCTIONS (WhatsApp & DB) ---
 # ===================================================================
 def create_text_body(variables):
     if not variables: return None
@@ -88,173 +1262,1672 @@ def create_text_body(variables):
 def create_image_header(image_url):
     return {"type": "header", "parameters": [{"type": "image", "image": {"link": image_url}}]}
 
-def send_whatsapp_template(recipient_number, template_name, components=None):
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}", "Content-Type": "application/json"}
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    accepted = set()
+    for part in (accept_encoding or "").lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip().removeprefix("q=")
+        try:
+            if not q or float(q) > 0: accepted.add(name.strip())
+        except ValueError: pass
+    if brotli is not None and "br" in accepted: return "br"
+    return "gzip" if "gzip" in accepted else None
+
+def compress_chunks(chunks, encoding: Optional[str]):
+    if encoding is None:
+        yield from chunks
+        return
+    compressor = brotli.Compressor(quality=BROTLI_QUALITY) if encoding == "br" else zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    compress = compressor.process if encoding == "br" else compressor.compress
+    for chunk in chunks:
+        data = compress(chunk)
+        if data: yield data
+    yield compressor.finish() if encoding == "br" else compressor.flush()
+
+def json_response(request: Request, body: bytes, headers: Optional[dict] = None) -> Response:
+    # Pre-encoded bodies bypass response_model validation and the stdlib encoder; compression is negotiated per request.
+    headers = {**(headers or {}), "Vary": "Accept-Encoding"}
+    encoding = negotiate_encoding(request.headers.get("accept-encoding")) if len(body) >= COMPRESSION_MIN_SIZE else None
+    if encoding is not None:
+        body = b"".join(compress_chunks([body], encoding))
+        headers["Content-Encoding"] = encoding
+    return Response(body, media_type="application/json", headers=headers)
+
+def streaming_json_response(request: Request, chunks) -> StreamingResponse:
+    # The first chunk is produced before the headers go out, so a failure up to there is still a proper error response.
+    chunks = chain([next(chunks)], chunks)
+    encoding = negotiate_encoding(request.headers.get("accept-encoding"))
+    headers = {"Vary": "Accept-Encoding", **({"Content-Encoding": encoding} if encoding else {})}
+    return StreamingResponse(compress_chunks(chunks, encoding), media_type="application/json", headers=headers)
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match: return False
+    candidates = [c.strip().removeprefix('W/') for c in if_none_match.split(',')]
+    return '*' in candidates or etag in candidates
+
+async def send_whatsapp_template(recipient_number, template_name, components=None):
     template_data = {"name": template_name, "language": {"code": "en_US"}}
     if components:
         template_data["components"] = [c for c in components if c is not None]
     payload = {"messaging_product": "whatsapp", "to": recipient_number, "type": "template", "template": template_data}
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
-    response.raise_for_status()
-    return response.json()
+    return await graph_client.send_message(payload)
 
-def send_text_reply(recipient_number, message_text):
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {ACCESS_TOKEN}", "Content-Type": "application/json"}
+async def send_text_reply(recipient_number, message_text):
     payload = { "messaging_product": "whatsapp", "to": recipient_number, "type": "text", "text": {"body": message_text} }
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
-    response.raise_for_status()
-    return response.json()
+    return await graph_client.send_message(payload)
+
+def response_wamid(response: dict) -> Optional[str]:
+    messages = response.get("messages") or [{}]
+    return messages[0].get("id")
 
-def fetch_conversations_from_db():
-    conn = None
+def encode_cursor(created_at: datetime, key) -> str:
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{key}".encode()).decode()
+
+def decode_cursor(cursor: str, key_type=int):
     try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
-        cur = conn.cursor()
-        cur.execute("SELECT DISTINCT sender_id FROM messages ORDER BY sender_id;")
-        conversations = cur.fetchall()
-        return [convo[0] for convo in conversations]
-    finally:
-        if conn: conn.close()
+        created_at, key = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        return datetime.fromisoformat(created_at), key_type(key)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
 
-def fetch_messages_for_sender_from_db(sender_id: str):
-    conn = None
+def encode_search_cursor(rank: float, key: int) -> str:
+    return base64.urlsafe_b64encode(f"{rank!r}|{key}".encode()).decode()
+
+def decode_search_cursor(cursor: str):
     try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
+        rank, key = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        return float(rank), int(key)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+@timed_db
+def search_in_db(query: str, limit: int = 20, cursor: Optional[str] = None, sender_id: Optional[str] = None):
+    # Matches come off the GIN index, the newest SEARCH_CANDIDATE_LIMIT of them are ranked, and ts_headline (the expensive
+    # part) only runs on the page that is returned. Contacts match on partial phone numbers through the trigram index.
+    after_rank, after_id = decode_search_cursor(cursor) if cursor else (None, None)
+    digits = re.sub(r'\D', '', query)
+    with db_pool.connection() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT message_text, created_at, direction FROM messages WHERE sender_id = %s ORDER BY created_at ASC;", (sender_id,))
-        messages = cur.fetchall()
-        return [{"text": m[0], "timestamp": m[1].isoformat(), "direction": (m[2] or '').strip("'")} for m in messages]
-    finally:
-        if conn: conn.close()
+        contacts = []
+        if cursor is None and sender_id is None and len(digits) >= 3:
+            cur.execute(
+                "SELECT sender_id, last_message_at, last_message_text, last_direction, unread_count, message_count FROM conversations "
+                "WHERE sender_id LIKE %s ORDER BY last_message_at DESC LIMIT %s;", (f"%{digits}%", limit))
+            contacts = [conversation_from_row(r) for r in cur.fetchall()]
+        cur.execute(f"""
+            WITH query AS (SELECT websearch_to_tsquery('simple', %s) AS q),
+            candidates AS (
+                SELECT m.id, m.sender_id, m.message_text, m.created_at, m.direction,
+                       ts_rank_cd(to_tsvector('simple', COALESCE(m.message_text, '')), query.q) AS rank
+                FROM messages AS m, query
+                WHERE to_tsvector('simple', COALESCE(m.message_text, '')) @@ query.q AND (%s::text IS NULL OR m.sender_id = %s::text)
+                ORDER BY m.created_at DESC, m.id DESC LIMIT %s
+            ),
+            page AS (
+                SELECT * FROM candidates WHERE %s::real IS NULL OR (rank, id) < (%s::real, %s::bigint)
+                ORDER BY rank DESC, id DESC LIMIT %s
+            )
+            SELECT page.id, page.sender_id, page.created_at, page.direction, page.rank,
+                   ts_headline('simple', COALESCE(page.message_text, ''), query.q, %s)
+            FROM page, query ORDER BY page.rank DESC, page.id DESC;
+        """, (query, sender_id, sender_id, SEARCH_CANDIDATE_LIMIT, after_rank, after_rank, after_id, limit + 1, SEARCH_HEADLINE_OPTIONS))
+        rows = cur.fetchall()
+    messages = [{"id": r[0], "sender_id": r[1], "timestamp": r[2].isoformat(), "direction": (r[3] or '').strip("'"),
+                 "rank": r[4], "snippet": r[5]} for r in rows[:limit]]
+    next_cursor = encode_search_cursor(rows[limit - 1][4], rows[limit - 1][0]) if len(rows) > limit else None
+    return {"contacts": contacts, "messages": messages, "next_cursor": next_cursor}
+
+@timed_db
+def fetch_conversations_from_db(limit: int = 50, cursor: Optional[str] = None):
+    condition, params = "", ()
+    if cursor is not None:
+        condition, params = "WHERE (last_message_at, sender_id) < (%s, %s)", decode_cursor(cursor, str)
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT sender_id, last_message_at, last_message_text, last_direction, unread_count, message_count "
+            f"FROM conversations {condition} ORDER BY last_message_at DESC, sender_id DESC LIMIT %s;",
+            (*params, limit + 1))
+        rows = cur.fetchall()
+    conversations = [conversation_from_row(r) for r in rows[:limit]]
+    next_cursor = encode_cursor(rows[limit - 1][1], rows[limit - 1][0]) if len(rows) > limit else None
+    return {"conversations": conversations, "next_cursor": next_cursor}
+
+@timed_db
+def mark_conversation_read_in_db(sender_id: str):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE conversations SET unread_count = 0 WHERE sender_id = %s AND unread_count <> 0 "
+            "RETURNING sender_id, last_message_at, last_message_text, last_direction, unread_count, message_count;", (sender_id,))
+        events = [json.dumps({"conversation": conversation_from_row(r), "messages": []}) for r in cur.fetchall()]
+        publish_conversation_events(cur, events)
+        conn.commit()
+    if not DB_LISTEN_ENABLED:
+        for payload in events: event_hub.dispatch_threadsafe(payload)
+    return {"status": "success"}
+
+def stream_messages_for_sender_from_db(sender_id: str, limit: int = 50, before: Optional[str] = None,
+                                       after: Optional[str] = None, since: Optional[datetime] = None):
+    # Keyset paging on (created_at, id): newest page by default, older pages via `before`, newer rows via `after`/`since`.
+    # Yields a MessagePage as encoded JSON chunks, straight from a server-side cursor, always oldest first; the paging
+    # fields come last because they are only known once the rows have been read. Nothing is yielded before the first fetch.
+    forward = after is not None or since is not None
+    if after is not None:
+        condition, params = "AND (created_at, id) > (%s, %s)", decode_cursor(after)
+    elif since is not None:
+        condition, params = "AND created_at > %s", (since,)
+    elif before is not None:
+        condition, params = "AND (created_at, id) < (%s, %s)", decode_cursor(before)
+    else:
+        condition, params = "", ()
+    columns = "id, message_text, created_at, direction, status"
+    if forward:
+        sql = f"SELECT {columns}, 0 FROM messages WHERE sender_id = %s {condition} ORDER BY created_at, id LIMIT %s;"
+    else:
+        # Newest `limit + 1` rows, returned ascending; the window count says whether the first row is the look-ahead one.
+        sql = (f"SELECT {columns}, count(*) OVER () FROM (SELECT {columns} FROM messages WHERE sender_id = %s {condition} "
+               f"ORDER BY created_at DESC, id DESC LIMIT %s) AS page ORDER BY created_at, id;")
+    started = time.perf_counter()
+    first = last = None
+    emitted, has_more = 0, False
+    opening = b'{"messages":['
+    with history_pool.connection() as conn:
+        cur = conn.cursor(name=f"history_{uuid.uuid4().hex}")
+        cur.itersize = HISTORY_STREAM_CHUNK_SIZE
+        cur.execute(sql, (sender_id, *params, limit + 1))
+        rows = cur.fetchmany(HISTORY_STREAM_CHUNK_SIZE)
+        while rows:
+            if not forward and emitted == 0 and first is None and rows[0][5] > limit:
+                has_more, rows = True, rows[1:]
+            if forward and emitted + len(rows) > limit:
+                has_more, rows = True, rows[:limit - emitted]
+            if rows:
+                first = first or rows[0]
+                last = rows[-1]
+                body = orjson.dumps([{"id": m[0], "text": m[1], "timestamp": m[2], "direction": (m[3] or '').strip("'"), "status": m[4]} for m in rows])
+                yield opening + (b',' if emitted else b'') + body[1:-1]
+                opening, emitted = b'', emitted + len(rows)
+            rows = cur.fetchmany(HISTORY_STREAM_CHUNK_SIZE)
+        cur.close()
+    DB_QUERY_SECONDS.labels("stream_messages_for_sender_from_db").observe(time.perf_counter() - started)
+    yield opening + b'],' + orjson.dumps({
+        "has_more": has_more,
+        "before": encode_cursor(first[2], first[0]) if first else before,
+        "after": encode_cursor(last[2], last[0]) if last else after,
+    })[1:]
+
+def month_start(moment: datetime, offset: int = 0) -> date:
+    index = moment.year * 12 + moment.month - 1 + offset
+    return date(index // 12, index % 12 + 1, 1)
+
+@timed_db
+def ensure_message_partitions_in_db(months_ahead: int) -> List[str]:
+    # The current month and the next `months_ahead`, created ahead of time so inserts never wait on DDL.
+    now = datetime.now(timezone.utc)
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock(%s);", (MESSAGE_PARTITIONS_LOCK_ID,))
+        cur.execute("SELECT ensure_messages_partition(month) FROM unnest(%s::date[]) AS month;",
+                    ([month_start(now, i) for i in range(months_ahead + 1)],))
+        names = [r[0] for r in cur.fetchall()]
+        conn.commit()
+    return names
 
-def save_outgoing_message_to_db(sender_id, message_text):
-    conn = None
+def export_message_partition(conn, partition_name: str, path: str):
+    # Sorted by sender (byte order, to match Python's str ordering) so reads can stop as soon as they pass the sender.
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    row_count, partial = 0, f"{path}.partial"
+    cur = conn.cursor(name=f"archive_{uuid.uuid4().hex}")
+    cur.itersize = HISTORY_STREAM_CHUNK_SIZE
+    cur.execute(f'SELECT id, sender_id, message_text, direction, created_at, wamid, status, status_updated_at, status_error '
+                f'FROM "{partition_name}" ORDER BY sender_id COLLATE "C", created_at, id;')
+    columns = [c[0] for c in cur.description]
+    with gzip.open(partial, "wb", compresslevel=GZIP_LEVEL) as f:
+        while True:
+            rows = cur.fetchmany(HISTORY_STREAM_CHUNK_SIZE)
+            if not rows: break
+            f.write(b"".join(orjson.dumps(dict(zip(columns, r))) + b"\n" for r in rows))
+            row_count += len(rows)
+    cur.close()
+    digest = hashlib.sha256()
+    with open(partial, "rb") as f:
+        for block in iter(lambda: f.read(UPLOAD_READ_CHUNK_SIZE), b""): digest.update(block)
+    os.replace(partial, path)
+    return row_count, os.path.getsize(path), digest.hexdigest()
+
+@timed_db
+def archive_message_partitions_in_db(retention_months: int, archive_dir: str) -> List[dict]:
+    # Monthly partitions older than the retention window are detached, exported to NDJSON.gz and only then dropped.
+    # The archive row is written together with the DETACH, so an export interrupted by a crash is redone on the next run.
+    cutoff = month_start(datetime.now(timezone.utc), -retention_months)
+    archived = []
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_try_advisory_lock(%s);", (MESSAGE_ARCHIVE_LOCK_ID,))
+        locked = cur.fetchone()[0]
+        conn.commit()
+        if not locked: return archived
+        try:
+            cur.execute("SELECT c.relname FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid WHERE i.inhparent = 'messages'::regclass;")
+            for (name,) in sorted(cur.fetchall()):
+                match = MESSAGE_PARTITION_NAME.match(name)
+                if not match: continue
+                month = date(int(match[1]), int(match[2]), 1)
+                if month >= cutoff: continue
+                range_start = datetime(month.year, month.month, 1, tzinfo=timezone.utc)
+                range_end = datetime.combine(month_start(range_start, 1), datetime.min.time(), timezone.utc)
+                cur.execute(f'ALTER TABLE messages DETACH PARTITION "{name}";')
+                cur.execute("INSERT INTO message_archives (partition_name, range_start, range_end, path) VALUES (%s, %s, %s, %s);",
+                            (name, range_start, range_end, os.path.join(archive_dir, f"{name}.ndjson.gz")))
+            conn.commit()
+            cur.execute("SELECT partition_name, range_end, path FROM message_archives WHERE status = 'exporting' ORDER BY range_start;")
+            for name, range_end, path in cur.fetchall():
+                row_count, byte_count, sha256 = export_message_partition(conn, name, path)
+                cur.execute("UPDATE message_archives SET status = 'archived', row_count = %s, byte_count = %s, sha256 = %s, archived_at = now() "
+                            "WHERE partition_name = %s;", (row_count, byte_count, sha256, name))
+                cur.execute(f'DROP TABLE "{name}";')
+                cur.execute("DELETE FROM message_wamids WHERE created_at < %s;", (range_end,))
+                conn.commit()
+                archived.append({"partition_name": name, "path": path, "row_count": row_count, "byte_count": byte_count})
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(%s);", (MESSAGE_ARCHIVE_LOCK_ID,))
+            conn.commit()
+    return archived
+
+def read_archived_messages(path: str, sender_id: str):
     try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
+        with gzip.open(path, "rb") as f:
+            for line in f:
+                row = orjson.loads(line)
+                if row["sender_id"] < sender_id: continue
+                if row["sender_id"] > sender_id: return
+                row["created_at"] = datetime.fromisoformat(row["created_at"])
+                yield row
+    except FileNotFoundError:
+        raise HTTPException(status_code=503, detail=f"Message archive {os.path.basename(path)} is not available on this server.")
+
+@timed_db
+def fetch_archived_messages_from_db(sender_id: str, limit: int = 50, before: Optional[str] = None):
+    # Same page shape as the live history, read newest archive first until the page is full. Archives are cold storage:
+    # each file is decompressed up to the sender's rows, which is fine for an explicit "load archived history".
+    bound = decode_cursor(before) if before is not None else None
+    with db_pool.connection() as conn:
         cur = conn.cursor()
-        cur.execute("INSERT INTO messages (sender_id, message_text, direction) VALUES (%s, %s, 'outgoing');", (sender_id, message_text))
+        cur.execute("SELECT path FROM message_archives WHERE status = 'archived' AND (%s::timestamptz IS NULL OR range_start <= %s) "
+                    "ORDER BY range_start DESC;", (bound and bound[0], bound and bound[0]))
+        paths = [r[0] for r in cur.fetchall()]
+    page = []
+    for path in paths:
+        rows = [r for r in read_archived_messages(path, sender_id) if bound is None or (r["created_at"], r["id"]) < bound]
+        page = rows[len(page) - limit - 1:] + page if rows else page
+        if len(page) > limit: break
+    has_more, page = len(page) > limit, page[-limit:]
+    messages = [{"id": r["id"], "text": r["message_text"], "timestamp": r["created_at"].isoformat(),
+                 "direction": (r["direction"] or '').strip("'"), "status": r["status"]} for r in page]
+    return {"messages": messages, "has_more": has_more,
+            "before": encode_cursor(page[0]["created_at"], page[0]["id"]) if page else before,
+            "after": encode_cursor(page[-1]["created_at"], page[-1]["id"]) if page else None}
+
+@timed_db
+def apply_pending_statuses_in_db(max_age: float) -> int:
+    # Backstop for the writer's own pick-up: a status parked while its row was being inserted by another process's
+    # still-open transaction is applied here once the row is visible. Statuses for messages never stored eventually expire.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM message_status_pending WHERE parked_at < now() - make_interval(secs => %s);", (max_age,))
+        cur.execute("""
+            DELETE FROM message_status_pending AS p USING message_wamids AS w WHERE p.wamid = w.wamid
+            RETURNING p.wamid, p.status, p.updated_at, p.recipient_id, p.error;
+        """)
+        pending = [StatusUpdate(*r) for r in cur.fetchall()]
+        if pending: apply_status_updates(cur, pending)
         conn.commit()
-    finally:
-        if conn: conn.close()
+        return len(pending)
+
+async def sweep_pending_statuses():
+    while True:
+        await asyncio.sleep(PENDING_STATUS_SWEEP_INTERVAL)
+        try: await asyncio.to_thread(apply_pending_statuses_in_db, PENDING_STATUS_TTL)
+        except Exception as e: print(f"Pending status sweep error: {e}")
+
+async def maintain_message_partitions():
+    while True:
+        try:
+            await asyncio.to_thread(ensure_message_partitions_in_db, MESSAGE_PARTITION_PREMAKE_MONTHS)
+            if MESSAGE_RETENTION_MONTHS > 0:
+                for archive in await asyncio.to_thread(archive_message_partitions_in_db, MESSAGE_RETENTION_MONTHS, MESSAGE_ARCHIVE_DIR):
+                    print(f"Archived {archive['partition_name']}: {archive['row_count']} messages to {archive['path']}")
+        except Exception as e:
+            print(f"Message partition maintenance error: {e}")
+        await asyncio.sleep(MESSAGE_MAINTENANCE_INTERVAL)
+
+def save_outgoing_message_to_db(sender_id, message_text, wamid=None):
+    message_writer.put(MessageRow(sender_id, strip_nul(message_text), 'outgoing', datetime.now(timezone.utc), wamid), urgent=True)
         
-def save_incoming_message_to_db(sender_id, message_text):
-    conn = None
-    try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
+def save_incoming_message_to_db(sender_id, message_text, wamid=None):
+    message_writer.put(MessageRow(sender_id, strip_nul(message_text), 'incoming', datetime.now(timezone.utc), wamid), urgent=True)
+
+@timed_db
+def create_campaign_upload_in_db(filename: Optional[str]) -> int:
+    with db_pool.connection() as conn:
         cur = conn.cursor()
-        cur.execute("INSERT INTO messages (sender_id, message_text, direction) VALUES (%s, %s, 'incoming');", (sender_id, message_text))
+        cur.execute("INSERT INTO campaign_uploads (filename) VALUES (%s) RETURNING id;", (filename,))
+        upload_id = cur.fetchone()[0]
         conn.commit()
-    finally:
-        if conn: conn.close()
+        return upload_id
 
-def fetch_template_body_from_db(template_name: str):
-    conn = None
-    try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
+@timed_db
+def copy_upload_rows_to_db(upload_id: int, rows: List[tuple]):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows: writer.writerow((upload_id, *row))
+    buffer.seek(0)
+    with db_pool.connection() as conn:
         cur = conn.cursor()
-        cur.execute("SELECT template_body FROM templates WHERE template_name = %s;", (template_name,))
-        result = cur.fetchone()
-        return result[0] if result else None
-    finally:
-        if conn: conn.close()
+        cur.copy_expert(f"COPY campaign_upload_rows (upload_id, row_number, {', '.join(CUSTOMER_FIELDS)}) FROM STDIN WITH (FORMAT csv);", buffer)
+        conn.commit()
+
+@timed_db
+def finish_campaign_upload_in_db(upload_id: int, row_count: int, rejected_count: int, status: str):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("UPDATE campaign_uploads SET status = %s, row_count = %s, rejected_count = %s WHERE id = %s;", (status, row_count, rejected_count, upload_id))
+        conn.commit()
+
+@timed_db
+def fetch_campaign_upload_from_db(upload_id: int):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, filename, status, row_count, rejected_count FROM campaign_uploads WHERE id = %s;", (upload_id,))
+        r = cur.fetchone()
+        return {"upload_id": r[0], "filename": r[1], "status": r[2], "row_count": r[3], "rejected_count": r[4]} if r else None
+
+CAMPAIGN_COLUMNS = "id, template_name, image_url, status, total_count, created_at, updated_at, finished_at, skipped"
+
+def campaign_from_row(r) -> dict:
+    return {"campaign_id": r[0], "template_name": r[1], "image_url": r[2], "status": r[3], "total_count": r[4],
+            "created_at": r[5].isoformat(), "updated_at": r[6].isoformat(), "finished_at": r[7].isoformat() if r[7] else None, "skipped": r[8]}
+
+def create_campaign_candidates(cur):
+    cur.execute(f"""
+        CREATE TEMP TABLE campaign_candidates (ord BIGSERIAL, {', '.join(f'{f} TEXT' for f in CUSTOMER_FIELDS)},
+            country TEXT, national TEXT, number TEXT, reject TEXT) ON COMMIT DROP;
+    """)
+
+def load_campaign_candidates(cur, customers: List[Customer], upload_id: Optional[int]):
+    fields = ', '.join(CUSTOMER_FIELDS)
+    if customers:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for customer in customers: writer.writerow([getattr(customer, f) for f in CUSTOMER_FIELDS])
+        buffer.seek(0)
+        cur.copy_expert(f"COPY campaign_candidates ({fields}) FROM STDIN WITH (FORMAT csv);", buffer)
+    if upload_id is not None:
+        cur.execute(f"INSERT INTO campaign_candidates ({fields}) SELECT {fields} FROM campaign_upload_rows WHERE upload_id = %s ORDER BY row_number;",
+                    (upload_id,))
+    cur.execute("ANALYZE campaign_candidates;")
+
+def normalize_campaign_candidates(cur):
+    # Set-based pre-pass over campaign_candidates: normalize to E.164 digits, then reject invalid numbers, opted-out contacts
+    # and duplicates (first occurrence wins).
+    cur.execute(r"""
+        UPDATE campaign_candidates SET
+            country = CASE WHEN btrim(phone) ~ '^(\+|00)' THEN NULL ELSE NULLIF(regexp_replace(COALESCE(country_code, ''), '\D', '', 'g'), '') END,
+            national = CASE WHEN btrim(phone) ~ '^(\+|00)' THEN regexp_replace(regexp_replace(btrim(phone), '^00', ''), '\D', '', 'g')
+                            ELSE ltrim(regexp_replace(phone, '\D', '', 'g'), '0') END;
+        -- Full international numbers (or long numbers without a country code): split off the longest known country prefix.
+        UPDATE campaign_candidates AS c SET country = m.country_code, national = substr(c.national, length(m.country_code) + 1)
+        FROM (
+            SELECT c2.ord, (SELECT r.country_code FROM phone_number_rules AS r WHERE c2.national LIKE r.country_code || '%'
+                            ORDER BY length(r.country_code) DESC LIMIT 1) AS country_code
+            FROM campaign_candidates AS c2 WHERE c2.country IS NULL AND (btrim(c2.phone) ~ '^(\+|00)' OR length(c2.national) > 10)
+        ) AS m
+        WHERE c.ord = m.ord AND m.country_code IS NOT NULL;
+    """)
+    # Local numbers still without a country get DEFAULT_COUNTRY_CODE, or are rejected below.
+    if DEFAULT_COUNTRY_CODE: cur.execute(r"UPDATE campaign_candidates SET country = %s WHERE country IS NULL AND btrim(phone) !~ '^(\+|00)';", (DEFAULT_COUNTRY_CODE,))
+    cur.execute(r"""
+        -- Numbers typed with the country code repeated inside the phone column.
+        UPDATE campaign_candidates AS c SET national = substr(c.national, length(c.country) + 1)
+        FROM phone_number_rules AS r
+        WHERE r.country_code = c.country AND c.national !~ r.national_pattern AND c.national LIKE c.country || '%'
+          AND substr(c.national, length(c.country) + 1) ~ r.national_pattern;
+        UPDATE campaign_candidates SET number = COALESCE(country, '') || national;
+        UPDATE campaign_candidates AS c SET reject = CASE
+            WHEN btrim(c.name) = '' OR c.national = '' THEN 'missing'
+            WHEN c.country IS NULL AND btrim(c.phone) !~ '^(\+|00)' THEN 'invalid'
+            WHEN length(c.number) NOT BETWEEN 8 AND 15 THEN 'invalid'
+            WHEN EXISTS (SELECT 1 FROM phone_number_rules AS r WHERE r.country_code = c.country AND c.national !~ r.national_pattern) THEN 'invalid'
+            WHEN EXISTS (SELECT 1 FROM opt_outs AS o WHERE o.phone = c.number) THEN 'opted_out'
+        END;
+        UPDATE campaign_candidates AS c SET reject = 'duplicate'
+        FROM (SELECT ord, row_number() OVER (PARTITION BY number ORDER BY ord) AS n FROM campaign_candidates WHERE reject IS NULL) AS d
+        WHERE c.ord = d.ord AND d.n > 1;
+    """)
+
+def normalize_phones(cur, phones: List[str]) -> List[Optional[str]]:
+    # Bare numbers through the same pre-pass as campaign recipients, so opt-outs and lookups use the form campaigns store;
+    # None where no digits are left.
+    create_campaign_candidates(cur)
+    cur.execute("INSERT INTO campaign_candidates (phone, name) SELECT p, '' FROM unnest(%s::text[]) WITH ORDINALITY AS u (p, n) ORDER BY n;", (phones,))
+    normalize_campaign_candidates(cur)
+    cur.execute("SELECT CASE WHEN national <> '' THEN number END FROM campaign_candidates ORDER BY ord;")
+    return [r[0] for r in cur.fetchall()]
+
+def load_upload_candidates(cur, upload_id: int, after: int, limit: int) -> Optional[int]:
+    # The next `limit` upload rows after row `after`; returns the last row_number loaded, or None when the upload is done.
+    fields = ', '.join(CUSTOMER_FIELDS)
+    cur.execute(f"INSERT INTO campaign_candidates (ord, {fields}) SELECT row_number, {fields} FROM campaign_upload_rows "
+                f"WHERE upload_id = %s AND row_number > %s ORDER BY row_number LIMIT %s RETURNING ord;", (upload_id, after, limit))
+    loaded = [r[0] for r in cur.fetchall()]
+    if not loaded: return None
+    cur.execute("ANALYZE campaign_candidates;")
+    return max(loaded)
+
+def prepare_campaign_recipients(cur, campaign_id: int) -> dict:
+    # Inserts the candidates that survive the pre-pass and are not recipients yet (from an earlier chunk or source);
+    # returns the skipped counts per reason.
+    normalize_campaign_candidates(cur)
+    cur.execute("""
+        UPDATE campaign_candidates AS c SET reject = 'duplicate'
+        WHERE reject IS NULL AND EXISTS (SELECT 1 FROM campaign_recipients AS r WHERE r.campaign_id = %s AND r.recipient = c.number);
+    """, (campaign_id,))
+    cur.execute(f"""
+        INSERT INTO campaign_recipients (campaign_id, recipient, name, variables)
+        SELECT %s, number, name, jsonb_build_object({', '.join(f"'{f}', {f}" for f in CUSTOMER_FIELDS)})
+        FROM campaign_candidates WHERE reject IS NULL ORDER BY ord;
+    """, (campaign_id,))
+    cur.execute("SELECT reject, count(*) FROM campaign_candidates WHERE reject IS NOT NULL GROUP BY reject;")
+    return dict(cur.fetchall())
+
+@timed_db
+def create_campaign_in_db(campaign_data: CampaignRequest) -> dict:
+    # Only records the campaign and its sources; the runner fills campaign_recipients in chunks while it is 'preparing'.
+    # Posted customers are staged as an upload so preparation can resume from the database after a restart.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        if campaign_data.segment_id is not None:
+            cur.execute("SELECT 1 FROM customer_segments WHERE id = %s;", (campaign_data.segment_id,))
+            if cur.fetchone() is None: raise HTTPException(status_code=404, detail="Segment not found.")
+        customers_upload_id = None
+        if campaign_data.customers:
+            cur.execute("INSERT INTO campaign_uploads (filename, status, row_count) VALUES ('start-campaign', 'ready', %s) RETURNING id;",
+                        (len(campaign_data.customers),))
+            customers_upload_id = cur.fetchone()[0]
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            for i, customer in enumerate(campaign_data.customers, 1): writer.writerow([customers_upload_id, i, *(getattr(customer, f) for f in CUSTOMER_FIELDS)])
+            buffer.seek(0)
+            cur.copy_expert(f"COPY campaign_upload_rows (upload_id, row_number, {', '.join(CUSTOMER_FIELDS)}) FROM STDIN WITH (FORMAT csv);", buffer)
+        cur.execute(f"""
+            INSERT INTO campaigns (template_name, image_url, status, customers_upload_id, upload_id, segment_id)
+            VALUES (%s, %s, 'preparing', %s, %s, %s) RETURNING {CAMPAIGN_COLUMNS};
+        """, (campaign_data.template_name, campaign_data.image_url, customers_upload_id, campaign_data.upload_id, campaign_data.segment_id))
+        campaign = campaign_from_row(cur.fetchone())
+        notify_campaign_changed(cur, campaign["campaign_id"])
+        conn.commit()
+        return campaign
+
+@timed_db
+def prepare_campaign_chunk_in_db(campaign_id: int, limit: int) -> bool:
+    # One step of preparation per transaction, under the campaign's row lock so workers sharing a campaign take turns:
+    # a chunk of the current source, moving on to the next source, or (all done) switching the campaign to 'running'.
+    # Returns True once the campaign is no longer 'preparing'.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT status, customers_upload_id, upload_id, segment_id, prepare_step, prepare_cursor, skipped FROM campaigns WHERE id = %s FOR UPDATE;",
+                    (campaign_id,))
+        r = cur.fetchone()
+        if r is None or r[0] != 'preparing': return True
+        sources, step, cursor, skipped = r[1:4], r[4], r[5], dict(r[6])
+        if step < len(sources) and sources[step] is not None:
+            if step < 2:
+                create_campaign_candidates(cur)
+                last = load_upload_candidates(cur, sources[step], int(cursor or 0), limit)
+                chunk = prepare_campaign_recipients(cur, campaign_id) if last is not None else {}
+            else:
+                chunk, last = add_segment_recipients(cur, campaign_id, sources[step], cursor or '', limit)
+            for reason, count in chunk.items(): skipped[reason] = skipped.get(reason, 0) + count
+            if last is not None: cursor = str(last)
+            else: step, cursor = step + 1, None
+        elif step < len(sources):
+            step, cursor = step + 1, None
+        else:
+            cur.execute("""
+                UPDATE campaigns SET status = 'running', prepare_cursor = NULL, updated_at = now(),
+                    total_count = (SELECT count(*) FROM campaign_recipients WHERE campaign_id = %s)
+                WHERE id = %s;
+            """, (campaign_id, campaign_id))
+            notify_campaign_changed(cur, campaign_id)
+            conn.commit()
+            return True
+        cur.execute("UPDATE campaigns SET prepare_step = %s, prepare_cursor = %s, skipped = %s, updated_at = now() WHERE id = %s;",
+                    (step, cursor, json.dumps(skipped), campaign_id))
+        conn.commit()
+        return False
+
+@timed_db
+def add_opt_outs_to_db(phones: List[str], reason: Optional[str]) -> int:
+    # Stored in the same E.164 digit form the recipient pre-pass produces.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        numbers = sorted({n for n in normalize_phones(cur, phones) if n})
+        cur.execute("INSERT INTO opt_outs (phone, reason) SELECT p, %s FROM unnest(%s::text[]) AS p ON CONFLICT (phone) DO NOTHING;", (reason, numbers))
+        added = cur.rowcount
+        conn.commit()
+        return added
+
+def segment_value(kind: str, value):
+    if kind == "time":
+        try: return datetime.fromisoformat(str(value))
+        except ValueError: raise HTTPException(status_code=400, detail=f"Invalid timestamp '{value}' in segment filter.")
+    if not isinstance(value, (str, int, float)): raise HTTPException(status_code=400, detail="Segment filter values must be scalars.")
+    return str(value)
+
+def compile_segment_filter(node, depth: int = 0):
+    # Whitelisted JSON filter -> parameterized WHERE clause. Nodes are {"all": [...]}, {"any": [...]}, {"not": node} or
+    # {"field": ..., "op": ..., "value": ...}; only indexed fields are accepted, so every segment runs as an index scan.
+    if not isinstance(node, dict) or depth > SEGMENT_MAX_DEPTH: raise HTTPException(status_code=400, detail="Invalid segment filter.")
+    for key, joiner in (("all", " AND "), ("any", " OR ")):
+        if key in node:
+            children = node[key]
+            if not isinstance(children, list) or not children: raise HTTPException(status_code=400, detail=f"'{key}' needs a non-empty list.")
+            parts = [compile_segment_filter(child, depth + 1) for child in children]
+            return f"({joiner.join(sql for sql, _ in parts)})", [param for _, params in parts for param in params]
+    if "not" in node:
+        sql, params = compile_segment_filter(node["not"], depth + 1)
+        return f"(NOT {sql})", params
+    field, op, value = node.get("field"), node.get("op", "eq"), node.get("value")
+    kind = SEGMENT_FIELDS.get(field)
+    if kind is None: raise HTTPException(status_code=400, detail=f"Unknown segment field '{field}'.")
+    normalize = (lambda v: re.sub(r'\D', '', segment_value(kind, v))) if field == "phone" else partial(segment_value, kind)
+    if op == "is_null": return f"{field} IS NULL", []
+    if op == "not_null": return f"{field} IS NOT NULL", []
+    if op in ("in", "not_in"):
+        if not isinstance(value, list) or not value: raise HTTPException(status_code=400, detail=f"'{op}' needs a non-empty list.")
+        return (f"{field} = ANY(%s)" if op == "in" else f"NOT ({field} = ANY(%s))"), [[normalize(v) for v in value]]
+    if op == "prefix" and field == "phone": return "phone LIKE %s", [normalize(value) + '%']
+    if op in SEGMENT_COMPARISONS and (kind == "time" or op in ("eq", "ne")):
+        return f"{field} {SEGMENT_COMPARISONS[op]} %s", [normalize(value)]
+    raise HTTPException(status_code=400, detail=f"Operator '{op}' is not supported for '{field}'.")
 
+def add_segment_recipients(cur, campaign_id: int, segment_id: int, after: str, limit: int):
+    # Customers are already normalized and unique, so a segment chunk is a single INSERT ... SELECT walking the primary key
+    # after `after`; of the pre-pass only the opt-out check remains, plus skipping numbers the campaign already has.
+    # Returns the skipped counts and the last phone taken, or None when the segment is done.
+    cur.execute("SELECT filter FROM customer_segments WHERE id = %s;", (segment_id,))
+    row = cur.fetchone()
+    if row is None: return {}, None
+    condition, params = compile_segment_filter(row[0])
+    variables = ', '.join(f"'{f}', c.{f}" for f in CUSTOMER_FIELDS)
+    cur.execute(f"""
+        WITH audience AS (
+            SELECT c.*, EXISTS (SELECT 1 FROM opt_outs AS o WHERE o.phone = c.phone) AS opted_out,
+                   EXISTS (SELECT 1 FROM campaign_recipients AS r WHERE r.campaign_id = %s AND r.recipient = c.phone) AS duplicate
+            FROM customers AS c WHERE ({condition}) AND c.phone > %s ORDER BY c.phone LIMIT %s
+        ),
+        inserted AS (
+            INSERT INTO campaign_recipients (campaign_id, recipient, name, variables)
+            SELECT %s, c.phone, c.name, jsonb_build_object({variables}) FROM audience AS c
+            WHERE NOT c.opted_out AND NOT c.duplicate ORDER BY c.phone
+        )
+        SELECT count(*) FILTER (WHERE opted_out), count(*) FILTER (WHERE duplicate AND NOT opted_out), max(phone) FROM audience;
+    """, (campaign_id, *params, after, limit, campaign_id))
+    opted_out, duplicate, last = cur.fetchone()
+    return {reason: count for reason, count in (("opted_out", opted_out), ("duplicate", duplicate)) if count}, last
+
+@timed_db
+def upsert_customers_in_db(request: CustomerImportRequest) -> dict:
+    # Same normalization as campaign recipients; opted-out contacts are still stored (the opt-out applies at send time).
+    # Within one import the last row for a number wins, and rows that would not change anything are not rewritten.
+    updates = ', '.join(f"{f} = COALESCE(EXCLUDED.{f}, customers.{f})" for f in CUSTOMER_FIELDS if f != "phone")
+    changed = ', '.join(f"customers.{f}" for f in CUSTOMER_FIELDS if f != "phone")
+    incoming = ', '.join(f"COALESCE(EXCLUDED.{f}, customers.{f})" for f in CUSTOMER_FIELDS if f != "phone")
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        create_campaign_candidates(cur)
+        load_campaign_candidates(cur, request.customers, request.upload_id)
+        normalize_campaign_candidates(cur)
+        cur.execute(f"""
+            INSERT INTO customers ({', '.join(CUSTOMER_FIELDS)})
+            SELECT DISTINCT ON (number) number, name, country, {', '.join(f for f in CUSTOMER_FIELDS if f not in ('phone', 'name', 'country_code'))}
+            FROM campaign_candidates WHERE reject IS NULL OR reject IN ('opted_out', 'duplicate')
+            ORDER BY number, ord DESC
+            ON CONFLICT (phone) DO UPDATE SET {updates}, updated_at = now()
+            WHERE ({changed}) IS DISTINCT FROM ({incoming});
+        """)
+        upserted = cur.rowcount
+        cur.execute("SELECT reject, count(*) FROM campaign_candidates WHERE reject IN ('missing', 'invalid') GROUP BY reject;")
+        skipped = dict(cur.fetchall())
+        conn.commit()
+    return {"upserted": upserted, "skipped": skipped}
+
+@timed_db
+def fetch_customer_from_db(phone: str):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        number = normalize_phones(cur, [phone])[0]
+        if number is None: return None
+        cur.execute(f"SELECT {', '.join(CUSTOMER_FIELDS)}, created_at, updated_at FROM customers WHERE phone = %s;", (number,))
+        r = cur.fetchone()
+    if r is None: return None
+    return {**dict(zip(CUSTOMER_FIELDS, r)), "created_at": r[-2].isoformat(), "updated_at": r[-1].isoformat()}
+
+def segment_from_row(r) -> dict:
+    return {"segment_id": r[0], "name": r[1], "filter": r[2], "created_at": r[3].isoformat()}
+
+@timed_db
+def create_segment_in_db(segment: SegmentCreate) -> dict:
+    compile_segment_filter(segment.filter)
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("INSERT INTO customer_segments (name, filter) VALUES (%s, %s) ON CONFLICT (name) DO NOTHING RETURNING id, name, filter, created_at;",
+                    (segment.name, json.dumps(segment.filter)))
+        r = cur.fetchone()
+        if r is None: raise HTTPException(status_code=409, detail=f"Segment '{segment.name}' already exists.")
+        conn.commit()
+        return segment_from_row(r)
+
+@timed_db
+def fetch_segments_from_db():
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, name, filter, created_at FROM customer_segments ORDER BY name;")
+        return [segment_from_row(r) for r in cur.fetchall()]
+
+@timed_db
+def fetch_segment_from_db(segment_id: int, sample_size: int = 20):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, name, filter, created_at FROM customer_segments WHERE id = %s;", (segment_id,))
+        r = cur.fetchone()
+        if r is None: return None
+        segment = segment_from_row(r)
+        condition, params = compile_segment_filter(segment["filter"])
+        cur.execute(f"SELECT count(*) FROM customers WHERE {condition};", params)
+        segment["customer_count"] = cur.fetchone()[0]
+        cur.execute(f"SELECT phone, name FROM customers WHERE {condition} ORDER BY phone LIMIT %s;", (*params, sample_size))
+        segment["sample"] = [{"phone": p, "name": n} for p, n in cur.fetchall()]
+        return segment
+
+@timed_db
+def delete_segment_from_db(segment_id: int) -> bool:
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM customer_segments WHERE id = %s;", (segment_id,))
+        deleted = cur.rowcount > 0
+        conn.commit()
+        return deleted
+
+@timed_db
+def remove_opt_out_from_db(phone: str) -> bool:
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        # Rows added before opt-outs shared the recipient normalizer may still be in plain digit form.
+        number = normalize_phones(cur, [phone])[0]
+        cur.execute(r"DELETE FROM opt_outs WHERE phone IN (%s, regexp_replace(%s, '\D', '', 'g'));", (number, phone))
+        removed = cur.rowcount > 0
+        conn.commit()
+        return removed
+
+@timed_db
+def fetch_campaign_from_db(campaign_id: int):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT {CAMPAIGN_COLUMNS} FROM campaigns WHERE id = %s;", (campaign_id,))
+        r = cur.fetchone()
+        if r is None: return None
+        campaign = campaign_from_row(r)
+        cur.execute("SELECT state, count(*) FROM campaign_recipients WHERE campaign_id = %s GROUP BY state;", (campaign_id,))
+        campaign["recipients"] = {"pending": 0, "sending": 0, "sent": 0, "failed": 0, **dict(cur.fetchall())}
+        return campaign
+
+def campaign_stats_from_row(r) -> dict:
+    # Delivery and read rates are relative to accepted sends; the failure rate to every attempted send, each of which either
+    # failed to send or was accepted (and may then have failed delivery).
+    sent, delivered, read, send_failed, delivery_failed = (int(v or 0) for v in r)
+    attempted, failed = sent + send_failed, send_failed + delivery_failed
+    return {"sent": sent, "delivered": delivered, "read": read, "failed": failed, "send_failed": send_failed, "delivery_failed": delivery_failed,
+            "delivered_rate": round(delivered / sent, 4) if sent else None, "read_rate": round(read / sent, 4) if sent else None,
+            "failed_rate": round(failed / attempted, 4) if attempted else None}
+
+@timed_db
+def fetch_campaign_stats_from_db(campaign_id: int, granularity: str = "hour"):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT template_name, status, total_count FROM campaigns WHERE id = %s;", (campaign_id,))
+        campaign = cur.fetchone()
+        if campaign is None: return None
+        cur.execute(
+            "SELECT date_trunc(%s, bucket, 'UTC') AS period, sum(sent), sum(delivered), sum(read), sum(send_failed), sum(delivery_failed) "
+            "FROM campaign_stats_hourly WHERE campaign_id = %s GROUP BY period ORDER BY period;", (granularity, campaign_id))
+        rows = cur.fetchall()
+    totals = [sum(r[i] for r in rows) for i in range(1, 6)]
+    return {"campaign_id": campaign_id, "template_name": campaign[0], "status": campaign[1], "total_count": campaign[2],
+            "totals": campaign_stats_from_row(totals), "buckets": [{"bucket": r[0].isoformat(), **campaign_stats_from_row(r[1:])} for r in rows]}
+
+@timed_db
+def fetch_template_stats_from_db(since: datetime, template_name: Optional[str] = None):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT template_name, count(DISTINCT campaign_id), sum(sent), sum(delivered), sum(read), sum(send_failed), sum(delivery_failed) FROM campaign_stats_hourly "
+            "WHERE bucket >= %s AND (%s::text IS NULL OR template_name = %s::text) GROUP BY template_name ORDER BY sum(sent) DESC;",
+            (since, template_name, template_name))
+        return [{"template_name": r[0], "campaigns": r[1], **campaign_stats_from_row(r[2:])} for r in cur.fetchall()]
+
+@timed_db
+def fetch_campaigns_from_db(limit: int):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"SELECT {CAMPAIGN_COLUMNS} FROM campaigns ORDER BY id DESC LIMIT %s;", (limit,))
+        return [campaign_from_row(r) for r in cur.fetchall()]
+
+@timed_db
+def set_campaign_status_in_db(campaign_id: int, status: str, allowed_from: tuple):
+    # Returns the new row, or None if the campaign is missing or not in one of the allowed states.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            UPDATE campaigns SET status = %s, updated_at = now(), finished_at = CASE WHEN %s IN ('cancelled', 'completed') THEN now() END
+            WHERE id = %s AND status = ANY(%s) RETURNING {CAMPAIGN_COLUMNS};
+        """, (status, status, campaign_id, list(allowed_from)))
+        r = cur.fetchone()
+        if r and status == 'running': notify_campaign_changed(cur, campaign_id)
+        conn.commit()
+        return campaign_from_row(r) if r else None
+
+def notify_campaign_changed(cur, campaign_id: int):
+    if DB_LISTEN_ENABLED: cur.execute("SELECT pg_notify(%s, %s);", (CAMPAIGNS_CHANNEL, str(campaign_id)))
+
+@timed_db
+def claim_campaign_recipients_in_db(campaign_id: int, shard: int, limit: int, worker_id: str) -> List[CampaignRecipient]:
+    # SKIP LOCKED lets any number of senders claim disjoint batches; the campaign must still be running at claim time.
+    # Workers start on different shards, so they rarely even contend for the same index range.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE campaign_recipients SET state = 'sending', claimed_at = now(), claimed_by = %s, attempts = attempts + 1, updated_at = now()
+            WHERE id IN (
+                SELECT r.id FROM campaign_recipients AS r JOIN campaigns AS c ON c.id = r.campaign_id
+                WHERE r.campaign_id = %s AND r.shard = %s AND r.state = 'pending' AND c.status = 'running'
+                  AND (r.next_attempt_at IS NULL OR r.next_attempt_at <= now())
+                ORDER BY r.id LIMIT %s FOR UPDATE OF r SKIP LOCKED
+            )
+            RETURNING id, recipient, name, variables, attempts;
+        """, (worker_id, campaign_id, shard, limit))
+        claimed = sorted(CampaignRecipient(*r) for r in cur.fetchall())
+        conn.commit()
+        return claimed
+
+@timed_db
+def complete_campaign_in_db(campaign_id: int) -> bool:
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE campaigns SET status = 'completed', updated_at = now(), finished_at = now()
+            WHERE id = %s AND status = 'running'
+              AND NOT EXISTS (SELECT 1 FROM campaign_recipients WHERE campaign_id = %s AND state IN ('pending', 'sending'))
+            RETURNING id;
+        """, (campaign_id, campaign_id))
+        completed = cur.fetchone() is not None
+        conn.commit()
+        return completed
+
+@timed_db
+def heartbeat_campaign_worker_in_db(worker_id: str, sent_total: int, rate_limit: float, interval: float) -> int:
+    # Registers this worker and returns how many workers are alive, which is how the global rate limit gets shared out.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO campaign_workers (worker_id, hostname, sent_total, rate_limit) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = now(), sent_total = EXCLUDED.sent_total, rate_limit = EXCLUDED.rate_limit;
+        """, (worker_id, socket.gethostname(), sent_total, rate_limit))
+        # Claims stay leased for as long as their owner is alive, however slowly a throttled limiter works through them.
+        cur.execute("UPDATE campaign_recipients SET claimed_at = now() WHERE claimed_by = %s AND state = 'sending';", (worker_id,))
+        cur.execute("DELETE FROM campaign_workers WHERE heartbeat_at < now() - make_interval(secs => %s);", (interval * 20,))
+        cur.execute("SELECT count(*) FROM campaign_workers WHERE heartbeat_at >= now() - make_interval(secs => %s);", (interval * 3,))
+        active = cur.fetchone()[0]
+        conn.commit()
+        return max(1, active)
+
+@timed_db
+def release_campaign_recipients_in_db(worker_id: str, recipient_ids: List[int]) -> int:
+    # Claimed rows that never reached the Graph API go back to 'pending' with their attempt refunded.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            UPDATE campaign_recipients SET state = 'pending', attempts = attempts - 1, claimed_at = NULL, claimed_by = NULL, updated_at = now()
+            WHERE id = ANY(%s) AND state = 'sending' AND claimed_by = %s
+            RETURNING campaign_id;
+        """, (recipient_ids, worker_id))
+        campaign_ids = {r[0] for r in cur.fetchall()}
+        for campaign_id in sorted(campaign_ids): notify_campaign_changed(cur, campaign_id)
+        conn.commit()
+        return len(campaign_ids)
+
+@timed_db
+def remove_campaign_worker_from_db(worker_id: str):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("DELETE FROM campaign_workers WHERE worker_id = %s;", (worker_id,))
+        conn.commit()
+
+@timed_db
+def fetch_campaign_workers_from_db(interval: float):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT worker_id, hostname, started_at, heartbeat_at, sent_total, rate_limit, heartbeat_at >= now() - make_interval(secs => %s)
+            FROM campaign_workers ORDER BY started_at;
+        """, (interval * 3,))
+        return [{"worker_id": r[0], "hostname": r[1], "started_at": r[2].isoformat(), "heartbeat_at": r[3].isoformat(),
+                 "sent_total": r[4], "rate_limit": r[5], "active": r[6]} for r in cur.fetchall()]
+
+@timed_db
+def fetch_next_campaign_attempt_from_db(campaign_id: int) -> float:
+    # Seconds until the earliest scheduled retry of this campaign is due.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT COALESCE(EXTRACT(EPOCH FROM min(next_attempt_at) - now()), 0) FROM campaign_recipients
+            WHERE campaign_id = %s AND state = 'pending';
+        """, (campaign_id,))
+        return float(cur.fetchone()[0])
+
+@timed_db
+def fetch_dead_letters_from_db(campaign_id: int, limit: int, after: Optional[int]):
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id, recipient_id, recipient, attempts, error, error_code, created_at FROM campaign_dead_letters
+            WHERE campaign_id = %s AND replayed_at IS NULL AND id > %s ORDER BY id LIMIT %s;
+        """, (campaign_id, after or 0, limit))
+        return [{"id": r[0], "recipient_id": r[1], "recipient": r[2], "attempts": r[3], "error": r[4], "error_code": r[5],
+                 "created_at": r[6].isoformat()} for r in cur.fetchall()]
+
+@timed_db
+def replay_dead_letters_in_db(campaign_id: int, error_code: Optional[int]) -> int:
+    # Set-based: every open dead letter (optionally one error code) goes back to 'pending' with a fresh attempt budget,
+    # and a finished campaign is reopened so workers pick the rows up.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        # The failure counted when each dead letter was written is taken back out of that same hourly bucket.
+        cur.execute(f"""
+            WITH replayed AS (
+                UPDATE campaign_dead_letters SET replayed_at = now()
+                WHERE campaign_id = %s AND replayed_at IS NULL AND (%s::integer IS NULL OR error_code = %s::integer)
+                RETURNING campaign_id, recipient_id, created_at
+            ),
+            uncounted AS (
+                {CAMPAIGN_STATS_INSERT}
+                SELECT d.campaign_id, date_trunc('hour', d.created_at, 'UTC'), c.template_name, 0, 0, 0, -count(*), 0
+                FROM replayed AS d JOIN campaigns AS c ON c.id = d.campaign_id
+                GROUP BY 1, 2, 3
+                {CAMPAIGN_STATS_ON_CONFLICT}
+            )
+            UPDATE campaign_recipients SET state = 'pending', attempts = 0, next_attempt_at = NULL, last_error = NULL, last_error_code = NULL, updated_at = now()
+            WHERE id IN (SELECT recipient_id FROM replayed) AND state = 'failed';
+        """, (campaign_id, error_code, error_code))
+        replayed = cur.rowcount
+        if replayed:
+            cur.execute("UPDATE campaigns SET status = 'running', finished_at = NULL, updated_at = now() WHERE id = %s AND status IN ('running', 'completed');", (campaign_id,))
+            notify_campaign_changed(cur, campaign_id)
+        conn.commit()
+        return replayed
+
+@timed_db
+def recover_campaigns_in_db(lease_seconds: float, heartbeat_interval: float) -> List[int]:
+    # A 'sending' row past its lease whose owner has stopped heartbeating belonged to a process that died mid-send; the
+    # message may or may not have gone out, so it is failed rather than resent. Returns the campaigns that should resume.
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"""
+            WITH interrupted AS (
+                UPDATE campaign_recipients SET state = 'failed', last_error = 'interrupted: send outcome unknown', updated_at = now()
+                WHERE state = 'sending' AND claimed_at < now() - make_interval(secs => %s)
+                  AND NOT EXISTS (SELECT 1 FROM campaign_workers AS w WHERE w.worker_id = campaign_recipients.claimed_by
+                                  AND w.heartbeat_at >= now() - make_interval(secs => %s))
+                RETURNING id, campaign_id, recipient, attempts, last_error
+            ),
+            counted AS (
+                {CAMPAIGN_STATS_INSERT}
+                SELECT i.campaign_id, date_trunc('hour', now(), 'UTC'), c.template_name, 0, 0, 0, count(*), 0
+                FROM interrupted AS i JOIN campaigns AS c ON c.id = i.campaign_id
+                GROUP BY i.campaign_id, c.template_name
+                {CAMPAIGN_STATS_ON_CONFLICT}
+            )
+            INSERT INTO campaign_dead_letters (campaign_id, recipient_id, recipient, attempts, error)
+            SELECT campaign_id, id, recipient, attempts, last_error FROM interrupted;
+        """, (lease_seconds, heartbeat_interval * 3))
+        if cur.rowcount: print(f"Marked {cur.rowcount} interrupted campaign recipients as failed")
+        cur.execute("SELECT id FROM campaigns WHERE status IN ('preparing', 'running') ORDER BY id;")
+        running = [r[0] for r in cur.fetchall()]
+        conn.commit()
+        return running
+
+@timed_db
 def fetch_templates_from_db():
-    conn = None
-    try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
+    with db_pool.connection() as conn:
         cur = conn.cursor()
         cur.execute("SELECT id, template_name, template_body FROM templates ORDER BY template_name;")
         templates = [{"id": r[0], "template_name": r[1], "template_body": r[2]} for r in cur.fetchall()]
         return templates
-    finally:
-        if conn: conn.close()
 
+@timed_db
+def fetch_template_from_db(template_name: str) -> Optional[dict]:
+    with db_pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT id, template_name, template_body FROM templates WHERE template_name = %s;", (template_name,))
+        r = cur.fetchone()
+        return {"id": r[0], "template_name": r[1], "template_body": r[2]} if r else None
+
+def notify_templates_changed(cur):
+    cur.execute("SELECT pg_notify(%s, %s);", (TEMPLATES_CHANNEL, PROCESS_TOKEN))
+
+@timed_db
 def add_template_to_db(template: TemplateCreate):
-    conn = None
-    try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
+    with db_pool.connection() as conn:
         cur = conn.cursor()
         cur.execute("INSERT INTO templates (template_name, template_body) VALUES (%s, %s) RETURNING id;", (template.template_name, template.template_body))
         new_id = cur.fetchone()[0]
+        notify_templates_changed(cur)
         conn.commit()
-        return {"id": new_id, **template.model_dump()}
-    finally:
-        if conn: conn.close()
+    created = {"id": new_id, **template.model_dump()}
+    template_store.upsert(created)
+    return created
 
+@timed_db
 def update_template_in_db(template_id: int, template: TemplateCreate):
-    conn = None
-    try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
+    with db_pool.connection() as conn:
         cur = conn.cursor()
-        cur.execute("UPDATE templates SET template_name = %s, template_body = %s WHERE id = %s;", (template.template_name, template.template_body, template_id))
+        cur.execute(
+            "UPDATE templates AS t SET template_name = %s, template_body = %s "
+            "FROM (SELECT id, template_name FROM templates WHERE id = %s FOR UPDATE) AS old "
+            "WHERE t.id = old.id RETURNING old.template_name;",
+            (template.template_name, template.template_body, template_id))
+        previous = cur.fetchone()
+        notify_templates_changed(cur)
         conn.commit()
-        return {"status": "success"}
-    finally:
-        if conn: conn.close()
+    if previous: template_store.upsert({"id": template_id, **template.model_dump()})
+    return {"status": "success"}
 
+@timed_db
 def delete_template_from_db(template_id: int):
-    conn = None
-    try:
-        conn = psycopg2.connect(**DATABASE_CONFIG)
+    with db_pool.connection() as conn:
         cur = conn.cursor()
-        cur.execute("DELETE FROM templates WHERE id = %s;", (template_id,))
+        cur.execute("DELETE FROM templates WHERE id = %s RETURNING template_name;", (template_id,))
+        deleted = cur.fetchone()
+        notify_templates_changed(cur)
         conn.commit()
-        return {"status": "success"}
-    finally:
-        if conn: conn.close()
+    if deleted: template_store.remove(template_id)
+    return {"status": "success"}
+
+TEMPLATE_FORMATTER = string.Formatter()
+
+class CompiledTemplate:
+    def __init__(self, body: str):
+        self.body = body
+        # Parsed once with the same rules as str.format, so {{ }} escapes, format specs and conversions render as before.
+        try:
+            self.parts = list(TEMPLATE_FORMATTER.parse(body))
+        except ValueError:
+            self.parts = None
+
+    def render(self, values: dict):
+        # One pass builds both the Graph API body parameters and the text we store; text is None when it cannot be rendered.
+        if self.parts is None: return [], None
+        body_vars, pieces, complete = [], [], True
+        for literal, field_name, format_spec, conversion in self.parts:
+            pieces.append(literal)
+            if field_name is None: continue
+            value = values.get(field_name)
+            if value is not None: body_vars.append(value)
+            if not complete: continue
+            try:
+                obj, _ = TEMPLATE_FORMATTER.get_field(field_name, (), values)
+                obj = TEMPLATE_FORMATTER.convert_field(obj, conversion)
+                spec = TEMPLATE_FORMATTER.vformat(format_spec, (), values) if format_spec else ''
+                pieces.append(TEMPLATE_FORMATTER.format_field(obj, spec))
+            except (KeyError, IndexError, AttributeError, TypeError, ValueError):
+                complete = False
+        return body_vars, ''.join(pieces) if complete else None
+
+class TemplateStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_id: dict = {}
+        self._compiled: dict = {}
+        self._listing: List[dict] = []
+        self._encoded = b"[]"
+        self.etag = '"empty"'
+
+    def load(self):
+        templates = fetch_templates_from_db()
+        with self._lock:
+            self._by_id = {t["id"]: t for t in templates}
+            self._compiled.clear()
+            self._rebuild()
+
+    def upsert(self, template: dict):
+        with self._lock:
+            previous = self._by_id.get(template["id"])
+            if previous: self._compiled.pop(previous["template_name"], None)
+            self._compiled.pop(template["template_name"], None)
+            self._by_id[template["id"]] = dict(template)
+            self._rebuild()
+
+    def remove(self, template_id: int):
+        with self._lock:
+            previous = self._by_id.pop(template_id, None)
+            if previous: self._compiled.pop(previous["template_name"], None)
+            self._rebuild()
+
+    def _rebuild(self):
+        self._listing = sorted(self._by_id.values(), key=lambda t: t["template_name"])
+        self._encoded = orjson.dumps(self._listing)
+        self.etag = f'"{hashlib.sha1(orjson.dumps(self._listing, option=orjson.OPT_SORT_KEYS)).hexdigest()}"'
+
+    def snapshot(self):
+        # The listing is encoded once per change, so GET /templates only ever copies bytes.
+        with self._lock: return self._encoded, self.etag
+
+    def compiled(self, template_name: str) -> Optional[CompiledTemplate]:
+        # The store is only trusted while a listener keeps it in sync; without one, and on a miss (a NOTIFY lost while the
+        # listener was reconnecting), the template is read from Postgres and the store updated with it.
+        if DB_LISTEN_ENABLED:
+            with self._lock:
+                compiled = self._compiled.get(template_name)
+                if compiled is not None: return compiled
+                template = next((t for t in self._listing if t["template_name"] == template_name), None)
+                if template is not None:
+                    compiled = self._compiled[template_name] = CompiledTemplate(template["template_body"])
+                    return compiled
+        template = fetch_template_from_db(template_name)
+        if template is None: return None
+        self.upsert(template)
+        with self._lock:
+            compiled = self._compiled[template_name] = CompiledTemplate(template["template_body"])
+            return compiled
+
+    def on_notify(self, payload: Optional[str]):
+        # None means the listener reconnected and may have missed changes, so it reloads like a change from elsewhere.
+        if payload is None or payload != PROCESS_TOKEN: self.load()
+
+template_store = TemplateStore()
 
 # ===================================================================
-# --- 4. Campaign Logic (Background Task) ---
+# --- 7. Campaign Logic (Background Task) ---
 # ===================================================================
-async def run_campaign_logic(campaign_data: CampaignRequest):
-    template_name = campaign_data.template_name
-    await log_manager.broadcast(f"--- Starting Campaign '{template_name}' ---", "info")
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.max_rate = self.rate = max(rate, 0.1)
+        self.min_rate = max(self.max_rate / 50, 0.1)
+        self.capacity = capacity or max(1.0, self.max_rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def throttle(self):
+        # Multiplicative decrease on 429/throttling errors, drained bucket so every sender backs off at once.
+        self.rate = max(self.min_rate, self.rate / 2)
+        self.tokens = min(self.tokens, 0.0)
+
+    def set_max_rate(self, rate: float):
+        # Rescales to a new share of the global limit while keeping any throttling backoff in proportion.
+        ratio = self.rate / self.max_rate
+        self.max_rate = max(rate, 0.1)
+        self.min_rate = max(self.max_rate / 50, 0.1)
+        self.rate = max(self.min_rate, self.max_rate * ratio)
+        self.capacity = max(1.0, self.max_rate)
+
+    def recover(self):
+        # Additive increase: regains roughly 5% of the configured rate per second of clean sends.
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / (20 * self.rate))
+
+def graph_error_code(exc: Exception) -> Optional[int]:
+    if isinstance(exc, httpx.HTTPStatusError):
+        try: return exc.response.json().get("error", {}).get("code")
+        except ValueError: return None
+    return None
+
+def is_throttling_error(exc: Exception) -> bool:
+    if isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code == 429: return True
+    return graph_error_code(exc) in GRAPH_THROTTLING_ERROR_CODES
+
+def is_transient_error(exc: Exception) -> bool:
+    # Timeouts, dropped connections, 5xx and Graph's own transient codes/flag are worth retrying; 4xx payload errors are not.
+    if isinstance(exc, httpx.TransportError) or is_throttling_error(exc): return True
+    if not isinstance(exc, httpx.HTTPStatusError): return False
+    if exc.response.status_code >= 500 or graph_error_code(exc) in GRAPH_TRANSIENT_ERROR_CODES: return True
+    try: return bool(exc.response.json().get("error", {}).get("is_transient"))
+    except ValueError: return False
+
+def retry_delay(attempts: int) -> float:
+    # Exponential backoff with equal jitter, so retries from one burst of failures spread out instead of stampeding back.
+    delay = min(CAMPAIGN_RETRY_MAX_DELAY, CAMPAIGN_RETRY_BASE_DELAY * 2 ** max(attempts - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+class CampaignDispatcher:
+    def __init__(self, name: str, send, describe=str, concurrency: int = CAMPAIGN_CONCURRENCY, rate_limit: float = CAMPAIGN_RATE_LIMIT,
+                 on_failed=None, limiter: Optional[TokenBucket] = None, progress=None):
+        self.name, self.send, self.describe, self.on_failed, self.progress = name, send, describe, on_failed, progress
+        self.concurrency = max(1, concurrency)
+        self.limiter = limiter or TokenBucket(rate_limit)
+        self.sent = self.failed = self.skipped = self.throttled = self.retried = 0
+        self.started_at = time.monotonic()
+
+    async def run(self, recipients):
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self.started_at = time.monotonic()
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(self.concurrency)]
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            if hasattr(recipients, '__aiter__'):
+                async for recipient in recipients: await queue.put(recipient)
+            else:
+                for recipient in recipients: await queue.put(recipient)
+            await queue.join()
+        finally:
+            for task in workers + [reporter]: task.cancel()
+            await asyncio.gather(*workers, reporter, return_exceptions=True)
+        await log_manager.broadcast(self.progress_line(), "info")
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            recipient = await queue.get()
+            try: await self._deliver(recipient)
+            except Exception as e: print(f"Campaign worker error: {e}")
+            finally: queue.task_done()
+
+    async def _deliver(self, recipient):
+        for attempt in range(CAMPAIGN_THROTTLE_RETRIES + 1):
+            await self.limiter.acquire()
+            try:
+                delivered = await self.send(recipient)
+            except Exception as e:
+                if is_throttling_error(e) and attempt < CAMPAIGN_THROTTLE_RETRIES:
+                    self.throttled += 1
+                    CAMPAIGN_MESSAGES.labels("throttled").inc()
+                    self.limiter.throttle()
+                    await log_manager.broadcast(f"⏳ Rate limited by WhatsApp, slowing '{self.name}' to {self.limiter.rate:.1f} msg/s", "warning")
+                    continue
+                # on_failed returns True when it has scheduled a later retry instead of giving up on the recipient.
+                if self.on_failed and await self.on_failed(recipient, e):
+                    self.retried += 1
+                    CAMPAIGN_MESSAGES.labels("retried").inc()
+                    await log_manager.broadcast(f"↻ Will retry {self.describe(recipient)} later. Error: {e}", "warning")
+                    return
+                self.failed += 1
+                CAMPAIGN_MESSAGES.labels("failed").inc()
+                await log_manager.broadcast(f"❌ Failed to send to {self.describe(recipient)}. Error: {e}", "error")
+                return
+            self.limiter.recover()
+            if delivered:
+                self.sent += 1
+                CAMPAIGN_MESSAGES.labels("sent").inc()
+                await log_manager.broadcast(f"✔ Sent '{self.name}' to {self.describe(recipient)}", "success")
+            else:
+                self.skipped += 1
+            return
+
+    def progress_line(self) -> str:
+        elapsed = max(time.monotonic() - self.started_at, 1e-6)
+        return (f"📊 '{self.name}': {self.sent} sent, {self.failed} failed, {self.retried} retrying, {self.skipped} skipped "
+                f"in {elapsed:.0f}s ({self.sent / elapsed:.1f} msg/s, limit {self.limiter.rate:.1f} msg/s)")
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(CAMPAIGN_PROGRESS_INTERVAL)
+            try: line = await self.progress() if self.progress else self.progress_line()
+            except Exception as e: line = f"Progress unavailable: {e}"
+            await log_manager.broadcast(line, "info")
+
+async def send_campaign_message(campaign: dict, compiled: Optional[CompiledTemplate], recipient: CampaignRecipient) -> bool:
+    template_name = campaign["template_name"]
+    components = []
+    
+    if campaign["image_url"]:
+        components.append(create_image_header(campaign["image_url"]))
     
-    message_template = fetch_template_body_from_db(template_name)
+    message_to_save = f"(Sent Campaign: '{template_name}')"
+    if compiled:
+        body_vars, rendered = compiled.render(recipient.variables)
+        if body_vars:
+            components.append(create_text_body(body_vars))
+        message_to_save = rendered if rendered is not None else f"(Sent Campaign: '{template_name}') - render failed"
     
-    for customer_data in campaign_data.customers:
-        customer_dict = customer_data.model_dump()
-        recipient_number = f"{customer_dict.get('country_code', '')}{customer_dict.get('phone', '')}"
-        customer_name = customer_dict.get('name', '')
-
-        if not recipient_number or not customer_name:
-            await log_manager.broadcast(f"⚠️ Skipping row due to missing name or phone.", "warning")
-            continue
+    response = await send_whatsapp_template(recipient.recipient, template_name, components)
+    
+    wamid = response_wamid(response)
+    await message_writer.put_async(MessageRow(recipient.recipient, strip_nul(message_to_save), 'outgoing', datetime.now(timezone.utc), wamid))
+    await message_writer.put_async(RecipientOutcome(recipient.id, 'sent', wamid))
+    return True
+
+async def record_campaign_failure(recipient: CampaignRecipient, error: Exception) -> bool:
+    # Transient failures go back to 'pending' with a next_attempt_at: Postgres is the delay queue, so nothing waits in memory.
+    message, code = str(error)[:500], graph_error_code(error)
+    if is_transient_error(error) and recipient.attempts < CAMPAIGN_MAX_ATTEMPTS:
+        retry_at = datetime.now(timezone.utc) + timedelta(seconds=retry_delay(recipient.attempts))
+        await message_writer.put_async(RecipientOutcome(recipient.id, 'pending', error=message, error_code=code, next_attempt_at=retry_at))
+        return True
+    await message_writer.put_async(RecipientOutcome(recipient.id, 'failed', error=message, error_code=code))
+    return False
+
+async def iter_csv_records(upload: UploadFile):
+    # One csv.reader over the whole upload, so quoted fields may span lines and stray quotes inside fields parse as csv does.
+    # Records are pulled in batches off the event loop; yields (line number, values) where the line is where the record ends.
+    text = io.TextIOWrapper(upload.file, encoding='utf-8-sig', errors='replace', newline='')
+    reader = csv.reader(text)
+    def read_batch():
+        try: return [(reader.line_num, values) for values in islice(reader, UPLOAD_COPY_BATCH_SIZE)]
+        except csv.Error as e: raise HTTPException(status_code=400, detail=f"Malformed CSV at line {reader.line_num}: {e}")
+    try:
+        while batch := await asyncio.to_thread(read_batch):
+            for line, values in batch:
+                if any(v.strip() for v in values): yield line, values
+    finally:
+        text.detach()
+
+async def stage_campaign_upload(upload: UploadFile):
+    upload_id = await asyncio.to_thread(create_campaign_upload_in_db, upload.filename)
+    header, batch, accepted, rejected, errors = None, [], 0, 0, []
+    try:
+        async for line, values in iter_csv_records(upload):
+            if header is None:
+                header = [h.strip() for h in values]
+                continue
+            row = {key: value.strip() for key, value in zip(header, values) if key in CUSTOMER_FIELDS and value.strip()}
+            if not row.get("phone") or not row.get("name"):
+                rejected += 1
+                if len(errors) < 20: errors.append(f"Line {line}: missing name or phone.")
+                continue
+            customer = Customer(**row)
+            accepted += 1
+            batch.append((accepted, *(getattr(customer, f) for f in CUSTOMER_FIELDS)))
+            if len(batch) >= UPLOAD_COPY_BATCH_SIZE:
+                await asyncio.to_thread(copy_upload_rows_to_db, upload_id, batch)
+                batch = []
+        if header is None: raise HTTPException(status_code=400, detail="CSV must have a header and at least one data row.")
+        if batch: await asyncio.to_thread(copy_upload_rows_to_db, upload_id, batch)
+    except BaseException:
+        await asyncio.to_thread(finish_campaign_upload_in_db, upload_id, accepted, rejected, 'failed')
+        raise
+    await asyncio.to_thread(finish_campaign_upload_in_db, upload_id, accepted, rejected, 'ready')
+    return {"upload_id": upload_id, "filename": upload.filename, "status": "ready", "row_count": accepted, "rejected_count": rejected, "errors": errors}
+
+class CampaignRunner:
+    # Drives every 'running' campaign from its persisted recipient rows, so a restart resumes where the last process stopped.
+    # Any number of processes can run one: they claim disjoint batches and split CAMPAIGN_RATE_LIMIT between them.
+    def __init__(self, worker_id: str = PROCESS_TOKEN):
+        self.worker_id = worker_id
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.dispatchers: Dict[int, CampaignDispatcher] = {}
+        self.limiter = TokenBucket(CAMPAIGN_RATE_LIMIT)
+        self.active_workers = 1
+        self.sent_total = 0
+        self.unsent: Set[int] = set()  # claimed recipient ids not yet handed to the Graph API
+        self.finishing: Set[int] = set()  # campaigns whose last rows were still being sent by other workers when this one ran out
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.stopping = asyncio.Event()
+        self._maintainer: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if not CAMPAIGN_WORKER_ENABLED: return
+        self.loop = asyncio.get_running_loop()
+        self.stopping.clear()
+        await self._heartbeat()
+        for campaign_id in await asyncio.to_thread(recover_campaigns_in_db, CAMPAIGN_CLAIM_LEASE, CAMPAIGN_HEARTBEAT_INTERVAL): self.launch(campaign_id)
+        self._maintainer = asyncio.create_task(self._maintain())
+
+    async def stop(self):
+        # No new claims are made and queued recipients are not sent; sends already talking to the Graph API get
+        # CAMPAIGN_STOP_GRACE to finish. Unsent claims are released for other workers; only sends cut off after the grace
+        # period stay 'sending', and recovery fails those once this worker's heartbeat is gone, as their outcome is unknown.
+        self.stopping.set()
         try:
-            components = []
-            
-            if campaign_data.image_url:
-                components.append(create_image_header(campaign_data.image_url))
-            
-            if message_template:
-                placeholders = [p.strip('{}') for p in re.findall(r'\{.*?\}', message_template)]
-                body_vars = [customer_dict.get(p) for p in placeholders if customer_dict.get(p) is not None]
-                if body_vars:
-                    components.append(create_text_body(body_vars))
-            
-            send_whatsapp_template(recipient_number, template_name, components)
-            
-            message_to_save = f"(Sent Campaign: '{template_name}')"
-            if message_template:
+            if self.tasks: await asyncio.wait(list(self.tasks.values()), timeout=CAMPAIGN_STOP_GRACE)
+        finally:
+            tasks = [t for t in [self._maintainer, *self.tasks.values()] if t]
+            for task in tasks: task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                if self.unsent:
+                    await asyncio.to_thread(release_campaign_recipients_in_db, self.worker_id, sorted(self.unsent))
+                    self.unsent.clear()
+            finally:
+                if self._maintainer:
+                    self._maintainer = None
+                    await asyncio.to_thread(remove_campaign_worker_from_db, self.worker_id)
+
+    def launch(self, campaign_id: int):
+        if self.loop is None or self.stopping.is_set() or campaign_id in self.tasks: return
+        task = asyncio.create_task(self._run(campaign_id))
+        self.tasks[campaign_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(campaign_id, None))
+
+    def on_notify(self, payload: Optional[str]):
+        # Runs on the listener thread; a None payload (listener reconnect) is left to the periodic maintenance pass.
+        if payload and self.loop: self.loop.call_soon_threadsafe(self.launch, int(payload))
+
+    async def _run(self, campaign_id: int):
+        try:
+            campaign = await asyncio.to_thread(fetch_campaign_from_db, campaign_id)
+            if campaign is not None and campaign["status"] == 'preparing':
+                await log_manager.broadcast(f"--- Preparing recipients for campaign #{campaign_id} ---", "info")
+                while not await asyncio.to_thread(prepare_campaign_chunk_in_db, campaign_id, CAMPAIGN_PREPARE_BATCH_SIZE):
+                    if self.stopping.is_set(): return
+                campaign = await asyncio.to_thread(fetch_campaign_from_db, campaign_id)
+                skipped = ', '.join(f"{count} {reason.replace('_', ' ')}" for reason, count in campaign["skipped"].items())
+                await log_manager.broadcast(f"--- Campaign #{campaign_id} has {campaign['total_count']} recipients"
+                                            f"{f' (skipped {skipped})' if skipped else ''} ---", "info")
+            if campaign_id in self.finishing:
+                # Launched by the completion notify of a campaign this worker left to the workers sending its last rows.
+                self.finishing.discard(campaign_id)
+                if campaign is not None and campaign["status"] == 'completed': await log_manager.broadcast(f"--- Campaign #{campaign_id} Finished ---", "info")
+            if campaign is None or campaign["status"] != 'running': return
+            template_name = campaign["template_name"]
+            await log_manager.broadcast(f"--- Starting Campaign '{template_name}' (#{campaign_id}) ---", "info")
+            compiled = await asyncio.to_thread(template_store.compiled, template_name)
+            while True:
+                dispatcher = CampaignDispatcher(template_name, partial(self._send, campaign, compiled), describe=lambda r: r.name,
+                                                on_failed=record_campaign_failure, limiter=self.limiter, progress=partial(self.progress_line, campaign_id))
+                self.dispatchers[campaign_id] = dispatcher
                 try:
-                    message_to_save = message_template.format(**customer_dict)
-                except KeyError:
-                    message_to_save = f"(Sent Campaign: '{template_name}') - render failed"
-            
-            save_outgoing_message_to_db(recipient_number, message_to_save)
-            await log_manager.broadcast(f"✔ Sent '{template_name}' to {customer_name}", "success")
+                    await dispatcher.run(self._claimed_recipients(campaign_id))
+                finally:
+                    self.sent_total += dispatcher.sent
+                    self.dispatchers.pop(campaign_id, None)
+                await message_writer.drain()
+                if self.stopping.is_set(): return
+                if await asyncio.to_thread(complete_campaign_in_db, campaign_id):
+                    await log_manager.broadcast(f"--- Campaign #{campaign_id} Finished ---", "info")
+                    return
+                current = await asyncio.to_thread(fetch_campaign_from_db, campaign_id)
+                if current["status"] == 'completed':
+                    await log_manager.broadcast(f"--- Campaign #{campaign_id} Finished ---", "info")
+                    return
+                if current["status"] != 'running':
+                    await log_manager.broadcast(f"--- Campaign #{campaign_id} stopped here ({current['status']}) ---", "warning")
+                    return
+                if not current["recipients"]["pending"]:
+                    # Other workers are still sending the last rows; whichever writes the last outcome completes the campaign.
+                    self.finishing.add(campaign_id)
+                    return
+                # Pending rows left over are scheduled retries (or a quick pause/resume); sleep until the earliest is due.
+                wait = await asyncio.to_thread(fetch_next_campaign_attempt_from_db, campaign_id)
+                try: await asyncio.wait_for(self.stopping.wait(), min(max(wait, 0.5), CAMPAIGN_CLAIM_LEASE / 4))
+                except asyncio.TimeoutError: continue
+                return
         except Exception as e:
-            await log_manager.broadcast(f"❌ Failed to send to {customer_name}. Error: {e}", "error")
-        await asyncio.sleep(1)
-        
-    await log_manager.broadcast("--- Campaign Finished ---", "info")
+            print(f"Campaign {campaign_id} runner error: {e}")
+
+    async def _claimed_recipients(self, campaign_id: int):
+        # Small claims keep pause/cancel responsive: the status is re-checked by every claim. Shards are visited round-robin
+        # from a per-worker offset and the stream ends after a full round comes back empty.
+        shard = int(hashlib.md5(self.worker_id.encode()).hexdigest(), 16) % CAMPAIGN_SHARDS
+        empty = 0
+        while empty < CAMPAIGN_SHARDS and not self.stopping.is_set():
+            batch = await asyncio.to_thread(claim_campaign_recipients_in_db, campaign_id, shard, CAMPAIGN_CLAIM_BATCH_SIZE, self.worker_id)
+            self.unsent.update(r.id for r in batch)
+            shard = (shard + 1) % CAMPAIGN_SHARDS
+            empty = 0 if batch else empty + 1
+            for recipient in batch: yield recipient
+
+    async def _send(self, campaign: dict, compiled: Optional[CompiledTemplate], recipient: CampaignRecipient) -> bool:
+        if self.stopping.is_set(): return False  # still in self.unsent, so stop() releases it
+        self.unsent.discard(recipient.id)
+        return await send_campaign_message(campaign, compiled, recipient)
+
+    async def progress_line(self, campaign_id: int) -> str:
+        campaign = await asyncio.to_thread(fetch_campaign_from_db, campaign_id)
+        counts = campaign["recipients"]
+        return (f"📊 Campaign #{campaign_id} '{campaign['template_name']}': {counts['sent']}/{campaign['total_count']} sent, "
+                f"{counts['failed']} failed, {counts['pending'] + counts['sending']} remaining across {self.active_workers} worker(s) "
+                f"(this worker {self.limiter.rate:.1f} msg/s)")
+
+    async def _heartbeat(self):
+        sent = self.sent_total + sum(d.sent for d in self.dispatchers.values())
+        self.active_workers = await asyncio.to_thread(heartbeat_campaign_worker_in_db, self.worker_id, sent, self.limiter.max_rate, CAMPAIGN_HEARTBEAT_INTERVAL)
+        self.limiter.set_max_rate(CAMPAIGN_RATE_LIMIT / self.active_workers)
+
+    def stats(self):
+        return {"running_campaigns": len(self.tasks), "active_workers": self.active_workers, "rate_limit": self.limiter.rate,
+                "sent_total": self.sent_total + sum(d.sent for d in list(self.dispatchers.values()))}
+
+    async def _maintain(self):
+        last_recovery = time.monotonic()
+        while True:
+            await asyncio.sleep(CAMPAIGN_HEARTBEAT_INTERVAL)
+            try:
+                await self._heartbeat()
+                if time.monotonic() - last_recovery < CAMPAIGN_CLAIM_LEASE / 4: continue
+                last_recovery = time.monotonic()
+                for campaign_id in await asyncio.to_thread(recover_campaigns_in_db, CAMPAIGN_CLAIM_LEASE, CAMPAIGN_HEARTBEAT_INTERVAL):
+                    if campaign_id not in self.tasks and await asyncio.to_thread(complete_campaign_in_db, campaign_id): continue
+                    self.launch(campaign_id)
+            except Exception as e:
+                print(f"Campaign maintenance error: {e}")
+
+campaign_runner = CampaignRunner()
 
 # ===================================================================
-# --- 5. FastAPI App and API Endpoints ---
+# --- 8. Webhook Ingestion (Background Workers) ---
 # ===================================================================
-app = FastAPI()
+class LatencyStat:
+    def __init__(self, histogram=None):
+        self.count, self.total, self.max = 0, 0.0, 0.0
+        self.histogram = histogram
+
+    def observe(self, seconds: float):
+        if self.histogram is not None: self.histogram.observe(seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        return {"count": self.count, "avg_ms": round(1000 * self.total / self.count, 3) if self.count else 0.0, "max_ms": round(1000 * self.max, 3)}
+
+class DedupCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size, self.ttl = max_size, ttl
+        self._expires: OrderedDict = OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def seen(self, key: str) -> bool:
+        # True for a repeat within the TTL; otherwise records the key. Entries share one TTL, so the oldest sit at the front.
+        now = time.monotonic()
+        while self._expires and next(iter(self._expires.values())) <= now: self._expires.popitem(last=False)
+        if key in self._expires:
+            self.hits += 1
+            return True
+        self.misses += 1
+        self._expires[key] = now + self.ttl
+        if len(self._expires) > self.max_size:
+            self._expires.popitem(last=False)
+            self.evictions += 1
+        return False
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self._expires), "capacity": self.max_size, "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0}
+
+def dedup_key(item) -> Optional[str]:
+    if isinstance(item, MessageRow): return item.wamid
+    return f"{item.wamid}:{item.status}"
+
+def describe_message(message: dict) -> Optional[str]:
+    kind = message.get("type")
+    if kind == "text": return (message.get("text") or {}).get("body")
+    if kind == "button": return (message.get("button") or {}).get("text")
+    if kind == "interactive":
+        interactive = message.get("interactive") or {}
+        return (interactive.get("button_reply") or interactive.get("list_reply") or {}).get("title")
+    if kind in ("image", "video", "document", "audio", "sticker"):
+        media = message.get(kind) or {}
+        caption = media.get("caption") or media.get("filename")
+        return f"[{kind}] {caption}" if caption else f"[{kind}]"
+    if kind == "location":
+        location = message.get("location") or {}
+        return f"[location] {location.get('name') or ''} {location.get('latitude')},{location.get('longitude')}".replace("  ", " ")
+    if kind == "reaction": return f"[reaction] {(message.get('reaction') or {}).get('emoji', '')}".strip()
+    return f"[{kind or 'unknown'}]"
+
+def whatsapp_time(timestamp, fallback: datetime) -> datetime:
+    try: return datetime.fromtimestamp(int(timestamp), timezone.utc)
+    except (TypeError, ValueError): return fallback
+
+def parse_webhook_payload(data: dict, received_at: datetime):
+    # Single pass over every entry/change, yielding every message and every status callback in the delivery.
+    for entry in data.get("entry") or []:
+        for change in entry.get("changes") or []:
+            if change.get("field") != "messages": continue
+            value = change.get("value") or {}
+            for message in value.get("messages") or []:
+                sender_id, message_text = message.get("from"), describe_message(message)
+                if sender_id and message_text: yield MessageRow(sender_id, strip_nul(message_text), 'incoming', received_at, message.get("id"))
+            for status in value.get("statuses") or []:
+                if not status.get("id") or not status.get("status"): continue
+                errors = status.get("errors") or []
+                error = f"{errors[0].get('code')}: {errors[0].get('title') or errors[0].get('message')}" if errors else None
+                yield StatusUpdate(status["id"], status["status"], whatsapp_time(status.get("timestamp"), received_at), status.get("recipient_id"), error)
+
+class WebhookIngestor:
+    def __init__(self, queue_size: int, workers: int, batch_size: int):
+        self.workers, self.batch_size = max(1, workers), max(1, batch_size)
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks: List[asyncio.Task] = []
+        self.accepted_total = self.rejected_total = self.processed_total = self.failed_total = 0
+        self.queue_lag = LatencyStat(WEBHOOK_SECONDS.labels("queue_lag"))
+        self.process_time = LatencyStat(WEBHOOK_SECONDS.labels("process"))
+        self.store_time = LatencyStat(WEBHOOK_SECONDS.labels("store"))
+        self.dedup = DedupCache(WEBHOOK_DEDUP_CACHE_SIZE, WEBHOOK_DEDUP_CACHE_TTL)
+
+    async def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 10):
+        # Meta already has a 200 for everything queued, so whatever is not stored in time goes to the writer's spill file.
+        try: await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError: pass
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        items, left = [], 0
+        while not self.queue.empty():
+            _, received_at, data = self.queue.get_nowait()
+            items.extend(parse_webhook_payload(data, received_at))
+            left += 1
+        if items:
+            await asyncio.to_thread(message_writer.spill, items)
+            print(f"Webhook queue not drained on shutdown: spilled {len(items)} items from {left} deliveries.")
+
+    def submit(self, data: dict) -> bool:
+        try: self.queue.put_nowait((time.monotonic(), datetime.now(timezone.utc), data))
+        except asyncio.QueueFull:
+            self.rejected_total += 1
+            return False
+        self.accepted_total += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty(): batch.append(self.queue.get_nowait())
+            try: await self._process(batch)
+            except Exception as e:
+                self.failed_total += len(batch)
+                print(f"Error processing webhook batch: {e}")
+            finally:
+                for _ in batch: self.queue.task_done()
+
+    async def _process(self, batch):
+        started = time.monotonic()
+        items = []
+        for enqueued_at, received_at, data in batch:
+            self.queue_lag.observe(started - enqueued_at)
+            for item in parse_webhook_payload(data, received_at):
+                key = dedup_key(item)
+                if key is None or not self.dedup.seen(key): items.append(item)
+        parsed = time.monotonic()
+        self.process_time.observe(parsed - started)
+        for i, item in enumerate(items):
+            try: await message_writer.put_async(item, urgent=isinstance(item, MessageRow))
+            except asyncio.CancelledError:
+                # Shutdown cancelled us while the writer queue was full; keep the rest of this batch on disk.
+                message_writer.spill(items[i:])
+                raise
+        self.store_time.observe(time.monotonic() - parsed)
+        self.processed_total += len(batch)
+
+    def stats(self):
+        return {"queue_depth": self.queue.qsize(), "queue_capacity": self.queue.maxsize, "workers": self.workers,
+                "accepted_total": self.accepted_total, "rejected_total": self.rejected_total,
+                "processed_total": self.processed_total, "failed_total": self.failed_total,
+                "queue_lag": self.queue_lag.snapshot(), "process_time": self.process_time.snapshot(), "store_time": self.store_time.snapshot(),
+                "dedup_cache": self.dedup.stats()}
+
+webhook_ingestor = WebhookIngestor(WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS, WEBHOOK_BATCH_SIZE)
+
+REGISTRY.register(StatsCollector(lambda: [
+    ("db_pool", db_pool.stats()), ("history_pool", history_pool.stats()), ("message_writer", message_writer.stats()), ("webhook", webhook_ingestor.stats()),
+    ("webhook_dedup", webhook_ingestor.dedup.stats()), ("ws_log", log_manager.stats()), ("ws_events", event_hub.stats()),
+    ("campaign_worker", campaign_runner.stats()),
+]))
+
+# ===================================================================
+# --- 9. FastAPI App and API Endpoints ---
+# ===================================================================
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    db_pool.open()
+    history_pool.open()
+    run_migrations()
+    template_store.load()
+    message_writer.start()
+    event_hub.loop = asyncio.get_running_loop()
+    pg_listener.on(TEMPLATES_CHANNEL, template_store.on_notify)
+    pg_listener.on(EVENTS_CHANNEL, event_hub.dispatch_threadsafe)
+    if CAMPAIGN_WORKER_ENABLED: pg_listener.on(CAMPAIGNS_CHANNEL, campaign_runner.on_notify)
+    pg_listener.start()
+    await graph_client.open()
+    await webhook_ingestor.start()
+    await campaign_runner.start()
+    loop_monitor = asyncio.create_task(monitor_event_loop_lag())
+    partition_maintainer = asyncio.create_task(maintain_message_partitions())
+    status_sweeper = asyncio.create_task(sweep_pending_statuses())
+    try:
+        yield
+    finally:
+        status_sweeper.cancel()
+        partition_maintainer.cancel()
+        loop_monitor.cancel()
+        # Each step runs even if an earlier one failed (e.g. the database is gone), so the writer still gets to spill.
+        for name, step in (("campaign runner", campaign_runner.stop), ("webhook ingestor", webhook_ingestor.stop), ("graph client", graph_client.close),
+                           ("listener", pg_listener.stop), ("message writer", message_writer.stop), ("history pool", history_pool.close), ("database pool", db_pool.close)):
+            try:
+                result = step()
+                if asyncio.iscoroutine(result): await result
+            except Exception as e:
+                print(f"Shutdown of the {name} failed: {e}")
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
 
 @app.websocket("/ws/log")
@@ -264,46 +2937,189 @@ async def websocket_endpoint(websocket: WebSocket):
         while True: await websocket.receive_text()
     except Exception: log_manager.disconnect(websocket)
 
+@app.websocket("/ws/events")
+async def events_endpoint(websocket: WebSocket):
+    await event_hub.connect(websocket)
+    try:
+        while True:
+            command = json.loads(await websocket.receive_text())
+            topic = str(command.get("topic", ""))
+            if command.get("action") == "subscribe": event_hub.subscribe(websocket, topic)
+            elif command.get("action") == "unsubscribe": event_hub.unsubscribe(websocket, topic)
+    except Exception: event_hub.disconnect(websocket)
+
+@app.post("/campaign-uploads")
+async def upload_campaign_customers(file: UploadFile = File(...)):
+    return await stage_campaign_upload(file)
+
+@app.get("/campaign-uploads/{upload_id}")
+def get_campaign_upload(upload_id: int):
+    upload = fetch_campaign_upload_from_db(upload_id)
+    if upload is None: raise HTTPException(status_code=404, detail="Upload not found.")
+    return upload
+
+async def require_ready_upload(upload_id: int):
+    upload = await asyncio.to_thread(fetch_campaign_upload_from_db, upload_id)
+    if upload is None: raise HTTPException(status_code=404, detail="Upload not found.")
+    if upload["status"] != 'ready': raise HTTPException(status_code=409, detail=f"Upload is {upload['status']}.")
+
 @app.post("/start-campaign")
 async def start_campaign(campaign_data: CampaignRequest):
-    asyncio.create_task(run_campaign_logic(campaign_data))
-    return {"status": "Campaign has been started in the background."}
+    if not campaign_data.customers and campaign_data.upload_id is None and campaign_data.segment_id is None:
+        raise HTTPException(status_code=400, detail="Provide customers, an upload_id or a segment_id.")
+    if campaign_data.upload_id is not None: await require_ready_upload(campaign_data.upload_id)
+    campaign = await asyncio.to_thread(create_campaign_in_db, campaign_data)
+    campaign_runner.launch(campaign["campaign_id"])
+    return {"status": "Campaign is preparing its recipients in the background.", **campaign}
+
+@app.post("/customers")
+async def import_customers(request: CustomerImportRequest):
+    if not request.customers and request.upload_id is None: raise HTTPException(status_code=400, detail="Provide customers or an upload_id.")
+    if request.upload_id is not None: await require_ready_upload(request.upload_id)
+    return await asyncio.to_thread(upsert_customers_in_db, request)
+
+@app.get("/customers/{phone}")
+def get_customer(phone: str):
+    customer = fetch_customer_from_db(phone)
+    if customer is None: raise HTTPException(status_code=404, detail="Customer not found.")
+    return customer
+
+@app.get("/segments")
+def get_segments(): return fetch_segments_from_db()
+
+@app.post("/segments")
+def create_segment(segment: SegmentCreate): return create_segment_in_db(segment)
 
-@app.get("/conversations")
-def get_conversations():
-    return {"conversations": fetch_conversations_from_db()}
+@app.get("/segments/{segment_id}")
+def get_segment(segment_id: int, sample_size: int = Query(20, ge=0, le=100)):
+    segment = fetch_segment_from_db(segment_id, sample_size)
+    if segment is None: raise HTTPException(status_code=404, detail="Segment not found.")
+    return segment
 
-@app.get("/conversations/{sender_id}", response_model=List[Message])
-def get_conversation_history(sender_id: str):
-    messages = fetch_messages_for_sender_from_db(sender_id)
-    if isinstance(messages, dict): raise HTTPException(status_code=500, detail=messages.get("error"))
-    return messages
+@app.delete("/segments/{segment_id}")
+def delete_segment(segment_id: int):
+    if not delete_segment_from_db(segment_id): raise HTTPException(status_code=404, detail="Segment not found.")
+    return {"status": "success"}
+
+@app.post("/opt-outs")
+def add_opt_outs(request: OptOutRequest):
+    return {"added": add_opt_outs_to_db(request.phones, request.reason)}
+
+@app.delete("/opt-outs/{phone}")
+def delete_opt_out(phone: str):
+    if not remove_opt_out_from_db(phone): raise HTTPException(status_code=404, detail="Phone is not opted out.")
+    return {"status": "success"}
+
+@app.get("/campaigns")
+def get_campaigns(limit: int = Query(20, ge=1, le=100)):
+    return fetch_campaigns_from_db(limit)
+
+@app.get("/campaign-workers")
+def get_campaign_workers():
+    return fetch_campaign_workers_from_db(CAMPAIGN_HEARTBEAT_INTERVAL)
+
+@app.get("/campaigns/{campaign_id}")
+def get_campaign(campaign_id: int):
+    campaign = fetch_campaign_from_db(campaign_id)
+    if campaign is None: raise HTTPException(status_code=404, detail="Campaign not found.")
+    return campaign
+
+async def change_campaign_status(campaign_id: int, status: str, allowed_from: tuple):
+    campaign = await asyncio.to_thread(set_campaign_status_in_db, campaign_id, status, allowed_from)
+    if campaign is None:
+        current = await asyncio.to_thread(fetch_campaign_from_db, campaign_id)
+        if current is None: raise HTTPException(status_code=404, detail="Campaign not found.")
+        raise HTTPException(status_code=409, detail=f"Campaign is {current['status']}.")
+    return campaign
+
+@app.get("/campaigns/{campaign_id}/stats")
+def get_campaign_stats(campaign_id: int, bucket: str = Query("hour", pattern="^(hour|day)$")):
+    stats = fetch_campaign_stats_from_db(campaign_id, bucket)
+    if stats is None: raise HTTPException(status_code=404, detail="Campaign not found.")
+    return stats
+
+@app.get("/campaign-stats/templates")
+def get_template_stats(since: Optional[datetime] = None, template_name: Optional[str] = None):
+    return fetch_template_stats_from_db(since or datetime.now(timezone.utc) - timedelta(days=30), template_name)
+
+@app.get("/campaigns/{campaign_id}/dead-letters")
+def get_campaign_dead_letters(campaign_id: int, limit: int = Query(100, ge=1, le=1000), after: Optional[int] = None):
+    return fetch_dead_letters_from_db(campaign_id, limit, after)
+
+@app.post("/campaigns/{campaign_id}/dead-letters/replay")
+async def replay_campaign_dead_letters(campaign_id: int, error_code: Optional[int] = None):
+    if await asyncio.to_thread(fetch_campaign_from_db, campaign_id) is None: raise HTTPException(status_code=404, detail="Campaign not found.")
+    replayed = await asyncio.to_thread(replay_dead_letters_in_db, campaign_id, error_code)
+    if replayed: campaign_runner.launch(campaign_id)
+    return {"campaign_id": campaign_id, "replayed": replayed}
+
+@app.post("/campaigns/{campaign_id}/pause")
+async def pause_campaign(campaign_id: int):
+    return await change_campaign_status(campaign_id, 'paused', ('running',))
+
+@app.post("/campaigns/{campaign_id}/resume")
+async def resume_campaign(campaign_id: int):
+    campaign = await change_campaign_status(campaign_id, 'running', ('paused',))
+    campaign_runner.launch(campaign_id)
+    return campaign
+
+@app.post("/campaigns/{campaign_id}/cancel")
+async def cancel_campaign(campaign_id: int):
+    return await change_campaign_status(campaign_id, 'cancelled', ('preparing', 'running', 'paused'))
+
+@app.get("/conversations", response_model=ConversationPage)
+def get_conversations(request: Request, limit: int = Query(50, ge=1, le=500), cursor: Optional[str] = None):
+    return json_response(request, orjson.dumps(fetch_conversations_from_db(limit, cursor)))
+
+@app.get("/search", response_model=SearchResults)
+def search(request: Request, q: str = Query(..., min_length=1, max_length=200), limit: int = Query(20, ge=1, le=100),
+           cursor: Optional[str] = None, sender_id: Optional[str] = None):
+    return json_response(request, orjson.dumps(search_in_db(q, limit, cursor, sender_id)))
+
+@app.get("/conversations/{sender_id}", response_model=MessagePage)
+def get_conversation_history(request: Request, sender_id: str, limit: int = Query(50, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+                             before: Optional[str] = None, after: Optional[str] = None, since: Optional[datetime] = None,
+                             archived: bool = False):
+    # archived=true pages backwards through partitions the retention job has moved to MESSAGE_ARCHIVE_DIR.
+    if archived: return json_response(request, orjson.dumps(fetch_archived_messages_from_db(sender_id, limit, before)))
+    if before is not None: decode_cursor(before)
+    if after is not None: decode_cursor(after)
+    return streaming_json_response(request, stream_messages_for_sender_from_db(sender_id, limit, before, after, since))
+
+@app.post("/conversations/{sender_id}/read")
+def mark_conversation_read(sender_id: str): return mark_conversation_read_in_db(sender_id)
 
 @app.post("/conversations/{sender_id}/reply")
-def post_reply(sender_id: str, reply: Reply, background_tasks: BackgroundTasks):
+async def post_reply(sender_id: str, reply: Reply, background_tasks: BackgroundTasks):
     try:
-        send_text_reply(sender_id, reply.message)
-        background_tasks.add_task(save_outgoing_message_to_db, sender_id, reply.message)
+        response = await send_text_reply(sender_id, reply.message)
+        background_tasks.add_task(save_outgoing_message_to_db, sender_id, reply.message, response_wamid(response))
         return {"status": "Reply sent successfully"}
     except Exception as e: raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/whatsapp-webhook")
 async def whatsapp_webhook(request: Request):
-    data = await request.json()
-    print("Webhook received:", json.dumps(data, indent=2))
-    try:
-        if data.get("object") == "whatsapp_business_account":
-            for entry in data.get("entry", []):
-                for change in entry.get("changes", []):
-                    if change.get("field") == "messages":
-                        message_data = change.get("value", {}).get("messages", [{}])[0]
-                        if message_data.get("type") == "text":
-                            sender_id = message_data.get("from")
-                            message_text = message_data.get("text", {}).get("body")
-                            if sender_id and message_text: save_incoming_message_to_db(sender_id, message_text)
-    except Exception as e: print(f"Error processing webhook: {e}")
+    # Validate and enqueue only; parsing and storage happen in webhook_ingestor's workers so Meta gets its 200 immediately.
+    try: data = json.loads(await request.body())
+    except ValueError: raise HTTPException(status_code=400, detail="Invalid JSON payload.")
+    if not isinstance(data, dict) or data.get("object") != "whatsapp_business_account": return {"status": "ignored"}
+    if not webhook_ingestor.submit(data): raise HTTPException(status_code=503, detail="Webhook queue is full, retry later.")
     return {"status": "ok"}
 
+@app.get("/metrics")
+async def get_metrics():
+    # Collected on the event loop, which is the only place the connection and campaign dicts are mutated.
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/webhook/stats")
+def get_webhook_stats(): return webhook_ingestor.stats()
+
+@app.get("/db-pool/stats")
+def get_db_pool_stats(): return db_pool.stats()
+
+@app.get("/message-writer/stats")
+def get_message_writer_stats(): return message_writer.stats()
+
 @app.get("/whatsapp-webhook")
 async def whatsapp_verify(request: Request):
     if request.query_params.get("hub.mode") == "subscribe" and request.query_params.get("hub.challenge"):
@@ -313,7 +3129,11 @@ async def whatsapp_verify(request: Request):
     return "Hello webhook"
 
 @app.get("/templates", response_model=List[Template])
-def get_templates(): return fetch_templates_from_db()
+def get_templates(request: Request):
+    body, etag = template_store.snapshot()
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+    return json_response(request, body, {"ETag": etag, "Cache-Control": "no-cache"})
 
 @app.post("/templates", response_model=Template)
 def create_template(template: TemplateCreate): return add_template_to_db(template)
@@ -325,6 +3145,6 @@ def update_template(template_id: int, template: TemplateCreate): return update_t
 def delete_template(template_id: int): return delete_template_from_db(template_id)
 
 # ===================================================================
-# --- 6. Serve the Frontend ---
+# --- 10. Serve the Frontend ---
 # ===================================================================
 app.mount("/", StaticFiles(directory="static", html=True), name="static")
\ No newline at end of file
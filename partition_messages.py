@@ -0,0 +1,16 @@
+"""Offline conversion of `messages` into monthly partitions (migration 011).
+
+Stop the web and campaign workers first. The copy runs in batches of MESSAGE_PARTITION_COPY_BATCH_SIZE rows, each in
+its own transaction, and an interrupted run continues where it stopped when started again. Indexes are built once at
+the end; start the app afterwards to apply the remaining migrations:
+
+    python partition_messages.py
+"""
+from main import db_pool, partition_messages_offline
+
+if __name__ == "__main__":
+    db_pool.open()
+    try:
+        partition_messages_offline()
+    finally:
+        db_pool.close()
@@ -1,6 +1,7 @@
 document.addEventListener('DOMContentLoaded', () => {
     // --- 1. ELEMENT REFERENCES ---
     const templateSelect = document.getElementById('template-select');
+    const segmentSelect = document.getElementById('segment-select');
     const imageUrlInput = document.getElementById('image-url-input');
     const manualNameInput = document.getElementById('manual-name-input');
     const manualCcInput = document.getElementById('manual-cc-input');
@@ -18,6 +19,7 @@ document.addEventListener('DOMContentLoaded', () => {
     const savePresetButton = document.getElementById('save-preset-button');
     const deletePresetButton = document.getElementById('delete-preset-button');
     const conversationList = document.getElementById('conversation-list');
+    const conversationSearchInput = document.getElementById('conversation-search-input');
     const messageHistory = document.getElementById('message-history');
     const replyInput = document.getElementById('reply-input');
     const sendReplyButton = document.getElementById('send-reply-button');
@@ -31,8 +33,19 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- 2. DATA & STATE ---
     let customers = [];
+    let currentUpload = null;
     let currentConversationId = null;
+    let oldestCursor = null;
+    let historyArchived = false;
+    let newestCursor = null;
+    let conversationsCursor = null;
+    let searchQuery = '';
+    let searchCursor = null;
+    let searchTimer = null;
     let ws = null;
+    let eventsWs = null;
+    let eventsReconnecting = false;
+    const HISTORY_PAGE_SIZE = 50;
 
     // --- 3. FUNCTIONS ---
     function logToUI(message, status = 'info') {
@@ -48,7 +61,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function displayCustomers() {
         customerTableBody.innerHTML = '';
-        if (customers.length === 0) {
+        if (customers.length === 0 && !currentUpload) {
             const row = customerTableBody.insertRow();
             const cell = row.insertCell();
             cell.colSpan = 2;
@@ -56,6 +69,13 @@ document.addEventListener('DOMContentLoaded', () => {
             cell.style.textAlign = 'center';
             return;
         }
+        if (currentUpload) {
+            const row = customerTableBody.insertRow();
+            const nameCell = row.insertCell();
+            const countCell = row.insertCell();
+            nameCell.textContent = `📄 ${currentUpload.filename}`;
+            countCell.textContent = `${currentUpload.row_count} customers`;
+        }
         customers.forEach(customer => {
             const row = customerTableBody.insertRow();
             const nameCell = row.insertCell();
@@ -65,92 +85,290 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
-    function parseCSV(text) {
-        const lines = text.split('\n').filter(line => line.trim() !== '');
-        if (lines.length < 2) throw new Error("CSV must have a header and at least one data row.");
-        const headers = lines[0].split(',').map(header => header.trim());
-        const data = [];
-        for (let i = 1; i < lines.length; i++) {
-            const values = lines[i].split(',').map(value => value.trim());
-            const entry = {};
-            for (let j = 0; j < headers.length; j++) {
-                entry[headers[j]] = values[j];
-            }
-            data.push(entry);
+    function createMessageElement(msg) {
+        const wrapper = document.createElement('div');
+        const bubble = document.createElement('div');
+        const timestamp = new Date(msg.timestamp).toLocaleString();
+        wrapper.className = 'message-wrapper';
+        wrapper.dataset.messageId = msg.id;
+        bubble.className = 'message-bubble';
+        if (msg.direction && msg.direction.trim() === 'incoming') {
+            wrapper.classList.add('incoming');
+            bubble.classList.add('bg-light', 'text-dark');
+        } else {
+            wrapper.classList.add('outgoing');
+            bubble.classList.add('bg-danger', 'text-white');
         }
-        return data;
+        const status = msg.status ? ` · ${msg.status}` : '';
+        bubble.innerHTML = `${msg.text}<br><small class="text-muted" style="font-size: 0.75em;">${timestamp}${status}</small>`;
+        wrapper.appendChild(bubble);
+        return wrapper;
     }
 
-    function displayMessageHistory(messages) {
+    function setLoadOlderButton(hasMore) {
+        messageHistory.querySelector('.load-older-button')?.remove();
+        // Once the live history is exhausted, older months may still be in the archive; those are only read on request.
+        if (!hasMore && (historyArchived || !oldestCursor)) return;
+        const button = document.createElement('button');
+        button.className = 'btn btn-sm btn-outline-light d-block mx-auto mb-3 load-older-button';
+        button.textContent = hasMore ? 'Load older messages' : 'Load archived messages';
+        button.addEventListener('click', () => {
+            if (!hasMore) historyArchived = true;
+            loadOlderMessages();
+        });
+        messageHistory.prepend(button);
+    }
+
+    function displayMessageHistory(messages, hasMore = false) {
         messageHistory.innerHTML = '';
         if (!messages || messages.length === 0) {
             messageHistory.innerHTML = '<p class="text-muted text-center">No messages in this conversation.</p>';
             return;
         }
+        messages.forEach(msg => messageHistory.appendChild(createMessageElement(msg)));
+        setLoadOlderButton(hasMore);
+        setTimeout(() => { messageHistory.scrollTop = messageHistory.scrollHeight; }, 0);
+    }
+
+    function appendMessages(messages) {
+        if (!messages || messages.length === 0) return;
+        messageHistory.querySelector('p.text-muted')?.remove();
         messages.forEach(msg => {
-            const wrapper = document.createElement('div');
-            const bubble = document.createElement('div');
-            const timestamp = new Date(msg.timestamp).toLocaleString();
-            wrapper.className = 'message-wrapper';
-            bubble.className = 'message-bubble';
-            if (msg.direction && msg.direction.trim() === 'incoming') {
-                wrapper.classList.add('incoming');
-                bubble.classList.add('bg-light', 'text-dark');
-            } else {
-                wrapper.classList.add('outgoing');
-                bubble.classList.add('bg-danger', 'text-white');
-            }
-            bubble.innerHTML = `${msg.text}<br><small class="text-muted" style="font-size: 0.75em;">${timestamp}</small>`;
-            wrapper.appendChild(bubble);
-            messageHistory.appendChild(wrapper);
+            if (!messageHistory.querySelector(`[data-message-id="${msg.id}"]`)) messageHistory.appendChild(createMessageElement(msg));
         });
         setTimeout(() => { messageHistory.scrollTop = messageHistory.scrollHeight; }, 0);
     }
 
-    async function fetchAndDisplayConversations() {
+    async function loadConversation(senderId) {
+        const response = await fetch(`/conversations/${senderId}?limit=${HISTORY_PAGE_SIZE}`);
+        if (!response.ok) throw new Error(`HTTP error! Status: ${response.status}`);
+        const page = await response.json();
+        oldestCursor = page.before;
+        newestCursor = page.after;
+        historyArchived = false;
+        displayMessageHistory(page.messages, page.has_more);
+    }
+
+    async function loadOlderMessages() {
+        if (!currentConversationId || !oldestCursor) return;
+        const archived = historyArchived ? '&archived=true' : '';
+        const response = await fetch(`/conversations/${currentConversationId}?limit=${HISTORY_PAGE_SIZE}&before=${encodeURIComponent(oldestCursor)}${archived}`);
+        if (!response.ok) return;
+        const page = await response.json();
+        oldestCursor = page.before;
+        const anchor = messageHistory.querySelector('.message-wrapper');
+        page.messages.forEach(msg => messageHistory.insertBefore(createMessageElement(msg), anchor));
+        setLoadOlderButton(page.has_more);
+    }
+
+    async function loadNewerMessages() {
+        if (!currentConversationId) return;
+        if (!newestCursor) return loadConversation(currentConversationId);
+        let hasMore = true;
+        while (hasMore) {
+            const response = await fetch(`/conversations/${currentConversationId}?limit=${HISTORY_PAGE_SIZE}&after=${encodeURIComponent(newestCursor)}`);
+            if (!response.ok) return;
+            const page = await response.json();
+            newestCursor = page.after;
+            appendMessages(page.messages);
+            hasMore = page.has_more;
+        }
+    }
+
+    function renderConversationLink(a, conversation) {
+        a.innerHTML = '';
+        const header = document.createElement('div');
+        header.className = 'd-flex justify-content-between align-items-center';
+        const name = document.createElement('span');
+        name.textContent = conversation.sender_id;
+        header.appendChild(name);
+        if (conversation.unread_count > 0) {
+            const badge = document.createElement('span');
+            badge.className = 'badge rounded-pill bg-danger';
+            badge.textContent = conversation.unread_count;
+            header.appendChild(badge);
+        }
+        const snippet = document.createElement('small');
+        snippet.className = 'd-block text-truncate text-white-50';
+        snippet.textContent = conversation.last_message_text || '';
+        a.append(header, snippet);
+    }
+
+    function createConversationItem(conversation, currentSelection) {
+        const senderId = conversation.sender_id;
+        const li = document.createElement('li');
+        const a = document.createElement('a');
+        a.href = '#';
+        a.dataset.senderId = senderId;
+        renderConversationLink(a, conversation);
+        if (senderId === currentSelection) a.classList.add('active');
+        a.addEventListener('click', async (event) => {
+            event.preventDefault();
+            if (currentConversationId) sendEventCommand('unsubscribe', `conversation:${currentConversationId}`);
+            currentConversationId = senderId;
+            sendEventCommand('subscribe', `conversation:${senderId}`);
+            document.querySelectorAll('.conversation-list li a').forEach(el => el.classList.remove('active'));
+            a.classList.add('active');
+            a.querySelector('.badge')?.remove();
+            fetch(`/conversations/${senderId}/read`, { method: 'POST' });
+            messageHistory.innerHTML = '<p class="text-muted text-center">Loading messages...</p>';
+            try {
+                await loadConversation(senderId);
+                replyInput.disabled = false;
+                sendReplyButton.disabled = false;
+            } catch (error) {
+                messageHistory.innerHTML = '<p class="text-danger text-center">Error loading messages.</p>';
+            }
+        });
+        li.appendChild(a);
+        return li;
+    }
+
+    function setLoadMoreConversationsButton() {
+        conversationList.querySelector('.load-more-conversations')?.remove();
+        if (!conversationsCursor) return;
+        const li = document.createElement('li');
+        li.className = 'load-more-conversations';
+        const a = document.createElement('a');
+        a.href = '#';
+        a.className = 'text-center text-white-50';
+        a.textContent = 'Load more conversations';
+        a.addEventListener('click', (event) => { event.preventDefault(); fetchAndDisplayConversations(true); });
+        li.appendChild(a);
+        conversationList.appendChild(li);
+    }
+
+    async function fetchAndDisplayConversations(loadMore = false) {
+        if (searchQuery) return;
         try {
-            const response = await fetch('/conversations');
+            const url = loadMore && conversationsCursor ? `/conversations?cursor=${encodeURIComponent(conversationsCursor)}` : '/conversations';
+            const response = await fetch(url);
             if (!response.ok) throw new Error(`HTTP error! Status: ${response.status}`);
             const data = await response.json();
             const currentSelection = document.querySelector('.conversation-list li a.active')?.dataset.senderId;
-            conversationList.innerHTML = '';
+            if (!loadMore) conversationList.innerHTML = '';
+            conversationsCursor = data.next_cursor;
             
             if (data.conversations && data.conversations.length > 0) {
-                data.conversations.forEach(senderId => {
-                    const li = document.createElement('li');
-                    const a = document.createElement('a');
-                    a.href = '#';
-                    a.textContent = senderId;
-                    a.dataset.senderId = senderId;
-                    if (senderId === currentSelection) a.classList.add('active');
-                    a.addEventListener('click', async (event) => {
-                        event.preventDefault();
-                        currentConversationId = senderId;
-                        document.querySelectorAll('.conversation-list li a').forEach(el => el.classList.remove('active'));
-                        a.classList.add('active');
-                        messageHistory.innerHTML = '<p class="text-muted text-center">Loading messages...</p>';
-                        try {
-                            const historyResponse = await fetch(`/conversations/${senderId}`);
-                            const messages = await historyResponse.json();
-                            displayMessageHistory(messages);
-                            replyInput.disabled = false;
-                            sendReplyButton.disabled = false;
-                        } catch (error) {
-                            messageHistory.innerHTML = '<p class="text-danger text-center">Error loading messages.</p>';
-                        }
-                    });
-                    li.appendChild(a);
-                    conversationList.appendChild(li);
-                });
-            } else {
+                data.conversations.forEach(conversation => conversationList.appendChild(createConversationItem(conversation, currentSelection)));
+            } else if (!loadMore) {
                 conversationList.innerHTML = '<li><a href="#">No conversations found.</a></li>';
             }
+            setLoadMoreConversationsButton();
         } catch (error) {
             console.error("Failed to fetch conversations:", error);
             conversationList.innerHTML = `<li><a href="#">Error loading conversations.</a></li>`;
         }
     }
 
+    function highlightSnippet(snippet) {
+        const div = document.createElement('div');
+        div.textContent = snippet;
+        return div.innerHTML.replace(/&lt;mark&gt;/g, '<mark>').replace(/&lt;\/mark&gt;/g, '</mark>');
+    }
+
+    function createSearchHitItem(hit) {
+        const li = createConversationItem({ sender_id: hit.sender_id, unread_count: 0, last_message_text: '' }, currentConversationId);
+        const snippet = li.querySelector('small');
+        snippet.classList.remove('text-truncate');
+        snippet.innerHTML = `${new Date(hit.timestamp).toLocaleString()} · ${highlightSnippet(hit.snippet)}`;
+        return li;
+    }
+
+    async function runSearch(loadMore = false) {
+        const query = searchQuery;
+        if (!query) return;
+        try {
+            const params = new URLSearchParams({ q: query });
+            if (loadMore && searchCursor) params.set('cursor', searchCursor);
+            const response = await fetch(`/search?${params}`);
+            if (!response.ok) throw new Error(`HTTP error! Status: ${response.status}`);
+            const data = await response.json();
+            if (query !== searchQuery) return;
+            if (!loadMore) conversationList.innerHTML = '';
+            conversationList.querySelector('.load-more-conversations')?.remove();
+            data.contacts.forEach(contact => conversationList.appendChild(createConversationItem(contact, currentConversationId)));
+            data.messages.forEach(hit => conversationList.appendChild(createSearchHitItem(hit)));
+            if (!loadMore && data.contacts.length === 0 && data.messages.length === 0) {
+                conversationList.innerHTML = '<li><a href="#">No matches found.</a></li>';
+            }
+            searchCursor = data.next_cursor;
+            if (searchCursor) {
+                const li = document.createElement('li');
+                li.className = 'load-more-conversations';
+                const a = document.createElement('a');
+                a.href = '#';
+                a.className = 'text-center text-white-50';
+                a.textContent = 'More results';
+                a.addEventListener('click', (event) => { event.preventDefault(); runSearch(true); });
+                li.appendChild(a);
+                conversationList.appendChild(li);
+            }
+        } catch (error) {
+            console.error("Search failed:", error);
+            conversationList.innerHTML = '<li><a href="#">Search failed.</a></li>';
+        }
+    }
+
+    function upsertConversationItem(conversation) {
+        if (searchQuery) return;
+        const senderId = conversation.sender_id;
+        const existing = [...conversationList.querySelectorAll('a[data-sender-id]')].find(a => a.dataset.senderId === senderId);
+        if (senderId === currentConversationId && conversation.unread_count > 0) {
+            conversation.unread_count = 0;
+            fetch(`/conversations/${senderId}/read`, { method: 'POST' });
+        }
+        if (existing) {
+            renderConversationLink(existing, conversation);
+            conversationList.prepend(existing.parentElement);
+        } else {
+            if (!conversationList.querySelector('a[data-sender-id]')) conversationList.innerHTML = '';
+            conversationList.prepend(createConversationItem(conversation, currentConversationId));
+        }
+    }
+
+    function handleServerEvent(event) {
+        if (event.type === 'conversation.updated') {
+            upsertConversationItem(event.conversation);
+        } else if (event.type === 'message.new' && event.sender_id === currentConversationId) {
+            if (event.messages && event.messages.length > 0) {
+                appendMessages(event.messages);
+                newestCursor = event.messages[event.messages.length - 1].cursor;
+            } else {
+                loadNewerMessages();
+            }
+        } else if (event.type === 'resync') {
+            fetchAndDisplayConversations();
+            loadNewerMessages();
+        }
+    }
+
+    function sendEventCommand(action, topic) {
+        if (eventsWs && eventsWs.readyState === WebSocket.OPEN) eventsWs.send(JSON.stringify({ action, topic }));
+    }
+
+    function connectEventsSocket() {
+        if (eventsWs && eventsWs.readyState < 2) return;
+        const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
+        eventsWs = new WebSocket(`${wsProtocol}//${window.location.host}/ws/events`);
+        eventsWs.onopen = () => {
+            sendEventCommand('subscribe', 'inbox');
+            if (currentConversationId) sendEventCommand('subscribe', `conversation:${currentConversationId}`);
+            // Catch up on anything that happened while we were disconnected.
+            if (eventsReconnecting) {
+                fetchAndDisplayConversations();
+                loadNewerMessages();
+            }
+            eventsReconnecting = true;
+        };
+        eventsWs.onmessage = (event) => handleServerEvent(JSON.parse(event.data));
+        eventsWs.onclose = () => {
+            eventsWs = null;
+            setTimeout(connectEventsSocket, 5000);
+        };
+        eventsWs.onerror = (error) => { console.error('Events WebSocket error:', error); eventsWs.close(); };
+    }
+
     function connectWebSocket() {
         if (ws && ws.readyState < 2) return;
         const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
@@ -198,6 +416,21 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
     
+    async function populateSegmentDropdown() {
+        try {
+            const response = await fetch('/segments');
+            const segments = await response.json();
+            segments.forEach(segment => {
+                const option = document.createElement('option');
+                option.value = segment.segment_id;
+                option.textContent = segment.name;
+                segmentSelect.appendChild(option);
+            });
+        } catch (error) {
+            console.error("Failed to load segments:", error);
+        }
+    }
+
     async function fetchAndDisplayTemplates() {
         try {
             const response = await fetch('/templates');
@@ -221,18 +454,27 @@ document.addEventListener('DOMContentLoaded', () => {
 
     // --- 4. EVENT LISTENERS ---
     loadCsvButton.addEventListener('click', () => csvFileInput.click());
-    csvFileInput.addEventListener('change', (event) => {
+    csvFileInput.addEventListener('change', async (event) => {
         const file = event.target.files[0];
         if (!file) return;
-        const reader = new FileReader();
-        reader.onload = (e) => {
-            try { customers = parseCSV(e.target.result); displayCustomers(); logToUI(`✔ Loaded ${customers.length} customers.`, 'success'); }
-            catch (error) { logToUI(`❌ Error: Could not parse CSV.`, 'error'); alert('Error: Could not parse the CSV file.'); }
-        };
-        reader.readAsText(file);
         event.target.value = '';
+        const formData = new FormData();
+        formData.append('file', file);
+        logToUI(`⏳ Uploading ${file.name}...`, 'info');
+        try {
+            const response = await fetch('/campaign-uploads', { method: 'POST', body: formData });
+            const result = await response.json();
+            if (!response.ok) throw new Error(result.detail || 'Upload failed.');
+            currentUpload = result;
+            displayCustomers();
+            logToUI(`✔ Loaded ${result.row_count} customers from ${file.name}.`, 'success');
+            if (result.rejected_count > 0) logToUI(`⚠️ Skipped ${result.rejected_count} rows. ${result.errors.join(' ')}`, 'warning');
+        } catch (error) {
+            logToUI(`❌ Error: Could not load CSV. ${error.message}`, 'error');
+            alert('Error: Could not load the CSV file.');
+        }
     });
-    clearListButton.addEventListener('click', () => { customers = []; displayCustomers(); logToUI('ℹ️ Customer list cleared.', 'info'); });
+    clearListButton.addEventListener('click', () => { customers = []; currentUpload = null; displayCustomers(); logToUI('ℹ️ Customer list cleared.', 'info'); });
     manualAddButton.addEventListener('click', () => {
         const name = manualNameInput.value.trim();
         const phone = manualPhoneInput.value.trim();
@@ -247,18 +489,28 @@ document.addEventListener('DOMContentLoaded', () => {
         const templateName = templateSelect.value;
         const imageUrl = imageUrlInput.value.trim();
         if (templateName === 'Select a template...') { alert('Please select a template.'); return; }
-        if (customers.length === 0) { alert('Please load or add customers.'); return; }
-        const campaignData = { template_name: templateName, image_url: imageUrl || null, customers: customers };
+        const segmentId = segmentSelect.value ? Number(segmentSelect.value) : null;
+        if (customers.length === 0 && !currentUpload && segmentId === null) { alert('Please load or add customers, or select a segment.'); return; }
+        const campaignData = { template_name: templateName, image_url: imageUrl || null, customers: customers, upload_id: currentUpload ? currentUpload.upload_id : null, segment_id: segmentId };
         logToUI('--- Sending campaign request... ---', 'info');
         try {
             const response = await fetch('/start-campaign', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(campaignData) });
             const result = await response.json();
             if (!response.ok) throw new Error(result.detail || 'An unknown error occurred.');
-            logToUI(`✅ Backend accepted campaign.`, 'success');
+            logToUI(`✅ Backend accepted campaign #${result.campaign_id}; preparing its recipients.`, 'success');
         } catch (error) {
             logToUI(`❌ ERROR: Could not start campaign. ${error.message}`, 'error');
         }
     });
+    conversationSearchInput.addEventListener('input', () => {
+        clearTimeout(searchTimer);
+        searchTimer = setTimeout(() => {
+            searchQuery = conversationSearchInput.value.trim();
+            searchCursor = null;
+            if (searchQuery) runSearch();
+            else fetchAndDisplayConversations();
+        }, 300);
+    });
     sendReplyButton.addEventListener('click', async () => {
         const messageText = replyInput.value.trim();
         if (!messageText || !currentConversationId) return;
@@ -267,9 +519,7 @@ document.addEventListener('DOMContentLoaded', () => {
             const response = await fetch(`/conversations/${currentConversationId}/reply`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ message: messageText }) });
             if (!response.ok) throw new Error('Failed to send reply.');
             replyInput.value = '';
-            const historyResponse = await fetch(`/conversations/${currentConversationId}`);
-            const messages = await historyResponse.json();
-            displayMessageHistory(messages);
+            if (!eventsWs || eventsWs.readyState !== WebSocket.OPEN) await loadNewerMessages();
         } catch (error) {
             alert('Failed to send reply.');
         } finally {
@@ -361,9 +611,10 @@ document.addEventListener('DOMContentLoaded', () => {
     // --- 5. INITIALIZATION ---
     displayCustomers();
     connectWebSocket();
+    connectEventsSocket();
     fetchAndDisplayConversations();
     updatePresetDropdown();
-    setInterval(fetchAndDisplayConversations, 25000);
     fetchAndDisplayTemplates();
     populateTemplateDropdown();
+    populateSegmentDropdown();
 });
\ No newline at end of file
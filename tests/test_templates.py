@@ -0,0 +1,19 @@
+from main import CompiledTemplate
+
+
+def test_escaped_braces_render_as_literals():
+    body_vars, text = CompiledTemplate("Hi {name}, {{literal}}").render({"name": "A"})
+    assert text == "Hi A, {literal}"
+    assert body_vars == ["A"]
+
+
+def test_renders_like_str_format():
+    body = "{name!r} owes {amount:.2f} by {due:>{width}}"
+    values = {"name": "A", "amount": 3.5, "due": "Fri", "width": 5}
+    assert CompiledTemplate(body).render(values)[1] == body.format(**values)
+
+
+def test_missing_placeholder_leaves_text_unrendered():
+    body_vars, text = CompiledTemplate("Hi {name}, your code is {code}").render({"name": "A"})
+    assert text is None
+    assert body_vars == ["A"]